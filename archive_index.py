@@ -0,0 +1,830 @@
+#!/usr/bin/env python3
+"""アーカイブを展開せずにファイル一覧（名前と展開後サイズ）を取得する。
+zip は zipfile、RAR4/RAR5/7z はヘッダを直接読む。tar/cbt は tarfile で読む（.tar.zst は zstd で伸長しながら）。
+ヘッダが暗号化されている・未対応の方式で圧縮されている場合のみ外部ツール(lsar/7z)を使う。
+ZIPのメンバを複数スレッドで並列に読み出す ParallelZipReader と、tar を先頭から1回だけ読みながら
+メンバを配る TarStreamReader も置く。
+"""
+
+import collections
+import contextlib
+import io
+import json
+import lzma
+import os
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+
+RAR4_SIG = b'Rar!\x1a\x07\x00'
+RAR5_SIG = b'Rar!\x1a\x07\x01\x00'
+SEVENZIP_SIG = b'7z\xbc\xaf\x27\x1c'
+TOOL_TIMEOUT = 30
+TAR_EXTS = {'tar', 'cbt', 'tar.zst', 'tzst'}
+ZSTD_EXTS = {'tar.zst', 'tzst'}
+STREAM_BLOCK = 8 * 1024 * 1024   # tar を読み書きするときのバッファ（遅いディスクでも大きな単位でI/Oする）
+PAGE_ALIGN = 4096         # 出力ZIPの無圧縮エントリのデータ先頭を揃える境界（mmap用）
+ALIGN_EXTRA_ID = 0xD935   # Android の zipalign と同じ詰め物用の拡張フィールドID
+
+
+class UnsupportedHeader(Exception):
+    """ヘッダが暗号化されている等、自前では読めない"""
+
+
+def archive_ext(path):
+    """アーカイブの拡張子（小文字。'.tar.zst' は 'tar.zst' として返す）"""
+    name = os.path.basename(path).lower()
+    if name.endswith('.tar.zst'):
+        return 'tar.zst'
+    return name.rsplit('.', 1)[-1] if '.' in name else ''
+
+
+def list_entries(path):
+    """アーカイブ内のファイル一覧 [(名前, 展開後サイズ)] を返す（ディレクトリは除く）
+    サイズが分からない場合は None。
+    """
+    ext = archive_ext(path)
+    if ext in ('zip', 'cbz'):
+        with zipfile.ZipFile(path, 'r') as z:
+            return [(i.filename, i.file_size) for i in z.infolist() if not i.is_dir()]
+    if ext in TAR_EXTS:
+        try:
+            return [(m.filename, m.file_size) for m in list_tar(path)]
+        except (tarfile.TarError, OSError, ValueError):
+            return []
+
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(8)
+            f.seek(0)
+            if head.startswith(RAR5_SIG):
+                return read_rar5(f)
+            if head.startswith(RAR4_SIG):
+                return read_rar4(f)
+            if head.startswith(SEVENZIP_SIG):
+                return read_7z(f)
+    except (UnsupportedHeader, EOFError, ValueError, IndexError, struct.error, lzma.LZMAError):
+        pass
+
+    return _list_with_tools(path, ext)
+
+
+def _read(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise EOFError('unexpected end of archive')
+    return data
+
+
+# --- RAR5 ---
+
+def _vint(buf, pos):
+    """RAR5の可変長整数（7bitずつ、最上位bitが継続）"""
+    value = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return value, pos
+        shift += 7
+
+
+def read_rar5(f):
+    f.seek(len(RAR5_SIG))
+    entries = []
+    while True:
+        head = f.read(7)
+        if len(head) < 5:
+            break
+        # CRC32(4) + ヘッダサイズ(vint, 最大3バイト)
+        size, n = _vint(head, 4)
+        f.seek(f.tell() - len(head) + n)
+        buf = _read(f, size)
+        htype, pos = _vint(buf, 0)
+        hflags, pos = _vint(buf, pos)
+        if hflags & 0x0001:
+            _, pos = _vint(buf, pos)
+        data_size = 0
+        if hflags & 0x0002:
+            data_size, pos = _vint(buf, pos)
+
+        if htype == 4:
+            raise UnsupportedHeader('encrypted headers')
+        if htype == 5:
+            break
+        if htype == 2:
+            file_flags, pos = _vint(buf, pos)
+            unp_size, pos = _vint(buf, pos)
+            _, pos = _vint(buf, pos)            # 属性
+            if file_flags & 0x0002:
+                pos += 4                        # 更新日時
+            if file_flags & 0x0004:
+                pos += 4                        # CRC32
+            _, pos = _vint(buf, pos)            # 圧縮方式
+            _, pos = _vint(buf, pos)            # ホストOS
+            name_len, pos = _vint(buf, pos)
+            name = buf[pos:pos + name_len].decode('utf-8', 'replace')
+            # 分割ボリュームの続きは先頭側で数える
+            if not file_flags & 0x0001 and not hflags & 0x0008:
+                entries.append((name, None if file_flags & 0x0008 else unp_size))
+        f.seek(data_size, 1)
+    return entries
+
+
+# --- RAR4 ---
+
+def _rar4_unicode(raw):
+    """RAR4のUnicodeファイル名（ASCII部 + 0 + 差分符号化）を復号"""
+    zero = raw.index(0)
+    ascii_part = raw[:zero]
+    enc = raw[zero + 1:]
+    if not enc:
+        return ascii_part.decode('utf-8', 'replace')
+    out = []
+    high = enc[0]
+    pos = 1
+    flags = 0
+    flag_bits = 0
+    while pos < len(enc):
+        if flag_bits == 0:
+            flags = enc[pos]
+            pos += 1
+            flag_bits = 8
+        flag_bits -= 2
+        mode = (flags >> flag_bits) & 3
+        if mode == 0:
+            out.append(enc[pos])
+            pos += 1
+        elif mode == 1:
+            out.append(enc[pos] | (high << 8))
+            pos += 1
+        elif mode == 2:
+            out.append(enc[pos] | (enc[pos + 1] << 8))
+            pos += 2
+        else:
+            n = enc[pos]
+            pos += 1
+            if n & 0x80:
+                correction = enc[pos]
+                pos += 1
+                for _ in range((n & 0x7f) + 2):
+                    out.append(((ascii_part[len(out)] + correction) & 0xff) | (high << 8))
+            else:
+                for _ in range(n + 2):
+                    out.append(ascii_part[len(out)])
+    return ''.join(chr(c) for c in out)
+
+
+def read_rar4(f):
+    f.seek(len(RAR4_SIG))
+    entries = []
+    while True:
+        head = f.read(7)
+        if len(head) < 7:
+            break
+        _, htype, hflags, hsize = struct.unpack('<HBHH', head)
+        if hsize < 7:
+            raise ValueError('broken header')
+        body = _read(f, hsize - 7)
+        add_size = 0
+
+        if htype == 0x73 and hflags & 0x0080:
+            raise UnsupportedHeader('encrypted headers')
+        if htype == 0x7b:
+            break
+        if htype == 0x74:
+            pack_size, unp_size = struct.unpack_from('<II', body, 0)
+            name_size = struct.unpack_from('<H', body, 19)[0]
+            pos = 25
+            if hflags & 0x0100:
+                high_pack, high_unp = struct.unpack_from('<II', body, pos)
+                pack_size |= high_pack << 32
+                unp_size |= high_unp << 32
+                pos += 8
+            raw = body[pos:pos + name_size]
+            if hflags & 0x0200 and 0 in raw:
+                name = _rar4_unicode(raw)
+            else:
+                name = raw.decode('utf-8', 'replace')
+            is_dir = hflags & 0x00e0 == 0x00e0
+            # 分割ボリュームの続き(0x01)は数えない
+            if not is_dir and not hflags & 0x0001:
+                entries.append((name.replace('\\', '/'), unp_size))
+            add_size = pack_size
+        elif hflags & 0x8000:
+            add_size = struct.unpack_from('<I', body, 0)[0]
+        f.seek(add_size, 1)
+    return entries
+
+
+# --- 7z ---
+
+class _Buf:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def byte(self):
+        b = self.data[self.pos]
+        self.pos += 1
+        return b
+
+    def bytes(self, n):
+        if self.pos + n > len(self.data):
+            raise EOFError('unexpected end of header')
+        b = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return b
+
+    def number(self):
+        """7zの可変長整数（先頭バイトの上位bitで後続バイト数を表す）"""
+        first = self.byte()
+        mask = 0x80
+        value = 0
+        for i in range(8):
+            if not first & mask:
+                return value | ((first & (mask - 1)) << (8 * i))
+            value |= self.byte() << (8 * i)
+            mask >>= 1
+        return value
+
+    def bits(self, n):
+        out = []
+        b = 0
+        for i in range(n):
+            if i % 8 == 0:
+                b = self.byte()
+            out.append(bool(b & (0x80 >> (i % 8))))
+        return out
+
+    def defined(self, n):
+        all_defined = self.byte()
+        return [True] * n if all_defined else self.bits(n)
+
+
+def _7z_digests(buf, n):
+    for d in buf.defined(n):
+        if d:
+            buf.bytes(4)
+
+
+def _7z_pack_info(buf):
+    pack_pos = buf.number()
+    n = buf.number()
+    sizes = []
+    while True:
+        pid = buf.byte()
+        if pid == 0x00:
+            break
+        if pid == 0x09:
+            sizes = [buf.number() for _ in range(n)]
+        elif pid == 0x0a:
+            _7z_digests(buf, n)
+        else:
+            raise ValueError(f'unexpected property {pid:#x}')
+    return pack_pos, sizes
+
+
+def _7z_folder(buf):
+    coders = []
+    total_in = 0
+    total_out = 0
+    for _ in range(buf.number()):
+        flag = buf.byte()
+        coder_id = buf.bytes(flag & 0x0f)
+        n_in, n_out = (buf.number(), buf.number()) if flag & 0x10 else (1, 1)
+        props = buf.bytes(buf.number()) if flag & 0x20 else b''
+        coders.append((coder_id, props))
+        total_in += n_in
+        total_out += n_out
+    bound_out = set()
+    for _ in range(total_out - 1):
+        buf.number()
+        bound_out.add(buf.number())
+    n_packed = total_in - (total_out - 1)
+    if n_packed > 1:
+        for _ in range(n_packed):
+            buf.number()
+    return {'coders': coders, 'n_out': total_out, 'bound_out': bound_out}
+
+
+def _7z_unpack_info(buf):
+    if buf.byte() != 0x0b:
+        raise ValueError('folder expected')
+    n = buf.number()
+    if buf.byte() != 0:
+        raise UnsupportedHeader('external folders')
+    folders = [_7z_folder(buf) for _ in range(n)]
+    if buf.byte() != 0x0c:
+        raise ValueError('unpack sizes expected')
+    for folder in folders:
+        sizes = [buf.number() for _ in range(folder['n_out'])]
+        main = [i for i in range(folder['n_out']) if i not in folder['bound_out']][0]
+        folder['size'] = sizes[main]
+        folder['crc'] = False
+    while True:
+        pid = buf.byte()
+        if pid == 0x00:
+            break
+        if pid == 0x0a:
+            for folder, d in zip(folders, buf.defined(n)):
+                if d:
+                    buf.bytes(4)
+                    folder['crc'] = True
+        else:
+            raise ValueError(f'unexpected property {pid:#x}')
+    return folders
+
+
+def _7z_substreams(buf, folders):
+    counts = [1] * len(folders)
+    sizes = []
+    pid = buf.byte()
+    if pid == 0x0d:
+        counts = [buf.number() for _ in folders]
+        pid = buf.byte()
+    has_sizes = pid == 0x09
+    for folder, count in zip(folders, counts):
+        if count == 0:
+            continue
+        part = [buf.number() for _ in range(count - 1)] if has_sizes else []
+        sizes.extend(part)
+        sizes.append(folder['size'] - sum(part))
+    if has_sizes:
+        pid = buf.byte()
+    while pid != 0x00:
+        if pid == 0x0a:
+            n = sum(c for f, c in zip(folders, counts) if not (c == 1 and f['crc']))
+            _7z_digests(buf, n)
+        else:
+            raise ValueError(f'unexpected property {pid:#x}')
+        pid = buf.byte()
+    return sizes
+
+
+def _7z_streams_info(buf):
+    """StreamsInfo を読み (pack_pos, pack_sizes, folders, ファイルごとのサイズ) を返す"""
+    pack_pos, pack_sizes, folders, sizes = 0, [], [], None
+    while True:
+        pid = buf.byte()
+        if pid == 0x00:
+            break
+        if pid == 0x06:
+            pack_pos, pack_sizes = _7z_pack_info(buf)
+        elif pid == 0x07:
+            folders = _7z_unpack_info(buf)
+        elif pid == 0x08:
+            sizes = _7z_substreams(buf, folders)
+        else:
+            raise ValueError(f'unexpected property {pid:#x}')
+    if sizes is None:
+        sizes = [folder['size'] for folder in folders]
+    return pack_pos, pack_sizes, folders, sizes
+
+
+def _7z_decode_header(f, buf):
+    """LZMA/LZMA2で圧縮されたヘッダを展開（暗号化や複数コーダは未対応）"""
+    pack_pos, pack_sizes, folders, _ = _7z_streams_info(buf)
+    if len(folders) != 1 or len(folders[0]['coders']) != 1 or not pack_sizes:
+        raise UnsupportedHeader('complex header coders')
+    coder_id, props = folders[0]['coders'][0]
+    if coder_id == b'\x03\x01\x01':
+        d = props[0]
+        dict_size = struct.unpack('<I', props[1:5])[0]
+        filters = [{'id': lzma.FILTER_LZMA1, 'dict_size': dict_size,
+                    'lc': d % 9, 'lp': (d // 9) % 5, 'pb': d // 45}]
+    elif coder_id == b'\x21':
+        p = props[0]
+        dict_size = (2 | (p & 1)) << (p // 2 + 11) if p < 40 else 0xffffffff
+        filters = [{'id': lzma.FILTER_LZMA2, 'dict_size': dict_size}]
+    elif coder_id == b'\x00':
+        filters = None
+    else:
+        raise UnsupportedHeader(f'header coder {coder_id.hex()}')
+    f.seek(32 + pack_pos)
+    packed = _read(f, pack_sizes[0])
+    if filters is None:
+        return packed
+    dec = lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=filters)
+    return dec.decompress(packed, max_length=folders[0]['size'])
+
+
+def read_7z(f):
+    start = _read(f, 32)
+    next_offset, next_size = struct.unpack_from('<QQ', start, 12)
+    if next_size == 0:
+        return []
+    f.seek(32 + next_offset)
+    buf = _Buf(_read(f, next_size))
+
+    pid = buf.byte()
+    while pid == 0x17:
+        buf = _Buf(_7z_decode_header(f, buf))
+        pid = buf.byte()
+    if pid != 0x01:
+        raise ValueError('header expected')
+
+    sizes = []
+    names = []
+    empty_stream = []
+    empty_file = []
+    n_files = 0
+    while True:
+        pid = buf.byte()
+        if pid == 0x00:
+            break
+        if pid == 0x02:
+            while buf.byte() != 0x00:
+                buf.bytes(buf.number())
+        elif pid == 0x03:
+            _7z_streams_info(buf)
+        elif pid == 0x04:
+            sizes = _7z_streams_info(buf)[3]
+        elif pid == 0x05:
+            n_files = buf.number()
+            while True:
+                prop = buf.byte()
+                if prop == 0x00:
+                    break
+                size = buf.number()
+                end = buf.pos + size
+                if prop == 0x0e:
+                    empty_stream = buf.bits(n_files)
+                elif prop == 0x0f:
+                    empty_file = buf.bits(empty_stream.count(True))
+                elif prop == 0x11:
+                    if buf.byte() != 0:
+                        raise UnsupportedHeader('external names')
+                    raw = buf.bytes(end - buf.pos)
+                    names = raw.decode('utf-16-le').split('\x00')[:n_files]
+                buf.pos = end
+        else:
+            raise ValueError(f'unexpected property {pid:#x}')
+
+    empty_stream = empty_stream or [False] * n_files
+    entries = []
+    stream_idx = 0
+    empty_idx = 0
+    for i in range(n_files):
+        name = names[i] if i < len(names) else ''
+        if empty_stream[i]:
+            is_file = empty_idx < len(empty_file) and empty_file[empty_idx]
+            empty_idx += 1
+            if is_file:
+                entries.append((name, 0))
+        else:
+            entries.append((name, sizes[stream_idx] if stream_idx < len(sizes) else None))
+            stream_idx += 1
+    return entries
+
+
+# --- ZIPの並列読み出し ---
+
+class ParallelZipReader:
+    """スレッドごとに別の ZipFile を開いてメンバを並列に読み出す
+    1つのハンドルを共有するとシークと読み込みがロックで直列になるため、スレッドごとに開く。
+    zlib の伸長は GIL を解放するので、Deflate 圧縮の PNG/BMP でも複数コアで伸長が進む。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._handles = []
+        with zipfile.ZipFile(path, 'r') as z:
+            self.members = [i for i in z.infolist() if not i.is_dir()]
+
+    def _handle(self):
+        z = getattr(self._local, 'zip', None)
+        if z is None:
+            z = zipfile.ZipFile(self.path, 'r')
+            self._local.zip = z
+            with self._lock:
+                self._handles.append(z)
+        return z
+
+    def open(self, info):
+        return self._handle().open(info)
+
+    def read(self, info):
+        return self._handle().read(info)
+
+    def extract_to(self, info, dst, block=1024 * 1024):
+        """メンバを dst に書き出す（全体をメモリに載せない）"""
+        with self._handle().open(info) as fi, open(dst, 'wb') as fo:
+            shutil.copyfileobj(fi, fo, block)
+
+    def close(self):
+        with self._lock:
+            for z in self._handles:
+                z.close()
+            self._handles = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# --- tar（中央ディレクトリが無いので先頭から順に読み書きする） ---
+
+# tar のメンバ（ZipInfo と同じ属性名。offset は伸長後のストリーム上のヘッダ位置で、メンバの識別に使う）
+TarMember = collections.namedtuple('TarMember', 'filename file_size offset')
+
+
+@contextlib.contextmanager
+def tar_stream(path):
+    """tar を先頭から順に読む TarFile（ストリームモード。gz/bz2/xz は tarfile が、.tar.zst は zstd が伸長する）"""
+    if archive_ext(path) in ZSTD_EXTS:
+        zstd = shutil.which('zstd')
+        if not zstd:
+            raise ValueError('zstd not found (needed for .tar.zst)')
+        proc = subprocess.Popen([zstd, '-dcq', path], stdout=subprocess.PIPE, bufsize=STREAM_BLOCK)
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode='r|') as tin:
+                yield tin
+        finally:
+            proc.stdout.close()
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+    else:
+        with open(path, 'rb', buffering=STREAM_BLOCK) as f, tarfile.open(fileobj=f, mode='r|*') as tin:
+            yield tin
+
+
+def list_tar(path):
+    """tar の通常ファイルの一覧 [TarMember]
+    無圧縮ならヘッダだけをシークしながら読む。圧縮されていれば一度最後まで伸長して読み捨てる。
+    """
+    if archive_ext(path) not in ZSTD_EXTS:
+        with tarfile.open(path, 'r:*') as tin:
+            return [TarMember(t.name, t.size, t.offset) for t in tin if t.isreg()]
+    with tar_stream(path) as tin:
+        return [TarMember(t.name, t.size, t.offset) for t in tin if t.isreg()]
+
+
+def extract_tar(path, dest_dir):
+    """tar をストリームのまま dest_dir に展開（絶対パスや '..' は data フィルタで弾く）"""
+    with tar_stream(path) as tin:
+        if hasattr(tarfile, 'data_filter'):
+            tin.extractall(dest_dir, filter='data')
+        else:
+            tin.extractall(dest_dir)
+
+
+class TarStreamReader:
+    """tar を別スレッドで先頭から1回だけ読み、メンバを要求したスレッドに渡す
+    ParallelZipReader と同じ read / open / extract_to を持つが、メンバはストリームの順に届くので、
+    要求もおおむねその順に出す（変換タスクを一覧の順に投入する）こと。
+    先読みしてメモリに置くのは ahead 件まで。spill を指定したメンバ（画像以外など）は
+    先読みに数えず、読んだ時点でそのパスに書き出す。start で渡したもの以外は読み捨てる。
+    """
+
+    def __init__(self, path, ahead=8):
+        self.path = path
+        self.ahead = ahead
+        self.members = list_tar(path)
+        self._cv = threading.Condition()
+        self._ready = {}      # offset -> データ
+        self._wanted = set()
+        self._spill = {}      # offset -> 書き出し先
+        self._stop = False
+        self._finished = False
+        self._error = None
+        self._thread = None
+
+    def spill(self, info, dst):
+        self._spill[info.offset] = dst
+
+    def start(self, wanted):
+        """wanted（read で受け取るメンバ）を登録して読み始める"""
+        self._wanted = {m.offset for m in wanted}
+        self._thread = threading.Thread(target=self._feed, daemon=True)
+        self._thread.start()
+
+    def _feed(self):
+        try:
+            with tar_stream(self.path) as tin:
+                for t in tin:
+                    if self._stop:
+                        break
+                    if not t.isreg():
+                        continue
+                    if t.offset in self._spill:
+                        with tin.extractfile(t) as fi, open(self._spill[t.offset], 'wb') as fo:
+                            shutil.copyfileobj(fi, fo, STREAM_BLOCK)
+                    elif t.offset in self._wanted:
+                        data = tin.extractfile(t).read()
+                        with self._cv:
+                            while len(self._ready) >= self.ahead and not self._stop:
+                                self._cv.wait()
+                            self._ready[t.offset] = data
+                            self._cv.notify_all()
+        except Exception as e:
+            self._error = e
+        finally:
+            with self._cv:
+                self._finished = True
+                self._cv.notify_all()
+
+    def read(self, info):
+        with self._cv:
+            while info.offset not in self._ready:
+                if self._error:
+                    raise OSError(f'reading {self.path}: {self._error}')
+                if self._finished or self._stop:
+                    raise EOFError(f'{info.filename} was not delivered')
+                self._cv.wait()
+            data = self._ready.pop(info.offset)
+            self._cv.notify_all()
+        return data
+
+    def open(self, info):
+        return io.BytesIO(self.read(info))
+
+    def extract_to(self, info, dst, block=None):
+        with open(dst, 'wb') as f:
+            f.write(self.read(info))
+
+    def abort(self):
+        """読むのをやめる（待っている read は EOFError になる）"""
+        with self._cv:
+            self._stop = True
+            self._cv.notify_all()
+
+    def close(self):
+        """最後まで読み終える（spill の書き出しを含む）のを待つ。途中で読めなくなっていたら OSError"""
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._error and not self._stop:
+            raise OSError(f'reading {self.path}: {self._error}')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.abort()
+        self.close()
+
+
+@contextlib.contextmanager
+def tar_writer(path):
+    """出力用の TarFile（ストリームモードで先頭から1回書くだけ。.tar.zst は zstd で圧縮しながら）
+    中央ディレクトリが無いので、書き終えた分を後から読み直したりシークしたりしない（遅いディスク向け）。
+    """
+    with open(path, 'wb', buffering=STREAM_BLOCK) as fo:
+        if archive_ext(path) not in ZSTD_EXTS:
+            with tarfile.open(fileobj=fo, mode='w|', format=tarfile.PAX_FORMAT) as tout:
+                yield tout
+            return
+        zstd = shutil.which('zstd')
+        if not zstd:
+            raise ValueError('zstd not found (needed for .tar.zst)')
+        # 画像は圧縮済みなので、速いレベルで圧縮する（ヘッダと画像以外が縮めば十分）
+        proc = subprocess.Popen([zstd, '-q', '-1', '-T0', '-c'], stdin=subprocess.PIPE, stdout=fo,
+                                bufsize=STREAM_BLOCK)
+        try:
+            with tarfile.open(fileobj=proc.stdin, mode='w|', format=tarfile.PAX_FORMAT) as tout:
+                yield tout
+        finally:
+            proc.stdin.close()
+            rc = proc.wait()
+        if rc != 0:
+            raise OSError(f'zstd exited with {rc}')
+
+
+def write_tar(tout, name, path):
+    """ファイルを tar に1エントリとして追記（書いたバイト数を返す）"""
+    info = tarfile.TarInfo(name)
+    info.size = os.path.getsize(path)
+    info.mtime = int(time.time())
+    info.mode = 0o644
+    with open(path, 'rb') as f:
+        tout.addfile(info, f)
+    return info.size
+
+
+# --- 画像ヘッダ ---
+
+HEADER_BYTES = 64 * 1024  # image_dimensions に渡す先頭部分の大きさ（AVIF の ispe はたいていこの中にある）
+
+
+def image_dimensions(head):
+    """画像の先頭部分から (幅, 高さ) を読む（WebP / AVIF / PNG。分からなければ None）
+    AVIF はグリッド画像のタイルやサムネイルも ispe を持つので、最も大きいものを採る。
+    """
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP' and len(head) >= 30:
+        chunk = head[12:16]
+        if chunk == b'VP8 ':
+            w, h = struct.unpack('<HH', head[26:30])
+            return w & 0x3fff, h & 0x3fff
+        if chunk == b'VP8L':
+            b = head[21:25]
+            return 1 + (b[0] | (b[1] & 0x3f) << 8), 1 + (b[1] >> 6 | b[2] << 2 | (b[3] & 0x0f) << 10)
+        if chunk == b'VP8X':
+            return 1 + int.from_bytes(head[24:27], 'little'), 1 + int.from_bytes(head[27:30], 'little')
+        return None
+    if head[:8] == b'\x89PNG\r\n\x1a\n' and len(head) >= 24:
+        return struct.unpack('>II', head[16:24])
+    if head[4:8] == b'ftyp':
+        best = None
+        pos = head.find(b'ispe')
+        while pos >= 0 and pos + 16 <= len(head):
+            w, h = struct.unpack('>II', head[pos + 8:pos + 16])
+            if not best or w * h > best[0] * best[1]:
+                best = (w, h)
+            pos = head.find(b'ispe', pos + 4)
+        return best
+    return None
+
+
+def safe_member_name(name):
+    """出力に使うメンバ名から絶対パス・'..' を取り除く（zipfile.extract と同じ規則）"""
+    name = os.path.splitdrive(name.replace('\\', '/'))[1]
+    return '/'.join(p for p in name.split('/') if p not in ('', '.', '..'))
+
+
+def natural_key(name):
+    """数字を数値として比べる並び順のキー（'2.avif' が '10.avif' より前になる）"""
+    return [int(t) if t.isdigit() else t.lower() for t in re.split(r'(\d+)', name)]
+
+
+def write_aligned(zout, name, data, align=PAGE_ALIGN):
+    """無圧縮でエントリを書き、データの先頭を align バイト境界に揃える（書いたバイト数を返す）
+    ローカルヘッダの拡張フィールドに詰め物を入れる（zipalign と同じ方式）。
+    中央ディレクトリには詰め物を除いた同じフィールドだけを書く（無いと unzip が非ASCII名で警告する）。
+    """
+    zinfo = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+    zinfo.compress_type = zipfile.ZIP_STORED
+    zinfo.external_attr = 0o600 << 16
+    if align > 1:
+        try:
+            name_len = len(name.encode('ascii'))
+        except UnicodeEncodeError:
+            name_len = len(name.encode('utf-8'))
+        # zipfile は大きいエントリのローカルヘッダに zip64 フィールド(20バイト)を足す
+        zip64 = 20 if len(data) * 1.05 > zipfile.ZIP64_LIMIT else 0
+        start = zout.fp.tell() + zipfile.sizeFileHeader + name_len + zip64 + 6
+        pad = -start % align
+        zinfo.extra = struct.pack('<HHH', ALIGN_EXTRA_ID, 2 + pad, align) + b'\0' * pad
+    zout.writestr(zinfo, data)
+    if align > 1:
+        zinfo.extra = struct.pack('<HHH', ALIGN_EXTRA_ID, 2, align)
+    return len(data)
+
+
+# --- 外部ツール（フォールバック） ---
+
+def _list_with_tools(path, ext):
+    try:
+        if ext in ('rar', 'cbr'):
+            result = subprocess.run(['lsar', '-j', path], capture_output=True,
+                                    text=True, timeout=TOOL_TIMEOUT)
+            if result.returncode == 0:
+                contents = json.loads(result.stdout).get('lsarContents', [])
+                return [(c.get('XADFileName', ''), c.get('XADFileSize'))
+                        for c in contents if not c.get('XADIsDirectory')]
+        elif ext == '7z':
+            result = subprocess.run(['7z', 'l', '-slt', path], capture_output=True,
+                                    text=True, timeout=TOOL_TIMEOUT)
+            if result.returncode == 0:
+                return _parse_7z_slt(result.stdout)
+    except subprocess.TimeoutExpired:
+        print(f"  WARNING: listing timed out: {path}", file=sys.stderr)
+    except (OSError, ValueError):
+        pass
+    return []
+
+
+def _parse_7z_slt(text):
+    entries = []
+    # 先頭のアーカイブ自体の情報ブロックは '----------' の前
+    body = text.split('\n----------\n', 1)[-1]
+    for block in body.split('\n\n'):
+        props = {}
+        for line in block.splitlines():
+            key, sep, value = line.partition(' = ')
+            if sep:
+                props[key] = value
+        if 'Path' not in props or 'D' in props.get('Attributes', ''):
+            continue
+        size = props.get('Size')
+        entries.append((props['Path'], int(size) if size and size.isdigit() else None))
+    return entries
+
+
+if __name__ == '__main__':
+    for p in sys.argv[1:]:
+        for name, size in list_entries(p):
+            print(f"{size if size is not None else '?':>12}  {name}")
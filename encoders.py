@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""利用できるエンコーダを調べ、最速のAV1バックエンドを選ぶ
+ffmpeg の各エンコーダは一覧に載っていても実際に使えるとは限らない（GPUなしの av1_nvenc など）ため、
+64x64の試しエンコードで判定する。結果は ~/.cache/zip_to_avif/encoders.json に保存し、
+ffmpeg が更新されるまで再利用する。
+"""
+
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+STATE_DIR = os.path.expanduser('~/.cache/zip_to_avif')
+CACHE_FILE = os.path.join(STATE_DIR, 'encoders.json')
+FFMPEG_ENCODERS = ['av1_nvenc', 'libsvtav1', 'librav1e', 'libaom-av1', 'libwebp']
+AV1_ORDER = ['av1_nvenc', 'libsvtav1', 'librav1e', 'libaom-av1', 'pillow_avif']  # 速い順
+GRAY_CAPABLE = {'librav1e', 'libaom-av1', 'pillow_avif'}  # yuv400(モノクロ)のまま出力できる
+SVT_PRESET = 8
+RAV1E_SPEED = 10
+AOM_CPU_USED = 6
+
+_backend = None
+
+
+def _ffmpeg_id():
+    """キャッシュの鍵（ffmpegのパス・サイズ・更新時刻）"""
+    path = shutil.which('ffmpeg')
+    if not path:
+        return None
+    st = os.stat(path)
+    return f'{os.path.realpath(path)}:{st.st_size}:{int(st.st_mtime)}'
+
+
+def _try_encode(name):
+    """小さな単色画像を1フレームだけエンコードして使えるか確かめる"""
+    pix_fmt = 'yuv420p' if name != 'libwebp' else 'yuva420p'
+    cmd = [
+        'ffmpeg', '-hide_banner', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', 'color=c=gray:s=64x64',
+        '-frames:v', '1', '-c:v', name, '-pix_fmt', pix_fmt, '-f', 'null', '-'
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+        return result.returncode == 0
+    except Exception:
+        return False
+
+
+def _has_pillow_avif():
+    """Pillow で AVIF が保存できるか（pillow-avif-plugin か Pillow 11.3 以降の内蔵サポート）"""
+    if importlib.util.find_spec('pillow_avif'):
+        return True
+    try:
+        from PIL import features
+        return bool(features.check('avif'))
+    except Exception:
+        return False
+
+
+def probe_encoders(refresh=False):
+    """使えるエンコーダを {名前: bool} で返す（ffmpeg分はキャッシュを使う）"""
+    ffmpeg_id = _ffmpeg_id()
+    found = {}
+    if ffmpeg_id:
+        cache = {}
+        if not refresh:
+            try:
+                with open(CACHE_FILE, encoding='utf-8') as f:
+                    cache = json.load(f)
+            except (OSError, ValueError):
+                cache = {}
+        if cache.get('ffmpeg') == ffmpeg_id:
+            found = cache.get('encoders', {})
+        else:
+            listed = set()
+            try:
+                result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'],
+                                        capture_output=True, text=True, timeout=30)
+                for line in result.stdout.splitlines():
+                    parts = line.split()
+                    if len(parts) >= 2:
+                        listed.add(parts[1])
+            except Exception:
+                pass
+            found = {name: name in listed and _try_encode(name) for name in FFMPEG_ENCODERS}
+            try:
+                os.makedirs(STATE_DIR, exist_ok=True)
+                with open(CACHE_FILE, 'w', encoding='utf-8') as f:
+                    json.dump({'ffmpeg': ffmpeg_id, 'encoders': found}, f, indent=1)
+            except OSError:
+                pass
+    found = {name: bool(found.get(name)) for name in FFMPEG_ENCODERS}
+    found['pillow_avif'] = _has_pillow_avif()
+    return found
+
+
+def select_backend(workers, forced=None):
+    """最速のAV1バックエンドを選び、1枚あたりのスレッド数を決めてログに出す
+    forced が指定されていればそれを使う（使えなければ候補の一覧とともにエラー）。
+    """
+    global _backend
+    found = probe_encoders()
+    available = [name for name in AV1_ORDER if found.get(name)]
+    if forced:
+        if forced not in AV1_ORDER:
+            raise ValueError(f"unknown encoder: {forced} (choices: {', '.join(AV1_ORDER)})")
+        if not found.get(forced):
+            raise ValueError(f"encoder not available: {forced} (available: {', '.join(available) or 'none'})")
+        name = forced
+    elif available:
+        name = available[0]
+    else:
+        raise ValueError('no AV1 encoder available (need ffmpeg with av1_nvenc/libsvtav1/librav1e/libaom-av1, or pillow-avif)')
+
+    # 画像単位で並列に動かすので、CPUコアを並列数で割ったぶんだけ各エンコーダに渡す
+    threads = max(1, (os.cpu_count() or 1) // max(1, workers))
+    _backend = {'name': name, 'threads': threads}
+    if name == 'av1_nvenc':
+        print(f"AV1 backend: {name} (GPU)", flush=True)
+    else:
+        tune = {'libsvtav1': f'preset {SVT_PRESET}', 'librav1e': f'speed {RAV1E_SPEED}',
+                'libaom-av1': f'cpu-used {AOM_CPU_USED}', 'pillow_avif': 'speed 8'}[name]
+        print(f"AV1 backend: {name} ({tune}, {threads} threads x {workers} workers)", flush=True)
+    return _backend
+
+
+def current_backend():
+    """選択済みのバックエンド（未選択なら並列数4として選ぶ）"""
+    return _backend or select_backend(4)
+
+
+def av1_args(quality, gray=False):
+    """ffmpeg に渡すエンコーダ指定とピクセル形式を返す
+    gray=True のとき、yuv400 に対応するエンコーダでは -pix_fmt gray で出力する。
+    対応しないエンコーダでは呼び出し側が format=gray を挟んでから yuv420p に戻す。
+    """
+    backend = current_backend()
+    name, threads = backend['name'], backend['threads']
+    if name == 'av1_nvenc':
+        cq = max(1, min(51, int(51 - quality * 0.51)))
+        args = ['-c:v', 'av1_nvenc', '-cq', str(cq)]
+    elif name == 'libsvtav1':
+        crf = max(1, min(63, int(63 - quality * 0.63)))
+        args = ['-c:v', 'libsvtav1', '-crf', str(crf), '-preset', str(SVT_PRESET),
+                '-svtav1-params', f'lp={threads}']
+    elif name == 'librav1e':
+        qp = max(1, min(255, int(255 - quality * 2.55)))
+        args = ['-c:v', 'librav1e', '-qp', str(qp), '-speed', str(RAV1E_SPEED),
+                '-threads', str(threads)]
+    elif name == 'libaom-av1':
+        crf = max(1, min(63, int(63 - quality * 0.63)))
+        args = ['-c:v', 'libaom-av1', '-crf', str(crf), '-b:v', '0',
+                '-cpu-used', str(AOM_CPU_USED), '-row-mt', '1', '-threads', str(threads)]
+    else:
+        raise ValueError(f'{name} is not an ffmpeg encoder')
+    pix_fmt = 'gray' if gray and name in GRAY_CAPABLE else 'yuv420p'
+    return args + ['-pix_fmt', pix_fmt]
+
+
+def is_gray_capable():
+    return current_backend()['name'] in GRAY_CAPABLE
+
+
+def uses_pillow():
+    return current_backend()['name'] == 'pillow_avif'
+
+
+def pillow_cmd(in_path, out_path, quality, max_size, gray=False):
+    """Pillow(AVIF)で1枚を変換する子プロセスのコマンド（ffmpegにAV1エンコーダがない環境向け）
+    ffmpeg と同じく quarantine.run_guarded で実行し、画素数に応じたタイムアウトと隔離を効かせる。
+    """
+    return [sys.executable, os.path.abspath(__file__), 'pillow', in_path, out_path,
+            str(quality), str(max_size), str(current_backend()['threads']), 'gray' if gray else 'color']
+
+
+def encode_with_pillow(in_path, out_path, quality, max_size, gray=False, threads=1):
+    """Pillow(AVIF)で1枚を変換（pillow_cmd の子プロセスで呼ばれる）"""
+    try:
+        import pillow_avif  # noqa: F401  プラグインの登録
+    except ImportError:
+        pass
+    from PIL import Image
+    try:
+        with Image.open(in_path) as img:
+            img = img.convert('RGBA' if 'A' in img.getbands() and not gray else 'RGB')
+            if max_size > 0 and max(img.size) > max_size:
+                img.thumbnail((max_size, max_size), Image.LANCZOS)
+            params = {'quality': quality, 'speed': 8, 'max_threads': threads}
+            if gray:
+                params['subsampling'] = '4:0:0'
+            img.save(out_path, 'AVIF', **params)
+        return True, None
+    except Exception as e:
+        return False, str(e)
+
+
+def main():
+    if len(sys.argv) == 8 and sys.argv[1] == 'pillow':
+        in_path, out_path, quality, max_size, threads, kind = sys.argv[2:]
+        ok, err = encode_with_pillow(in_path, out_path, int(quality), int(max_size), kind == 'gray', int(threads))
+        if not ok:
+            print(err, file=sys.stderr)
+            sys.exit(1)
+        return
+    print("Usage: python3 encoders.py pillow <入力> <出力> <品質> <最大辺px> <スレッド数> <gray|color>")
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
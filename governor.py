@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""共用マシンでの長時間バッチ向けに、優先度と同時変換数を負荷に合わせて調整する
+起動時に nice / ionice を下げ（ffmpeg や変換スクリプトなどの子プロセスにも引き継がれる）、
+監視スレッドがロードアベレージ・空きメモリ・自プロセスツリーのRSS合計を定期的に見て
+同時に変換する枚数（limit）を増減する。閾値を超えたら 0（一時停止）にして、下回ったら再開する。
+変換中のものは止めずに最後まで終わらせる（途中で止めるとタイムアウトで隔離されるため）。
+ロードアベレージからは、自プロセスツリーが使ったCPU時間の分を差し引いて他の負荷だけを見る（自分の負荷で止まらないように）。
+limit はファイル（環境変数 LIMIT_ENV）にも書き、アーカイブ変換の子プロセスは follow() でそれを読んで
+変換中にも同時変換数を合わせる。
+"""
+
+import atexit
+import math
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+CHECK_INTERVAL = 2.0     # 監視の間隔（秒）
+ADJUST_INTERVAL = 15.0   # 同時変換数を1つ増減する最短間隔（ロードアベレージの遅れを待つ）
+PAUSE_LOAD_FACTOR = 1.5  # ロードが max_load のこの倍を超えたら一時停止
+RESUME_MARGIN = 0.9      # 一時停止からの再開は閾値のこの割合まで下がってから（RSS・ロード）
+LOAD_PERIOD = 60.0       # 1分ロードアベレージの時定数（自プロセスツリーの負荷を同じ重みで平均する）
+IONICE_CLASSES = {'idle': ['-c', '3'], 'low': ['-c', '2', '-n', '7']}
+STATE_DIR = os.path.expanduser('~/.cache/zip_to_avif')
+LIMIT_ENV = 'ZIP_TO_AVIF_GOVERNOR'  # 子プロセスに limit のファイルを知らせる環境変数
+
+
+
+def _print(line):
+    print(line, flush=True)
+
+
+_lock = threading.Lock()
+_cv = threading.Condition()
+_state = {'active': False, 'workers': 0, 'limit': 0, 'max_rss': 0, 'max_load': 0.0, 'min_free': 0,
+          'changed': 0.0, 'reason': '', 'own_load': 0.0, 'cpu': None, 'file': None,
+          'following': False, 'running': 0, 'out': _print}
+
+
+def parse_size(text):
+    """'8G' / '512M' / '1048576' をバイト数に変換"""
+    m = re.fullmatch(r'(\d+(?:\.\d+)?)([KMGT]?)B?', text.strip().upper())
+    if not m:
+        raise ValueError(f'invalid size: {text}')
+    return int(float(m.group(1)) * 1024 ** ' KMGT'.index(m.group(2) or ' '))
+
+
+def _fmt(size):
+    return f'{size / 1024 ** 3:.1f}GB'
+
+
+def mem_available():
+    """/proc/meminfo の MemAvailable（取れなければ None）"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _tree(root=None):
+    """root（省略時は自分）とその子孫プロセスの pid の一覧（/proc が無ければ空）"""
+    root = root or os.getpid()
+    children = {}
+    try:
+        pids = [int(p) for p in os.listdir('/proc') if p.isdigit()]
+    except OSError:
+        return []
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                # comm に空白や括弧が入ることがあるので最後の ')' の後ろを読む
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(pid)
+    tree = []
+    stack = [root]
+    while stack:
+        pid = stack.pop()
+        tree.append(pid)
+        stack.extend(children.get(pid, []))
+    return tree
+
+
+def tree_rss(root=None):
+    """root（省略時は自分）とその子孫プロセスのRSS合計（/proc が無ければ 0）"""
+    page = os.sysconf('SC_PAGE_SIZE')
+    total = 0
+    for pid in _tree(root):
+        try:
+            with open(f'/proc/{pid}/statm') as f:
+                total += int(f.read().split()[1]) * page
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+
+def tree_cpu(root=None):
+    """root とその子孫プロセスが使ったCPU秒数の合計（終了して回収された子孫の分も含む）
+    生きている各プロセスの utime + stime + cutime + cstime を足す（回収済みの子は親の cutime に入っている）。
+    """
+    tick = os.sysconf('SC_CLK_TCK')
+    total = 0
+    for pid in _tree(root):
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            total += sum(int(v) for v in fields[11:15])
+        except (OSError, IndexError, ValueError):
+            pass
+    return total / tick
+
+
+def set_priority(nice=0, ionice=None):
+    """自プロセスの nice / ionice を下げる（以降に作るスレッドと子プロセスに引き継がれる）"""
+    if nice:
+        os.nice(nice)
+    if ionice:
+        if ionice not in IONICE_CLASSES:
+            raise ValueError(f"unknown ionice class: {ionice} (choices: {', '.join(IONICE_CLASSES)})")
+        if shutil.which('ionice'):
+            subprocess.run(['ionice', *IONICE_CLASSES[ionice], '-p', str(os.getpid())], capture_output=True)
+        else:
+            print("  WARNING: ionice not found, I/O priority is unchanged", flush=True)
+
+
+def configure(workers, nice=0, ionice=None, max_rss=0, max_load=0.0, min_free=0):
+    """優先度を設定し、閾値が1つでもあれば監視スレッドを始める（limit のファイルも作って子プロセスに知らせる）"""
+    set_priority(nice, ionice)
+    _state.update(workers=workers, limit=workers, max_rss=max_rss, max_load=max_load, min_free=min_free)
+    parts = [f'nice {nice}'] if nice else []
+    if ionice:
+        parts.append(f'ionice {ionice}')
+    if max_load:
+        parts.append(f'max load {max_load:.1f}')
+    if max_rss:
+        parts.append(f'max RSS {_fmt(max_rss)}')
+    if min_free:
+        parts.append(f'min free {_fmt(min_free)}')
+    if parts:
+        print(f"Governor: {', '.join(parts)}, up to {workers} workers", flush=True)
+    if (max_rss or max_load or min_free) and not _state['active']:
+        _state['active'] = True
+        _state['cpu'] = (time.time(), tree_cpu())
+        os.makedirs(STATE_DIR, exist_ok=True)
+        _state['file'] = os.path.join(STATE_DIR, f'governor-{os.getpid()}.limit')
+        _publish(workers)
+        atexit.register(_remove_file)
+        os.environ[LIMIT_ENV] = _state['file']
+        threading.Thread(target=_monitor, daemon=True).start()
+
+
+def set_output(out):
+    """監視スレッドの表示先（対話中はプロンプトに混ざらないよう、ログに書く関数を渡す）"""
+    _state['out'] = out
+
+
+def _publish(value):
+    """limit をファイルに書く（子プロセスが途中の状態を読まないよう置き換えで）"""
+    tmp = _state['file'] + '.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            f.write(str(value))
+        os.replace(tmp, _state['file'])
+    except OSError:
+        pass
+
+
+def _remove_file():
+    try:
+        os.remove(_state['file'])
+    except OSError:
+        pass
+
+
+def options_to_config(opts, workers):
+    """コマンドラインのオプションから configure を呼ぶ（--background は共用マシン向けの既定値）"""
+    background = 'background' in opts
+    configure(
+        workers,
+        nice=int(opts.get('nice') or (10 if background else 0)),
+        ionice=opts.get('ionice') or ('idle' if background else None),
+        max_rss=parse_size(opts['max-rss']) if opts.get('max-rss') else 0,
+        max_load=float(opts.get('max-load') or ((os.cpu_count() or 1) if background else 0)),
+        min_free=parse_size(opts['min-free']) if opts.get('min-free') else (1024 ** 3 if background else 0),
+    )
+
+
+def _other_load():
+    """1分ロードアベレージから自プロセスツリーの分を除いたもの
+    前回からのCPU時間の増分を使用コア数とみなし、ロードアベレージと同じ時定数で平均して差し引く。
+    """
+    now, cpu = time.time(), tree_cpu()
+    last_time, last_cpu = _state['cpu']
+    _state['cpu'] = (now, cpu)
+    if now > last_time:
+        decay = math.exp(-(now - last_time) / LOAD_PERIOD)
+        busy = max(0.0, cpu - last_cpu) / (now - last_time)
+        _state['own_load'] = _state['own_load'] * decay + busy * (1 - decay)
+    return max(0.0, os.getloadavg()[0] - _state['own_load'])
+
+
+def _decide(cur):
+    """現在の測定値から新しい limit と理由を決める"""
+    workers, max_rss, max_load, min_free = (_state[k] for k in ('workers', 'max_rss', 'max_load', 'min_free'))
+    load = _other_load() if max_load else os.getloadavg()[0]
+    avail = mem_available()
+    rss = tree_rss() if max_rss else 0
+    if min_free and avail is not None and avail < min_free:
+        return 0, f'free memory {_fmt(avail)} < {_fmt(min_free)}'
+    if max_load and load > max_load * PAUSE_LOAD_FACTOR:
+        return 0, f'load {load:.1f} > {max_load * PAUSE_LOAD_FACTOR:.1f}'
+    if cur == 0:
+        # 一時停止中は、閾値より少し下がるまで再開しない
+        if (max_rss and rss > max_rss * RESUME_MARGIN) or (max_load and load > max_load * RESUME_MARGIN) \
+                or (min_free and avail is not None and avail < min_free / RESUME_MARGIN):
+            return 0, _state['reason']
+        return 1, f'load {load:.1f}'
+    if max_rss and rss > max_rss:
+        # 大きい画像を並べすぎている → 変換中の分が終わるのを待って1つ減らす
+        return max(1, cur - 1), f'RSS {_fmt(rss)} > {_fmt(max_rss)}'
+    if max_load and load > max_load:
+        return max(1, cur - 1), f'load {load:.1f} > {max_load:.1f}'
+    if cur < workers and (not max_load or load < max_load * RESUME_MARGIN) and \
+            (not max_rss or rss < max_rss * RESUME_MARGIN):
+        return cur + 1, f'load {load:.1f}'
+    return cur, _state['reason']
+
+
+def _monitor():
+    while True:
+        time.sleep(CHECK_INTERVAL)
+        try:
+            with _lock:
+                cur = _state['limit']
+                new, reason = _decide(cur)
+                # 一時停止は即座に、増減はロードアベレージが追いつくまで間隔を空ける
+                if new != cur and new != 0 and cur != 0 and time.time() - _state['changed'] < ADJUST_INTERVAL:
+                    continue
+                _state['reason'] = reason
+                if new == cur:
+                    continue
+                _state['limit'] = new
+                _state['changed'] = time.time()
+                _publish(new)
+        except OSError:
+            continue
+        out = _state['out']
+        if new == 0:
+            out(f"  Governor: paused ({reason})")
+        elif cur == 0:
+            out(f"  Governor: resumed with 1 worker ({reason})")
+        else:
+            out(f"  Governor: workers {cur} -> {new} ({reason})")
+
+
+def active():
+    return _state['active']
+
+
+def limit(default=None):
+    """今同時に変換してよい数（監視していなければ default）"""
+    return _state['limit'] if _state['active'] else default
+
+
+def status():
+    """一覧の下に出す状態（監視していなければ空）"""
+    if not _state['active'] or _state['following']:
+        return ''
+    limit = _state['limit']
+    state = 'paused' if limit == 0 else f"{limit}/{_state['workers']} workers"
+    return f"Governor: {state}" + (f" ({_state['reason']})" if _state['reason'] else '')
+
+
+def follow():
+    """親のガバナーが書く limit のファイルに従う（アーカイブ変換の子プロセスで呼ぶ）
+    以降 slot() が、親が減らしたら新しいページの開始を待ち、一時停止なら再開まで止める。
+    """
+    path = os.environ.get(LIMIT_ENV)
+    if not path or _state['active']:
+        return
+    value = _read_limit(path)
+    if value is None:
+        return
+    _state.update(active=True, following=True, limit=value)
+    threading.Thread(target=_follow, args=(path,), daemon=True).start()
+
+
+def _read_limit(path):
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def _follow(path):
+    while True:
+        time.sleep(CHECK_INTERVAL)
+        value = _read_limit(path)
+        if value is None and not os.path.exists(path):
+            # 親が終わった → 以降は制限しない
+            value = 1 << 30
+        if value is not None and value != _state['limit']:
+            with _cv:
+                _state['limit'] = value
+                _cv.notify_all()
+
+
+@contextmanager
+def slot():
+    """変換1枚分の枠を取る（親のガバナーに従っていなければ何もしない）
+    Ctrl-C 等でメインスレッドが終わっていれば、待たずに例外で抜ける（一時停止中に終了できなくならないように）。
+    """
+    if not _state['following']:
+        yield
+        return
+    with _cv:
+        while _state['running'] >= _state['limit']:
+            if not threading.main_thread().is_alive():
+                raise RuntimeError('interrupted')
+            _cv.wait(CHECK_INTERVAL)
+        _state['running'] += 1
+    try:
+        yield
+    finally:
+        with _cv:
+            _state['running'] -= 1
+            _cv.notify_all()
+
+
+def wait_ready():
+    """一時停止中なら再開まで待つ（アーカイブ1件を始める前に呼ぶ）"""
+    while _state['active'] and _state['limit'] == 0:
+        time.sleep(CHECK_INTERVAL)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""変換実績のデータベース（~/.cache/zip_to_avif/history.db, SQLite）
+実行ごとに形式・バックエンド・品質・並列数を、アーカイブと画像ごとに入出力サイズ・画素数・処理時間を記録する。
+シリーズ（巻数などを除いたアーカイブ名）ごと・拡張子ごとの圧縮率と処理時間を、ディレクトリ一括変換の
+一覧・スキップ判定・見込み時間と、並列数の自動選択に使う。
+
+  python3 history_db.py          最近の実行の一覧
+  python3 history_db.py series   シリーズごとの実績
+  python3 history_db.py trend    週ごと・バックエンドごとの処理速度の推移
+"""
+
+import os
+import re
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+STATE_DIR = os.path.expanduser('~/.cache/zip_to_avif')
+DB_FILE = os.path.join(STATE_DIR, 'history.db')
+SERIES_MIN_PAGES = 20     # これ未満のページ数しか実績がないシリーズは予測に使わない
+NOT_WORTH_RATIO = 0.9     # シリーズの実績の圧縮率がこれ以上なら変換しても縮まないとみなす
+WORKERS_MIN_PAGES = 200   # 並列数の比較に使う最低ページ数
+EXT_WINDOW_SEC = 90 * 86400  # 拡張子ごとの見込みはこの期間の実績から出す（エンコーダや設定の変更に追従する）
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY, started REAL, tool TEXT, fmt TEXT, backend TEXT,
+    quality INTEGER, workers INTEGER, max_size INTEGER, host TEXT, pages INTEGER DEFAULT 0, sec REAL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS archives (
+    id INTEGER PRIMARY KEY, run_id INTEGER, path TEXT, series TEXT,
+    in_bytes INTEGER, out_bytes INTEGER, pages INTEGER, sec REAL, result TEXT
+);
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY, run_id INTEGER, series TEXT, ext TEXT,
+    in_bytes INTEGER, out_bytes INTEGER, pixels INTEGER, sec REAL, ok INTEGER
+);
+CREATE INDEX IF NOT EXISTS images_series ON images(series);
+CREATE INDEX IF NOT EXISTS archives_series ON archives(series);
+'''
+
+_lock = threading.Lock()
+_run = None        # 記録中の実行（start_run で設定、最初の flush で runs に書く）
+_images = []
+_archives = []
+_pixels = {}       # 変換元のパス -> 画素数（変換関数が記録し、add_image が取り出す）
+
+
+def connect():
+    os.makedirs(STATE_DIR, exist_ok=True)
+    con = sqlite3.connect(DB_FILE, timeout=30)
+    con.executescript(SCHEMA)
+    return con
+
+
+def series_of(path):
+    """アーカイブ・フォルダ名から巻数やタグを除いたシリーズ名（'Title v03 [scan].zip' -> 'title'）"""
+    name = os.path.basename(path.rstrip('/'))
+    stem = name.rsplit('.', 1)[0] if '.' in name and not os.path.isdir(path) else name
+    prev = None
+    while prev != stem:
+        prev = stem
+        stem = re.sub(r'\s*[\(\[（【][^\)\]）】]*[\)\]）】]\s*$', '', stem)
+        stem = re.sub(r'(?i)[\s_\-.]*(?:vol(?:ume)?\.?|v|#|第)?\s*\d+(?:巻|話)?\s*$', '', stem)
+    stem = stem.strip(' _-.').lower()
+    return stem or os.path.basename(os.path.dirname(os.path.abspath(path))).lower()
+
+
+def start_run(tool, fmt, quality, workers, max_size, backend):
+    """この実行の設定を覚える（行は最初の flush で書く）"""
+    global _run
+    _run = {'id': None, 'started': time.time(), 'tool': tool, 'fmt': fmt, 'backend': backend,
+            'quality': int(quality), 'workers': int(workers), 'max_size': int(max_size),
+            'host': socket.gethostname(), 'pages': 0, 'sec': 0.0}
+
+
+def note_pixels(src, pixels):
+    """変換した画像の画素数を覚える（変換関数から呼ぶ）"""
+    with _lock:
+        _pixels[src] = pixels
+
+
+def take_pixels(src):
+    """note_pixels で覚えた画素数を取り出す（分散ワーカーが結果と一緒にサーバへ送る）"""
+    with _lock:
+        return _pixels.pop(src, None)
+
+
+def add_image(src, series, ext, in_bytes, out_bytes, sec, ok):
+    """画像1枚の結果を記録（元を残した場合は out_bytes に元のサイズを渡す）"""
+    with _lock:
+        _images.append((series, ext, in_bytes, out_bytes, _pixels.pop(src, None), sec, int(bool(ok))))
+
+
+def add_archive(path, in_bytes, out_bytes, pages, sec, result):
+    """アーカイブ1件の結果を記録（result: done / not_worth / failed）"""
+    with _lock:
+        _archives.append((os.path.abspath(path), series_of(path), in_bytes, out_bytes, pages, sec, result))
+
+
+def add_busy(pages, sec):
+    """実行全体の処理ページ数と実時間を加算（並列数ごとの処理速度の比較に使う）"""
+    if _run:
+        _run['pages'] += pages
+        _run['sec'] += sec
+
+
+def flush():
+    """溜めた記録を1トランザクションで書く（失敗しても変換は続ける）"""
+    if not _run:
+        return
+    with _lock:
+        images, archives = _images[:], _archives[:]
+        del _images[:], _archives[:]
+    if _run['id'] is None and not (images or archives):
+        return
+    try:
+        con = connect()
+        with con:
+            if _run['id'] is None:
+                cur = con.execute(
+                    'INSERT INTO runs (started, tool, fmt, backend, quality, workers, max_size, host)'
+                    ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (_run['started'], _run['tool'], _run['fmt'], _run['backend'], _run['quality'],
+                     _run['workers'], _run['max_size'], _run['host']))
+                _run['id'] = cur.lastrowid
+            con.execute('UPDATE runs SET pages = ?, sec = ? WHERE id = ?', (_run['pages'], _run['sec'], _run['id']))
+            con.executemany('INSERT INTO images (run_id, series, ext, in_bytes, out_bytes, pixels, sec, ok)'
+                            ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [(_run['id'],) + r for r in images])
+            con.executemany('INSERT INTO archives (run_id, path, series, in_bytes, out_bytes, pages, sec, result)'
+                            ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [(_run['id'],) + r for r in archives])
+        con.close()
+    except sqlite3.Error as e:
+        print(f"  WARNING: could not write history: {e}", flush=True)
+
+
+def series_table(fmt):
+    """シリーズ名 -> {pages, ratio, sec_per_page, archives, not_worth}（実績が少ないシリーズは含めない）"""
+    if not os.path.exists(DB_FILE):
+        return {}
+    try:
+        con = connect()
+        rows = con.execute(
+            'SELECT i.series, COUNT(*), SUM(i.in_bytes), SUM(i.out_bytes), SUM(i.sec) FROM images i'
+            ' JOIN runs r ON r.id = i.run_id WHERE r.fmt = ? GROUP BY i.series HAVING COUNT(*) >= ?',
+            (fmt, SERIES_MIN_PAGES)).fetchall()
+        arch = dict((s, (n, nw)) for s, n, nw in con.execute(
+            "SELECT a.series, COUNT(*), SUM(a.result = 'not_worth') FROM archives a"
+            ' JOIN runs r ON r.id = a.run_id WHERE r.fmt = ? GROUP BY a.series', (fmt,)))
+        con.close()
+    except sqlite3.Error:
+        return {}
+    table = {}
+    for series, pages, in_bytes, out_bytes, sec in rows:
+        if not in_bytes:
+            continue
+        n, nw = arch.get(series, (0, 0))
+        table[series] = {'pages': pages, 'ratio': out_bytes / in_bytes, 'sec_per_page': (sec or 0) / pages,
+                         'archives': n, 'not_worth': nw or 0}
+    return table
+
+
+def ext_table(fmt):
+    """拡張子 -> {ratio: 出力/入力, rate: 1ワーカーあたりの処理速度（入力バイト/秒）}（直近 EXT_WINDOW_SEC の実績）
+    一覧の段階では画素数が分からないので、速度は画素ではなく入力バイトで表す。
+    """
+    if not os.path.exists(DB_FILE):
+        return {}
+    try:
+        con = connect()
+        rows = con.execute(
+            'SELECT i.ext, SUM(i.in_bytes), SUM(i.out_bytes), SUM(i.sec) FROM images i'
+            ' JOIN runs r ON r.id = i.run_id WHERE r.fmt = ? AND r.started >= ? GROUP BY i.ext',
+            (fmt, time.time() - EXT_WINDOW_SEC)).fetchall()
+        con.close()
+    except sqlite3.Error:
+        return {}
+    return {ext: {'ratio': out_bytes / in_bytes, 'rate': in_bytes / sec}
+            for ext, in_bytes, out_bytes, sec in rows if in_bytes and sec}
+
+
+def best_workers(fmt, backend=None):
+    """実績上ページ/秒が最も高かった並列数（比べられる実績が2通り以上なければ None）
+    backend を省略したら直近の実行のバックエンドで比べる。
+    """
+    if not os.path.exists(DB_FILE):
+        return None
+    try:
+        con = connect()
+        if backend is None:
+            row = con.execute('SELECT backend FROM runs WHERE fmt = ? AND sec > 0 ORDER BY id DESC LIMIT 1',
+                              (fmt,)).fetchone()
+            backend = row[0] if row else None
+        rows = con.execute(
+            'SELECT workers, SUM(pages) / SUM(sec) FROM runs WHERE fmt = ? AND backend IS ? AND sec > 0'
+            ' GROUP BY workers HAVING SUM(pages) >= ?', (fmt, backend, WORKERS_MIN_PAGES)).fetchall()
+        con.close()
+    except sqlite3.Error:
+        return None
+    if len(rows) < 2:
+        return None
+    return max(rows, key=lambda r: r[1])[0]
+
+
+def main():
+    if not os.path.exists(DB_FILE):
+        print("No history yet.")
+        return
+    con = connect()
+    cmd = sys.argv[1] if len(sys.argv) > 1 else 'runs'
+    if cmd == 'series':
+        arch = dict(((s, f), n) for s, f, n in con.execute(
+            'SELECT a.series, r.fmt, COUNT(*) FROM archives a JOIN runs r ON r.id = a.run_id GROUP BY a.series, r.fmt'))
+        print(f"{'series':<40} {'fmt':<5} {'arch':>5} {'pages':>6} {'ratio':>6} {'s/page':>7}")
+        for series, fmt, pages, ratio, spp in con.execute(
+                'SELECT i.series, r.fmt, COUNT(*), SUM(i.out_bytes) * 1.0 / SUM(i.in_bytes), AVG(i.sec)'
+                ' FROM images i JOIN runs r ON r.id = i.run_id GROUP BY i.series, r.fmt ORDER BY COUNT(*) DESC'):
+            print(f"{series[:40]:<40} {fmt:<5} {arch.get((series, fmt), 0):>5} {pages:>6} "
+                  f"{(ratio or 0) * 100:>5.0f}% {spp or 0:>7.2f}")
+    elif cmd == 'trend':
+        # ページ/秒は実行の実時間から、MP/s は画像ごとの処理時間（1ワーカーあたり）から
+        # （画素数の分からない画像の時間は MP/s に入れない。入れると実際より遅く見える）
+        rates = {(w, f, b): p / s for w, f, b, p, s in con.execute(
+            "SELECT strftime('%Y-W%W', started, 'unixepoch', 'localtime') AS week, fmt, backend,"
+            ' SUM(pages), SUM(sec) FROM runs WHERE sec > 0 GROUP BY week, fmt, backend')}
+        print(f"{'week':<9} {'fmt':<5} {'backend':<12} {'pages':>7} {'ratio':>6} {'pages/s':>8} {'MP/s/worker':>12}")
+        for row in con.execute(
+                "SELECT strftime('%Y-W%W', r.started, 'unixepoch', 'localtime') AS week, r.fmt, r.backend,"
+                ' COUNT(*), SUM(i.out_bytes) * 1.0 / SUM(i.in_bytes), SUM(i.pixels) / 1e6'
+                ' / SUM(CASE WHEN i.pixels IS NOT NULL THEN i.sec END)'
+                ' FROM images i JOIN runs r ON r.id = i.run_id GROUP BY week, r.fmt, r.backend ORDER BY week'):
+            rate = rates.get(row[:3])
+            print(f"{row[0]:<9} {row[1]:<5} {(row[2] or '-'):<12} {row[3]:>7} {(row[4] or 0) * 100:>5.0f}% "
+                  f"{(f'{rate:.2f}' if rate else '-'):>8} {(f'{row[5]:.2f}' if row[5] else '-'):>12}")
+    else:
+        print(f"{'started':<16} {'tool':<18} {'backend':<12} {'q':>3} {'w':>2} {'pages':>6} {'ratio':>6} {'pages/s':>8}")
+        for row in con.execute(
+                'SELECT r.started, r.tool, r.backend, r.quality, r.workers, r.pages, r.sec,'
+                ' (SELECT SUM(out_bytes) * 1.0 / SUM(in_bytes) FROM images WHERE run_id = r.id)'
+                ' FROM runs r ORDER BY r.id DESC LIMIT 20'):
+            started = time.strftime('%Y-%m-%d %H:%M', time.localtime(row[0]))
+            ratio = f'{row[7] * 100:.0f}%' if row[7] else '-'
+            rate = f'{row[5] / row[6]:.2f}' if row[6] else '-'
+            print(f"{started:<16} {row[1]:<18} {(row[2] or '-'):<12} {row[3]:>3} {row[4]:>2} {row[5]:>6} {ratio:>6} {rate:>8}")
+    con.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""ページ画像の判定と変換の共通部分（変換スクリプトとディレクトリ一括変換で同じものを使う）
+縮小した画素から色の種類（gray / near_gray / palette / color）を判定する（NumPy が無ければ常に color）。
+アニメーションGIFは上限を確かめてから ffmpeg でアニメーションAVIF/WebPに変換する。
+"""
+
+import subprocess
+import time
+
+import encoders
+import history_db
+import quarantine
+import tuner
+import verify
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+GRAY_TOL = 2          # 完全グレーとみなすRGBの最大差
+NEAR_GRAY_TOL = 12    # ほぼグレー（スキャンの色かぶり程度）とみなす99パーセンタイルの差
+PALETTE_MAX = 64      # PNGをパレット画像とみなす色数
+CLASSIFY_SIZE = 256   # 判定用に縮小する幅
+MAX_ANIM_FRAMES = 1000
+MAX_ANIM_BYTES = 1024 * 1024 * 1024  # 展開後のRGBAフレーム合計の上限
+
+
+def classify_pixels(rgb, allow_palette=False):
+    """縮小したRGB画素(H, W, 3)を gray / near_gray / palette / color に分類"""
+    px = rgb.reshape(-1, 3).astype(np.int32)
+    if allow_palette:
+        packed = (px[:, 0] << 16) | (px[:, 1] << 8) | px[:, 2]
+        if np.unique(packed).size <= PALETTE_MAX:
+            return 'palette'
+    spread = px.max(axis=1) - px.min(axis=1)
+    if spread.max() <= GRAY_TOL:
+        return 'gray'
+    if np.percentile(spread, 99) <= NEAR_GRAY_TOL:
+        return 'near_gray'
+    return 'color'
+
+
+def classify_image(path, w, h):
+    """ffmpegで縮小デコードした画素から色の種類を判定"""
+    if np is None or not (w and h):
+        return 'color'
+    tw = min(CLASSIFY_SIZE, w)
+    th = max(1, round(h * tw / w))
+    # JPEGは -lowres で縮小デコード、パレット判定のため補間しない
+    cmd = [
+        'ffmpeg', '-v', 'error', '-lowres', '2', '-i', path, '-frames:v', '1',
+        '-vf', f'scale={tw}:{th}:flags=neighbor', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-'
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, timeout=30)
+    except Exception:
+        return 'color'
+    if result.returncode != 0 or len(result.stdout) != tw * th * 3:
+        return 'color'
+    rgb = np.frombuffer(result.stdout, dtype=np.uint8).reshape(th, tw, 3)
+    return classify_pixels(rgb, allow_palette=path.lower().endswith('.png'))
+
+
+def classify_decoded(img, allow_palette=False):
+    """Pillowでデコード済みの画像から色の種類を判定（--pipe 用、補間せずに縮小する）"""
+    if np is None:
+        return 'color'
+    cw = min(CLASSIFY_SIZE, img.width)
+    small = img.convert('RGB').resize((cw, max(1, round(img.height * cw / img.width))), Image.NEAREST)
+    return classify_pixels(np.asarray(small), allow_palette)
+
+
+def too_large_animation(w, h, frames):
+    """フレーム数か展開後のメモリ量が上限を超えるか"""
+    return frames > MAX_ANIM_FRAMES or w * h * 4 * frames > MAX_ANIM_BYTES
+
+
+def probe_animation(path):
+    """ffprobeでサイズとフレーム数を取得"""
+    cmd = [
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0', '-count_packets',
+        '-show_entries', 'stream=width,height,nb_read_packets', '-of', 'csv=p=0', path
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True,
+                                timeout=quarantine.probe_timeout(path))
+        if result.returncode == 0 and result.stdout.strip():
+            parts = result.stdout.strip().split(',')
+            return int(parts[0]), int(parts[1]), int(parts[2])
+    except subprocess.TimeoutExpired:
+        quarantine.add(path, 'ffprobe timeout')
+    except Exception:
+        pass
+    return None, None, None
+
+
+def convert_animation(in_path, out_path, quality, max_size, fmt):
+    """ffmpegでアニメーションGIFをアニメーションAVIF/WebPに変換（全フレーム）。失敗したらエラー文字列を返す
+    フレーム数と展開後のメモリ量が上限を超えるものは変換しない。
+    """
+    reason = quarantine.is_quarantined(in_path)
+    if reason:
+        return f'quarantined: {reason}'
+    w, h, frames = probe_animation(in_path)
+    if not frames:
+        return 'ffprobe failed'
+    if too_large_animation(w, h, frames):
+        return f'too large animation ({frames} frames, {w}x{h})'
+    if fmt == 'avif':
+        if encoders.uses_pillow():
+            return 'animation is not supported by pillow_avif backend'
+        codec = encoders.current_backend()['name']
+        codec_args = encoders.av1_args(quality)
+    else:
+        codec = 'libwebp'
+        codec_args = ['-c:v', 'libwebp', '-quality', str(quality), '-pix_fmt', 'yuva420p']
+
+    cmd = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-i', in_path]
+    if max_size > 0 and max(w, h) > max_size:
+        cmd += ['-vf', f'scale={max_size}:-2' if w >= h else f'scale=-2:{max_size}']
+    # 1フレームずつ元のタイミングのまま出力（GIFの可変ディレイを保持）
+    cmd += ['-vsync', '0', *codec_args, '-loop', '0', '-f', fmt, out_path]
+
+    pixels = w * h * frames
+    t = time.time()
+    err = quarantine.run_guarded(cmd, in_path, quarantine.encode_timeout(codec, pixels))
+    if err:
+        return err
+    quarantine.record_speed(codec, pixels, time.time() - t)
+    history_db.note_pixels(in_path, pixels)
+    tuner.add_pixels(pixels)
+    return verify.check(in_path, out_path, w, h)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""変換が異常に遅い・落ちる入力の隔離リストと、画素数に応じたタイムアウト
+タイムアウトやクラッシュ（シグナルで終了）した入力は ~/.cache/zip_to_avif/quarantine.json に記録し、
+以降の実行では変換せずに元のまま残す。アーカイブから展開した一時ファイルでも同じ画像と分かるよう、
+ファイル名ではなくサイズと先頭64KBのハッシュで識別する。
+
+  python3 quarantine.py          隔離中の入力を一覧
+  python3 quarantine.py clear    隔離リストを空にする
+"""
+
+import hashlib
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+STATE_DIR = os.path.expanduser('~/.cache/zip_to_avif')
+QUARANTINE_FILE = os.path.join(STATE_DIR, 'quarantine.json')
+HEAD_BYTES = 64 * 1024
+DEFAULT_MPPS = 0.5        # 実測前に仮定する処理速度（メガピクセル/秒、遅いCPUエンコーダ相当）
+TIMEOUT_MARGIN = 5.0      # 実測速度から見込んだ時間の何倍まで待つか
+TIMEOUT_MIN = 20
+TIMEOUT_MAX = 900
+PROBE_TIMEOUT_MIN = 10
+PROBE_RATE = 20 * 1024 * 1024  # ffprobe がファイル全体を読む場合に仮定する最低速度（バイト/秒）
+
+_lock = threading.Lock()
+_speed = {}  # バックエンド名 -> 実測速度（メガピクセル/秒の指数移動平均）
+
+
+def file_key(path):
+    """サイズと先頭64KBのハッシュ（展開先のパスが変わっても同じ画像を識別できる）"""
+    with open(path, 'rb') as f:
+        head = f.read(HEAD_BYTES)
+    return f'{os.path.getsize(path)}:{hashlib.sha1(head).hexdigest()}'
+
+
+def data_key(data):
+    """メモリ上の画像データの識別子（file_key と同じ値になる）"""
+    return f'{len(data)}:{hashlib.sha1(data[:HEAD_BYTES]).hexdigest()}'
+
+
+def _load():
+    try:
+        with open(QUARANTINE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def is_quarantined(path, key=None):
+    """隔離済みなら理由を返す（未登録なら None）。key を渡せばファイルを読まない"""
+    try:
+        key = key or file_key(path)
+    except OSError:
+        return None
+    rec = _load().get(key)
+    return rec['reason'] if rec else None
+
+
+def add(path, reason, key=None):
+    """入力を隔離リストに加える（他プロセスの追記を消さないよう読み直してから書く）"""
+    try:
+        key = key or file_key(path)
+    except OSError:
+        return
+    with _lock:
+        table = _load()
+        table[key] = {'name': os.path.basename(path), 'reason': reason,
+                      'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+        os.makedirs(STATE_DIR, exist_ok=True)
+        tmp = f'{QUARANTINE_FILE}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(table, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, QUARANTINE_FILE)
+
+
+def record_speed(backend, pixels, seconds):
+    """変換に成功した1枚の画素数と所要時間から、バックエンドの処理速度を更新"""
+    if pixels <= 0 or seconds <= 0:
+        return
+    mpps = pixels / 1e6 / seconds
+    with _lock:
+        prev = _speed.get(backend)
+        _speed[backend] = mpps if prev is None else prev * 0.8 + mpps * 0.2
+
+
+def encode_timeout(backend, pixels):
+    """画素数と実測速度から ffmpeg のタイムアウト秒数を決める"""
+    mpps = _speed.get(backend, DEFAULT_MPPS)
+    expected = pixels / 1e6 / mpps
+    return max(TIMEOUT_MIN, min(TIMEOUT_MAX, expected * TIMEOUT_MARGIN))
+
+
+def probe_timeout(path):
+    """ffprobe のタイムアウト秒数（ファイル全体を読む場合に備えてサイズで伸ばす）"""
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        size = 0
+    return max(PROBE_TIMEOUT_MIN, size / PROBE_RATE * TIMEOUT_MARGIN)
+
+
+def run_guarded(cmd, path, timeout, input=None, key=None):
+    """cmd を実行し、失敗したらエラー文字列を返す（成功なら None）
+    タイムアウトとシグナルによる異常終了は path（key があればその識別子）を隔離リストに加える
+    （SIGINT / SIGTERM で止められた場合は除く）。
+    input は標準入力に渡すバイト列。
+    """
+    try:
+        result = subprocess.run(cmd, input=input, capture_output=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        add(path, f'timeout after {timeout:.0f}s', key)
+        return f'timeout after {timeout:.0f}s (quarantined)'
+    if -result.returncode in (signal.SIGINT, signal.SIGTERM):
+        # 変換スクリプトごと止められた（Ctrl-C・締切・取り消し）。入力のせいではないので隔離しない
+        return 'interrupted'
+    if result.returncode < 0:
+        add(path, f'crashed (signal {-result.returncode})', key)
+        return f'crashed (signal {-result.returncode}, quarantined)'
+    if result.returncode != 0:
+        return result.stderr.decode(errors='replace') or f'exit code {result.returncode}'
+    return None
+
+
+def main():
+    table = _load()
+    if len(sys.argv) > 1 and sys.argv[1] == 'clear':
+        if os.path.exists(QUARANTINE_FILE):
+            os.remove(QUARANTINE_FILE)
+        print(f"Cleared {len(table)} entries.")
+        return
+    if not table:
+        print("Quarantine is empty.")
+        return
+    for rec in sorted(table.values(), key=lambda r: r['time']):
+        print(f"{rec['time']}  {rec['name']:<40}  {rec['reason']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""変換の同時実行数を、完了した画素数/秒を見ながら実行中に増減する（--adaptive）
+変換ワーカーのスレッドは上限の数だけ用意し、各タスクは slot() で枠を取ってから変換する。
+一定時間・一定枚数ごとに処理速度を測り、前の区間より速くなれば同じ向きにもう1つ動かし、
+遅くなれば1つ戻して向きを変える（山登り）。速度が大きく落ちたら（メモリ不足でスワップした等）半分にする。
+枠待ちのタスクが無い（入力待ちで枠が余っている）間は増やさない。
+/mnt 越しの読み込みが律速の区間と、大きなPNGのエンコードが律速の区間で最適な並列数が違うため。
+"""
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+WINDOW_SEC = 10.0       # 1区間の最短時間
+WINDOW_MIN_TASKS = 4    # 1区間に最低これだけ（かつ同時実行数以上）完了してから比べる
+IMPROVE_MARGIN = 0.05   # 前の区間よりこの割合以上速ければ改善とみなす
+COLLAPSE_RATIO = 0.6    # 前の区間のこの割合を下回ったら半分にする
+HOLD_WINDOWS = 3        # 戻したあと、この区間数は動かさない
+
+_cv = threading.Condition()
+_state = {'active': False, 'lo': 1, 'hi': 1, 'initial': 1, 'limit': 1, 'running': 0, 'waiting': 0,
+          'direction': 1, 'hold': 0, 'last_rate': None,
+          'window_start': 0.0, 'window_pixels': 0, 'window_tasks': 0,
+          'start': 0.0, 'timeline': [], 'rates': {}}
+
+
+def parse_bounds(text, workers):
+    """'2-12' を (下限, 上限) に（空なら 1 から workers の2倍まで）"""
+    if not text:
+        return 1, max(2, workers * 2)
+    lo, sep, hi = text.partition('-')
+    lo, hi = int(lo), int(hi) if sep else int(lo)
+    if not 1 <= lo <= hi:
+        raise ValueError(f'invalid worker range: {text}')
+    return lo, hi
+
+
+def configure(workers, lo, hi):
+    """workers から始め、lo〜hi の範囲で調整する（戻り値はスレッドプールに用意する数 = hi）"""
+    now = time.time()
+    start = min(max(workers, lo), hi)
+    _state.update(active=True, lo=lo, hi=hi, initial=start)
+    reset()
+    print(f"Adaptive workers: start {start}, range {lo}-{hi}", flush=True)
+    return hi
+
+
+def reset():
+    """調整を最初の並列数からやり直す（ディレクトリ一括変換で項目ごとに呼び、前の項目の速度・向き・推移を持ち越さない）"""
+    if not _state['active']:
+        return
+    now = time.time()
+    with _cv:
+        _state.update(limit=_state['initial'], direction=1, hold=0, last_rate=None,
+                      window_start=now, window_pixels=0, window_tasks=0, start=now,
+                      timeline=[(0.0, _state['initial'])], rates={})
+        _cv.notify_all()
+
+
+def options_to_config(opts, workers):
+    """--adaptive[=LO-HI] があれば configure して、スレッドプールの大きさを返す（無ければ workers）"""
+    if 'adaptive' not in opts:
+        return workers
+    lo, hi = parse_bounds(opts['adaptive'], workers)
+    return configure(workers, lo, hi)
+
+
+def active():
+    return _state['active']
+
+
+def limit(default=None):
+    return _state['limit'] if _state['active'] else default
+
+
+def pool_size(default):
+    """スレッドプールに用意する数（調整していなければ default）"""
+    return _state['hi'] if _state['active'] else default
+
+
+@contextmanager
+def slot():
+    """変換1枚分の枠を取る（調整していなければ何もしない）"""
+    if not _state['active']:
+        yield
+        return
+    with _cv:
+        _state['waiting'] += 1
+        while _state['running'] >= _state['limit']:
+            _cv.wait()
+        _state['waiting'] -= 1
+        _state['running'] += 1
+    try:
+        yield
+    finally:
+        with _cv:
+            _state['running'] -= 1
+            _state['window_tasks'] += 1
+            _maybe_adjust()
+            _cv.notify_all()
+
+
+def add_pixels(pixels):
+    """変換を終えた画素数を加える（変換関数から呼ぶ）"""
+    if _state['active']:
+        with _cv:
+            _state['window_pixels'] += pixels
+
+
+def _maybe_adjust():
+    """区間が終わっていれば処理速度を比べて limit を動かす（_cv を持った状態で呼ぶ）"""
+    s = _state
+    now = time.time()
+    elapsed = now - s['window_start']
+    if elapsed < WINDOW_SEC or s['window_tasks'] < max(WINDOW_MIN_TASKS, s['limit']):
+        return
+    rate = s['window_pixels'] / elapsed
+    cur, prev = s['limit'], s['last_rate']
+    # 同じ並列数での速度は指数移動平均で覚えておく（報告用）
+    old = s['rates'].get(cur)
+    s['rates'][cur] = rate if old is None else old * 0.5 + rate * 0.5
+    s.update(window_start=now, window_pixels=0, window_tasks=0, last_rate=rate)
+
+    new = cur
+    if prev is not None and rate < prev * COLLAPSE_RATIO and cur > s['lo']:
+        # 大きく落ちた → 乗算的に減らす
+        new = max(s['lo'], math.ceil(cur / 2))
+        s['direction'], s['hold'] = 1, HOLD_WINDOWS
+    elif s['hold'] > 0:
+        s['hold'] -= 1
+    elif prev is None or rate > prev * (1 + IMPROVE_MARGIN):
+        # 最初の区間、または前の一歩で速くなった → 同じ向きにもう1つ
+        new = cur + s['direction']
+    else:
+        # 速くならなかった → 一歩戻して向きを変え、しばらく様子を見る
+        new = cur - s['direction']
+        s['direction'] = -s['direction']
+        s['hold'] = HOLD_WINDOWS
+    if new > cur and s['waiting'] == 0:
+        # 枠待ちが無い（入力待ち）ので増やしても速くならない
+        new = cur
+    new = min(max(new, s['lo']), s['hi'])
+    if new == cur:
+        return
+    if new in (s['lo'], s['hi']):
+        s['direction'] = 1 if new == s['lo'] else -1
+    s['limit'] = new
+    s['timeline'].append((now - s['start'], new))
+
+
+def report(out=print):
+    """同時実行数の推移を表示（最後に呼ぶ。out は表示に使う関数）"""
+    if not _state['active']:
+        return
+    timeline = _state['timeline']
+    end = time.time() - _state['start']
+    # 時間で重み付けした平均
+    total = sum((t2 - t1) * n for (t1, n), (t2, _) in zip(timeline, timeline[1:] + [(end, 0)]))
+    avg = total / end if end > 0 else timeline[-1][1]
+    steps = ' '.join(f"{n}@{t:.0f}s" for t, n in timeline)
+    out(f"Workers: {steps} (avg {avg:.1f})")
+    if _state['rates']:
+        best = max(_state['rates'], key=_state['rates'].get)
+        out(f"  Best: {best} workers at {_state['rates'][best] / 1e6:.2f} MP/s")
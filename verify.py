@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""変換後の画像を元画像と比べ、壊れた出力を元ファイルの削除・差し替え前に弾く
+両方を ffmpeg で同じ大きさ（幅256px）に縮小デコードし、RGBのPSNRと輝度のSSIMを NumPy で計算する。
+途中で切れたファイルはデコードできず、色が壊れたファイル（nvencがyuv420pを無視した場合など）は
+PSNRが閾値を下回る。NumPy が無い場合は検証しない。
+"""
+
+import subprocess
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+VERIFY_SIZE = 256     # 比較用に縮小する幅
+MIN_PSNR = 24.0       # これ未満のPSNR(dB)は壊れているとみなす
+MIN_SSIM = 0.75       # これ未満の輝度SSIMは壊れているとみなす
+SSIM_BLOCK = 8
+
+_lock = threading.Lock()
+_config = {'rate': 1.0, 'min_psnr': MIN_PSNR, 'min_ssim': MIN_SSIM}
+_count = 0
+
+
+def configure(rate=1.0, min_psnr=MIN_PSNR, min_ssim=MIN_SSIM):
+    """検証する割合（0で無効、1で全数）と閾値を設定"""
+    _config.update(rate=rate, min_psnr=min_psnr, min_ssim=min_ssim)
+    if rate > 0 and np is None:
+        print("  WARNING: NumPy is not installed, output verification is disabled", flush=True)
+
+
+def sampled():
+    """この画像を検証するか（rate の割合で等間隔に True を返す）"""
+    global _count
+    rate = _config['rate']
+    if rate <= 0 or np is None:
+        return False
+    with _lock:
+        _count += 1
+        return int(_count * rate) > int((_count - 1) * rate)
+
+
+def decode_small(path, tw, th, timeout):
+    """1フレーム目を tw x th のRGBに縮小デコード（失敗したら None）"""
+    cmd = [
+        'ffmpeg', '-v', 'error', '-i', path, '-frames:v', '1',
+        '-vf', f'scale={tw}:{th}:flags=area', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-'
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, timeout=timeout)
+    except Exception:
+        return None
+    if result.returncode != 0 or len(result.stdout) != tw * th * 3:
+        return None
+    return np.frombuffer(result.stdout, dtype=np.uint8).reshape(th, tw, 3).astype(np.float64)
+
+
+def psnr(a, b):
+    mse = np.mean((a - b) ** 2)
+    return 99.0 if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+
+
+def ssim(a, b):
+    """輝度の 8x8 ブロックごとのSSIMの平均"""
+    weights = np.array([0.299, 0.587, 0.114])
+    ya, yb = a @ weights, b @ weights
+    h = ya.shape[0] // SSIM_BLOCK * SSIM_BLOCK
+    w = ya.shape[1] // SSIM_BLOCK * SSIM_BLOCK
+    if not (h and w):
+        return 1.0
+    shape = (h // SSIM_BLOCK, SSIM_BLOCK, w // SSIM_BLOCK, SSIM_BLOCK)
+    ba = ya[:h, :w].reshape(shape)
+    bb = yb[:h, :w].reshape(shape)
+    ma, mb = ba.mean(axis=(1, 3)), bb.mean(axis=(1, 3))
+    va, vb = ba.var(axis=(1, 3)), bb.var(axis=(1, 3))
+    cov = (ba * bb).mean(axis=(1, 3)) - ma * mb
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    s = ((2 * ma * mb + c1) * (2 * cov + c2)) / ((ma ** 2 + mb ** 2 + c1) * (va + vb + c2))
+    return float(s.mean())
+
+
+def check_image(img, out, force=False):
+    """デコード済みの元画像（Pillow）と出力を比べる（パイプ変換用。元のファイルが無い場合）"""
+    if np is None or not (force or sampled()):
+        return None
+    w, h = img.size
+    tw = min(VERIFY_SIZE, w)
+    th = max(1, round(h * tw / w))
+    from PIL import Image
+    ref = np.asarray(img.convert('RGB').resize((tw, th), Image.BOX), dtype=np.float64)
+    return _compare(ref, out, tw, th, max(30, w * h / 1e6 * 5))
+
+
+def _compare(ref, out, tw, th, timeout):
+    got = decode_small(out, tw, th, timeout)
+    if got is None:
+        return 'verification failed: output does not decode'
+    p, s = psnr(ref, got), ssim(ref, got)
+    if p < _config['min_psnr'] or s < _config['min_ssim']:
+        return f'verification failed: PSNR {p:.1f}dB, SSIM {s:.2f}'
+    return None
+
+
+def check(src, out, w, h, force=False):
+    """出力を検証し、不合格ならエラー文字列を返す（合格・検証対象外なら None）
+    force=True なら抽出の判定をせずに検証する（呼び出し側で sampled() 済みの場合）。
+    """
+    if not (w and h) or np is None or not (force or sampled()):
+        return None
+    tw = min(VERIFY_SIZE, w)
+    th = max(1, round(h * tw / w))
+    timeout = max(30, w * h / 1e6 * 5)
+    ref = decode_small(src, tw, th, timeout)
+    if ref is None:
+        return None
+    return _compare(ref, out, tw, th, timeout)
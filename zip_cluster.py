@@ -0,0 +1,639 @@
+#!/usr/bin/env python3
+"""複数マシンで画像変換を分散実行するジョブサーバ／ワーカー。
+サーバがアーカイブを展開して画像ジョブを配り、ワーカーは既存の変換関数
+（zip_to_avif_gpu.py / zip_to_webp.py の convert_image）でエンコードして結果を返す。
+ワーカーが落ちた場合、そのワーカーに渡したジョブは再配布される。
+"""
+
+import importlib
+import json
+import os
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from collections import deque
+
+import archive_index
+import encoders
+import history_db
+
+ENCODER_MODULES = {'avif': 'zip_to_avif_gpu', 'webp': 'zip_to_webp'}
+DEFAULT_BIND = '127.0.0.1:8765'
+SELFTEST_TIMEOUT = 600
+MAX_RETRIES = 3
+HEARTBEAT_SEC = 30
+LEASE_TIMEOUT = HEARTBEAT_SEC * 4  # 変換中のワーカーから何も届かなくなってから再配布するまでの秒数
+
+
+def to_wsl_path(p):
+    import re
+    m = re.match(r'^([A-Za-z]):[/\\]', p)
+    if m:
+        drive = m.group(1).lower()
+        rest = p[3:].replace('\\', '/')
+        return f'/mnt/{drive}/{rest}'
+    return p
+
+
+def parse_options(argv):
+    """--key=value 形式のオプションと位置引数を分離"""
+    args, opts = [], {}
+    for a in argv:
+        if a.startswith('--'):
+            key, _, value = a[2:].partition('=')
+            opts[key] = value
+        else:
+            args.append(a)
+    return args, opts
+
+
+def parse_address(addr):
+    host, _, port = addr.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+# --- 通信（ヘッダJSON + バイナリ本体） ---
+
+def send_msg(sock, header, payload=b''):
+    head = json.dumps(header).encode('utf-8')
+    sock.sendall(struct.pack('>II', len(head), len(payload)) + head + payload)
+
+
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(min(n - len(buf), 1 << 20))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        buf += chunk
+    return bytes(buf)
+
+
+def recv_msg(sock):
+    head_len, body_len = struct.unpack('>II', _recv_exact(sock, 8))
+    header = json.loads(_recv_exact(sock, head_len).decode('utf-8'))
+    payload = _recv_exact(sock, body_len) if body_len else b''
+    return header, payload
+
+
+# --- サーバ ---
+
+def chosen_output(job, out_path):
+    """採用するファイル。変換スクリプトと同じく静止画は変換結果を使い、
+    アニメーションは元より大きければ元を、失敗したものも元を残す（None を返す）"""
+    if out_path is None:
+        return None
+    if job['anim'] and os.path.getsize(out_path) >= job['size']:
+        return None
+    return out_path
+
+
+class JobBoard:
+    """未処理・処理中・完了のジョブを管理する（結果は spool_dir に書き出し、パスだけ持つ）
+    abort_after 枚終わった時点の見込み圧縮率が abort_ratio(%) を超えたら、残りを配らずに終える。
+    """
+
+    def __init__(self, tasks, spool_dir, series, abort_after=0, abort_ratio=100, other_bytes=0):
+        self.spool_dir = spool_dir
+        self.series = series
+        self.lock = threading.Lock()
+        self.pending = deque(tasks)
+        self.inflight = {}
+        self.attempts = {}
+        self.results = {}
+        self.total = len(tasks)
+        self.failed = 0
+        self.abort_after = abort_after
+        self.abort_ratio = abort_ratio
+        self.other_bytes = other_bytes
+        self.image_bytes = sum(job['size'] for job in tasks)
+        self.done_in = 0
+        self.done_out = 0
+        self.projected = None
+        self.finished = threading.Event()
+        if not tasks:
+            self.finished.set()
+
+    def take(self):
+        """次のジョブを返す。None なら待機、False なら全完了"""
+        with self.lock:
+            if self.finished.is_set():
+                return False
+            if not self.pending:
+                return None
+            job = self.pending.popleft()
+            self.inflight[job['id']] = job
+            return job
+
+    def complete(self, job_id, result, sec=0.0, pixels=None):
+        """result は変換結果のバイト列（失敗なら None）。メモリに溜めないようファイルにして持つ"""
+        if self.finished.is_set():
+            return
+        path = None
+        if result is not None:
+            path = os.path.join(self.spool_dir, f'{job_id}.out')
+            with open(path, 'wb') as f:
+                f.write(result)
+        with self.lock:
+            job = self.inflight.pop(job_id, None)
+            if job is None:
+                return
+            used = chosen_output(job, path)
+            self.results[job_id] = used
+            if path is None:
+                self.failed += 1
+            out_size = os.path.getsize(used) if used else job['size']
+            self.done_in += job['size']
+            self.done_out += out_size
+            if pixels:
+                history_db.note_pixels(job['path'], pixels)
+            history_db.add_image(job['path'], self.series, job['ext'], job['size'], out_size, sec, path)
+            self._check_done()
+
+    def release(self, job_id):
+        """ワーカー切断時にジョブを戻す（上限を超えたら元画像を採用）"""
+        with self.lock:
+            job = self.inflight.pop(job_id, None)
+            if job is None:
+                return
+            self.attempts[job_id] = self.attempts.get(job_id, 0) + 1
+            if self.attempts[job_id] >= MAX_RETRIES:
+                print(f"  GIVE UP {job['name']}: worker lost {MAX_RETRIES} times", flush=True)
+                self.results[job_id] = None
+                self.failed += 1
+                self.done_in += job['size']
+                self.done_out += job['size']
+                self._check_done()
+            else:
+                self.pending.appendleft(job)
+
+    def done_count(self):
+        with self.lock:
+            return len(self.results)
+
+    def _check_done(self):
+        done = len(self.results)
+        if self.abort_after > 0 and done == self.abort_after and done < self.total and self.done_in > 0:
+            # 見込み圧縮率 = 非画像 + 変換済み + 未変換×現在の圧縮率（変換スクリプトと同じ）
+            rest = self.image_bytes - self.done_in
+            est_out = self.other_bytes + self.done_out + rest * self.done_out / self.done_in
+            ratio = est_out / (self.other_bytes + self.image_bytes) * 100
+            if ratio > self.abort_ratio:
+                self.projected = ratio
+                self.finished.set()
+        if done == self.total:
+            self.finished.set()
+
+
+class JobHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        board = self.server.board
+        sock = self.request
+        sock.settimeout(LEASE_TIMEOUT)
+        peer = f"{self.client_address[0]}:{self.client_address[1]}"
+        job = None
+        try:
+            while True:
+                header, _ = recv_msg(sock)
+                if header.get('op') != 'get':
+                    return
+                job = board.take()
+                if job is False:
+                    send_msg(sock, {'op': 'done'})
+                    return
+                if job is None:
+                    send_msg(sock, {'op': 'wait', 'sec': 1})
+                    continue
+                with open(job['path'], 'rb') as f:
+                    data = f.read()
+                send_msg(sock, {
+                    'op': 'job', 'id': job['id'], 'name': job['name'],
+                    'fmt': self.server.fmt, 'quality': self.server.quality,
+                    'max_size': self.server.max_size,
+                }, data)
+                # 変換が長引いても、ハートビートが届いている間はジョブを預けたままにする
+                header, payload = recv_msg(sock)
+                while header.get('op') == 'beat':
+                    header, payload = recv_msg(sock)
+                if header.get('op') != 'result' or header.get('id') != job['id']:
+                    raise ConnectionError('unexpected reply')
+                sec = float(header.get('sec') or 0)
+                if header.get('ok'):
+                    board.complete(job['id'], payload, sec, header.get('pixels'))
+                else:
+                    print(f"  ERROR {job['name']} ({peer}): {header.get('error', '').strip()}", flush=True)
+                    board.complete(job['id'], None, sec)
+                job = None
+                self.server.report_progress()
+        except (OSError, ConnectionError, ValueError, struct.error):
+            pass
+        finally:
+            if job:
+                print(f"  Worker {peer} lost, requeue {job['name']}", flush=True)
+                board.release(job['id'])
+
+
+class JobServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, addr, board, fmt, quality, max_size):
+        super().__init__(addr, JobHandler)
+        self.board = board
+        self.fmt = fmt
+        self.quality = quality
+        self.max_size = max_size
+        self.start = time.time()
+        self._last_report = 0
+        self._report_lock = threading.Lock()
+
+    def report_progress(self):
+        done = self.board.done_count()
+        total = self.board.total
+        with self._report_lock:
+            if done == self._last_report or not (done % 20 == 0 or done == total):
+                return
+            self._last_report = done
+        elapsed = time.time() - self.start
+        eta = elapsed / done * (total - done) if done > 0 else 0
+        print(f"  [{done}/{total}] Elapsed: {elapsed:.0f}s | ETA: {eta:.0f}s", flush=True)
+
+
+def serve(args, opts):
+    if len(args) < 3:
+        print("Usage: python3 zip_cluster.py serve <入力アーカイブ> <出力ZIP> <品質(1-100)> [最大辺px]"
+              " [--format=avif|webp] [--bind=HOST:PORT] [--abort-after=N] [--abort-ratio=R] [--stage] [--no-history]")
+        print("  --abort-after=N: N枚変換した時点で見込み圧縮率を判定（デフォルト40、0で無効）")
+        print("  --abort-ratio=R: 見込み圧縮率がR%を超えたら中止（デフォルト90）")
+        print("  --stage: 入力をLinux側に順次コピーしてから展開し、出力ZIPも順次書き戻す（/mnt 上のファイル向け）")
+        print("  --no-history: 実績を history.db に記録しない（動作確認用）")
+        sys.exit(1)
+
+    src = to_wsl_path(args[0])
+    dst = to_wsl_path(args[1])
+    quality = int(args[2])
+    max_size = int(args[3]) if len(args) > 3 else 3000
+    fmt = opts.get('format', 'avif')
+    bind = parse_address(opts.get('bind', DEFAULT_BIND))
+    abort_after = int(opts.get('abort-after', 40))
+    abort_ratio = float(opts.get('abort-ratio', 90))
+    stage = 'stage' in opts
+    record = 'no-history' not in opts
+
+    if fmt not in ENCODER_MODULES:
+        print(f"エラー: 未対応の出力形式です ({fmt})")
+        sys.exit(1)
+    if not os.path.isfile(src):
+        print(f"エラー: ファイルが見つかりません: {src}")
+        sys.exit(1)
+    # 対象の拡張子は変換スクリプト側の定義に合わせる（別に持つと食い違う）
+    encoder = importlib.import_module(ENCODER_MODULES[fmt])
+    ext = archive_index.archive_ext(src)
+    if ext not in encoder.ARCHIVE_EXTS:
+        print(f"エラー: 未対応の形式です (.{ext})")
+        sys.exit(1)
+
+    start = time.time()
+    series = history_db.series_of(src)
+    if record:
+        # 並列数はつながってくるワーカー次第なので 0 で記録する（start_run しなければ何も書かない）
+        history_db.start_run('zip_cluster', fmt, quality, 0, max_size, 'cluster')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        in_dir = os.path.join(tmpdir, 'in')
+        os.makedirs(in_dir)
+
+        print("Extracting archive...", flush=True)
+        stage_time = 0.0
+        local_src = src
+        if stage:
+            t = time.time()
+            local_src = os.path.join(tmpdir, 'src.' + ext)
+            encoder.copy_sequential(src, local_src)
+            stage_time += time.time() - t
+        encoder.extract_archive(local_src, in_dir)
+
+        all_files = []
+        for root, dirs, files in os.walk(in_dir):
+            for f in files:
+                full = os.path.join(root, f)
+                rel = os.path.relpath(full, in_dir)
+                all_files.append((full, rel))
+
+        print(f"  {len(all_files)} files extracted", flush=True)
+
+        tasks = []
+        non_image_files = []
+        for full_path, rel_name in all_files:
+            ext_f = rel_name.rsplit('.', 1)[-1].lower() if '.' in rel_name else ''
+            if ext_f in encoder.IMAGE_EXTS or ext_f in encoder.ANIM_EXTS:
+                tasks.append({'id': len(tasks), 'path': full_path, 'name': rel_name, 'ext': ext_f,
+                              'size': os.path.getsize(full_path), 'anim': ext_f in encoder.ANIM_EXTS})
+            else:
+                non_image_files.append((full_path, rel_name))
+
+        spool_dir = os.path.join(tmpdir, 'out')
+        os.makedirs(spool_dir)
+        other_bytes = sum(os.path.getsize(p) for p, _ in non_image_files)
+        board = JobBoard(tasks, spool_dir, series, abort_after, abort_ratio, other_bytes)
+        server = JobServer(bind, board, fmt, quality, max_size)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        host, port = server.server_address[:2]
+        print(f"Serving {len(tasks)} images on {host}:{port} "
+              f"(format={fmt}, max_size={max_size}), waiting for workers...", flush=True)
+
+        try:
+            board.finished.wait()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        if board.projected is not None:
+            done = board.done_count()
+            print(f"\nAborted: projected ratio {board.projected:.0f}% after {done} images "
+                  f"(threshold {abort_ratio:.0f}%), not worth converting", flush=True)
+            encoder.mark_not_worth(src, fmt, board.projected)
+            history_db.add_archive(src, os.path.getsize(src), None, done, time.time() - start, 'not_worth')
+            history_db.add_busy(done, time.time() - start)
+            history_db.flush()
+            sys.exit(encoder.EXIT_NOT_WORTH)
+
+        print("Creating output ZIP...", flush=True)
+        entries = []
+        kept = 0
+        for job in tasks:
+            out_path = board.results.get(job['id'])
+            if out_path:
+                entries.append((job['name'].rsplit('.', 1)[0] + '.' + fmt, out_path))
+            else:
+                entries.append((job['name'], job['path']))
+                kept += 1
+        entries += [(rel_name, full_path) for full_path, rel_name in non_image_files]
+        # ページ番号の自然順で、データ先頭をページ境界に揃えて書く（1ファイルずつ読んで書き、溜めない）
+        entries.sort(key=lambda e: archive_index.natural_key(e[0]))
+        zip_path = os.path.join(tmpdir, 'out.zip') if stage else dst
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zout:
+            for name, path in entries:
+                with open(path, 'rb') as f:
+                    archive_index.write_aligned(zout, name, f.read())
+
+        if stage:
+            t = time.time()
+            encoder.write_back(zip_path, dst)
+            stage_time += time.time() - t
+
+        in_size = os.path.getsize(src)
+        out_size = os.path.getsize(dst)
+
+    elapsed = time.time() - start
+    history_db.add_archive(src, in_size, out_size, len(tasks), elapsed, 'done')
+    history_db.add_busy(len(tasks), elapsed)
+    history_db.flush()
+    print(f"\nDone in {elapsed:.0f}s")
+    print(f"Input:  {in_size/1024/1024:.1f} MB")
+    print(f"Output: {out_size/1024/1024:.1f} MB")
+    print(f"Ratio: {out_size/in_size*100:.1f}%")
+    if stage:
+        print(f"Staging: {stage_time:.1f}s sequential copy in/out")
+    if kept:
+        print(f"Kept original: {kept} files ({board.failed} failed)")
+
+
+# --- ワーカー ---
+
+def encode_job(header, payload, workdir):
+    """受け取った画像を既存の convert_image で変換し、(成功, 結果バイト or エラー, 画素数) を返す
+    ヘッダはネットワークから来るので、一時ファイル名に使う値はここで検査してから使う。
+    """
+    fmt = header.get('fmt')
+    job_id = header.get('id')
+    if fmt not in ENCODER_MODULES or not isinstance(job_id, int) or isinstance(job_id, bool):
+        return False, f"invalid job: fmt={fmt!r} id={job_id!r}", None
+    encoder = importlib.import_module(ENCODER_MODULES[fmt])
+    name = str(header.get('name', ''))
+    src_ext = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+    # 拡張子は変換スクリプトが扱う画像のものだけ通す（'a./../../x' のような名前で workdir の外に書かせない）
+    if src_ext not in encoder.IMAGE_EXTS and src_ext not in encoder.ANIM_EXTS:
+        return False, f"unsupported image type: {name!r}", None
+    in_path = os.path.join(workdir, f"{job_id}.{src_ext}")
+    out_path = os.path.join(workdir, f"{job_id}.{fmt}")
+    with open(in_path, 'wb') as f:
+        f.write(payload)
+    try:
+        conv = encoder.convert_animation if src_ext in encoder.ANIM_EXTS else encoder.convert_image
+        result_path, err = conv((in_path, out_path, int(header['quality']), int(header['max_size'])))
+        if result_path and os.path.exists(result_path):
+            with open(result_path, 'rb') as f:
+                return True, f.read(), history_db.take_pixels(in_path)
+        return False, err or 'no output', history_db.take_pixels(in_path)
+    except Exception as e:
+        return False, str(e), history_db.take_pixels(in_path)
+    finally:
+        for p in (in_path, out_path):
+            if os.path.exists(p):
+                os.remove(p)
+
+
+def encode_with_heartbeat(sock, header, payload, workdir):
+    """encode_job の間、HEARTBEAT_SEC ごとにサーバへ変換中であることを知らせる
+    1枚の変換は quarantine.TIMEOUT_MAX まで掛かりうるので、無言のままだとサーバの期限切れで再配布されてしまう。
+    """
+    finished = threading.Event()
+
+    def beat():
+        while not finished.wait(HEARTBEAT_SEC):
+            try:
+                send_msg(sock, {'op': 'beat', 'id': header.get('id')})
+            except OSError:
+                return
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        return encode_job(header, payload, workdir)
+    finally:
+        # 結果と混ざらないよう、送りかけのハートビートを待ってから返す
+        finished.set()
+        thread.join()
+
+
+def worker_loop(addr, once, stop):
+    """1接続分のワーカー。サーバが無い間は再接続を繰り返す（once なら1回のサーバで終了）"""
+    connected = False
+    with tempfile.TemporaryDirectory() as workdir:
+        while not stop.is_set():
+            try:
+                with socket.create_connection(addr, timeout=10) as sock:
+                    sock.settimeout(None)
+                    connected = True
+                    while True:
+                        send_msg(sock, {'op': 'get'})
+                        header, payload = recv_msg(sock)
+                        if header.get('op') == 'done':
+                            break
+                        if header.get('op') == 'wait':
+                            time.sleep(header.get('sec', 1))
+                            continue
+                        t = time.time()
+                        ok, result, pixels = encode_with_heartbeat(sock, header, payload, workdir)
+                        sec = time.time() - t
+                        if ok:
+                            send_msg(sock, {'op': 'result', 'id': header.get('id'), 'ok': True,
+                                            'sec': sec, 'pixels': pixels}, result)
+                        else:
+                            send_msg(sock, {'op': 'result', 'id': header.get('id'), 'ok': False,
+                                            'sec': sec, 'error': result})
+                if once:
+                    return
+            except (OSError, ConnectionError, ValueError, struct.error):
+                if once and connected:
+                    return
+            stop.wait(2)
+
+
+def work(args, opts):
+    if len(args) < 1:
+        print("Usage: python3 zip_cluster.py worker <HOST:PORT> [並列数] [--once] [--encoder=NAME]")
+        sys.exit(1)
+
+    addr = parse_address(args[0])
+    workers = int(args[1]) if len(args) > 1 else 4
+    once = 'once' in opts
+    stop = threading.Event()
+
+    print(f"Worker: {workers} threads -> {addr[0]}:{addr[1]}", flush=True)
+    try:
+        encoders.select_backend(workers, opts.get('encoder') or None)
+    except ValueError as e:
+        print(f"  WARNING: {e} (AVIF jobs will fail on this worker)", flush=True)
+    threads = [threading.Thread(target=worker_loop, args=(addr, once, stop), daemon=True)
+               for _ in range(workers)]
+    for t in threads:
+        t.start()
+    try:
+        for t in threads:
+            while t.is_alive():
+                t.join(0.5)
+    except KeyboardInterrupt:
+        stop.set()
+        print("\nWorker stopped.")
+
+
+# --- 動作確認（ループバック） ---
+
+def test_png(width, height, seed):
+    """Pillow なしで作るグラデーションのPNG（動作確認用のページ）"""
+    rows = b''.join(b'\x00' + bytes(v for x in range(width)
+                                     for v in (x * 255 // width, y * 255 // height, (x + y + seed * 37) & 255))
+                    for y in range(height))
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def selftest(args, opts):
+    """127.0.0.1 でサーバと複数のワーカープロセスを起動し、テスト用のZIPが最後まで変換されるか確かめる"""
+    workers = int(args[0]) if args else 3
+    pages = int(opts.get('pages') or 12)
+    fmt = opts.get('format', 'avif')
+    if fmt not in ENCODER_MODULES:
+        print(f"エラー: 未対応の出力形式です ({fmt})")
+        sys.exit(1)
+    script = os.path.abspath(__file__)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src = os.path.join(tmpdir, 'selftest.zip')
+        dst = os.path.join(tmpdir, 'selftest_out.zip')
+        # ページ番号の自然順（page2 < page10）も確かめられるよう桁数を揃えない
+        names = [f'page{i + 1}.png' for i in range(pages)]
+        with zipfile.ZipFile(src, 'w', zipfile.ZIP_STORED) as zout:
+            for i, name in enumerate(reversed(names)):
+                zout.writestr(name, test_png(320, 240, i))
+            zout.writestr('info.txt', b'selftest\n')
+
+        addr = f'127.0.0.1:{free_port()}'
+        print(f"Selftest: {pages} pages, {workers} workers on {addr} (format={fmt})", flush=True)
+        server = subprocess.Popen([sys.executable, script, 'serve', src, dst, '70', '0', f'--format={fmt}',
+                                   f'--bind={addr}', '--abort-after=0', '--no-history'],
+                                  stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        # サーバより先に起動しても、ワーカーはつながるまで再接続を繰り返す
+        procs = [subprocess.Popen([sys.executable, script, 'worker', addr, '1', '--once'],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                 for _ in range(workers)]
+        problems = []
+        try:
+            log, _ = server.communicate(timeout=SELFTEST_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            log, _ = server.communicate()
+            problems.append(f'server did not finish in {SELFTEST_TIMEOUT}s')
+        finally:
+            # --once のワーカーはサーバと一緒に終わる（つながる前にサーバが終わったものは止める）
+            for p in procs:
+                try:
+                    p.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    p.kill()
+                    p.wait()
+
+        if server.returncode != 0:
+            problems.append(f'server exited with {server.returncode}')
+        if os.path.exists(dst):
+            with zipfile.ZipFile(dst) as z:
+                got = z.namelist()
+                bad = z.testzip()
+            want = sorted([n.rsplit('.', 1)[0] + '.' + fmt for n in names] + ['info.txt'],
+                          key=archive_index.natural_key)
+            if bad:
+                problems.append(f'corrupt entry: {bad}')
+            if got != want:
+                problems.append(f'entries {got} != {want}')
+        elif server.returncode == 0:
+            problems.append('no output')
+
+    if problems:
+        print(log)
+        for p in problems:
+            print(f"  FAIL: {p}")
+        sys.exit(1)
+    print("  OK: all pages converted by the workers and written in page order")
+
+
+def main():
+    args, opts = parse_options(sys.argv[1:])
+    if not args or args[0] not in ('serve', 'worker', 'selftest'):
+        print("Usage:")
+        print("  python3 zip_cluster.py serve <入力アーカイブ> <出力ZIP> <品質(1-100)> [最大辺px]"
+              " [--format=avif|webp] [--bind=HOST:PORT] [--abort-after=N] [--abort-ratio=R] [--stage] [--no-history]")
+        print("  python3 zip_cluster.py worker <HOST:PORT> [並列数] [--once] [--encoder=NAME]")
+        print("  python3 zip_cluster.py selftest [ワーカー数] [--pages=N] [--format=avif|webp]")
+        sys.exit(1)
+
+    if args[0] == 'serve':
+        serve(args[1:], opts)
+    elif args[0] == 'selftest':
+        selftest(args[1:], opts)
+    else:
+        work(args[1:], opts)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+"""アーカイブ変換をHTTPで受け付けるローカルサービス
+他のサービスからアップロードされたアーカイブを変換し、変換済みのZIPを返す。
+画像の変換は zip_to_avif_gpu.py / zip_to_webp.py の convert_image をそのまま使い、
+全ジョブで1つの変換スレッドプールを共有する。同時に変換するジョブ数には上限があり、超えた分は待ち行列に入る。
+
+  POST   /jobs?format=avif&quality=70&max_size=3000&name=foo.zip   アップロード（本体はアーカイブ、chunked も可）
+  GET    /jobs                 ジョブの一覧
+  GET    /jobs/ID              ジョブの状態
+  GET    /jobs/ID/result       変換済みZIP（chunked。変換中なら書けたところから順に流す）
+  DELETE /jobs/ID              キャンセルして出力を消す
+
+アップロードはブロックごとに一時ファイルに書き（メモリに載せない）、出力ZIPはページ番号の自然順に
+先頭から追記するだけで書く（ローカルヘッダを書き戻さない）ので、書けた分をそのままダウンロードに流せる。
+"""
+
+import importlib
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import archive_index
+import encoders
+
+ENCODER_MODULES = {'avif': 'zip_to_avif_gpu', 'webp': 'zip_to_webp'}
+ARCHIVE_EXTS = {'zip', 'rar', '7z', 'cbz', 'cbr'} | archive_index.TAR_EXTS
+DEFAULT_BIND = '127.0.0.1:8780'
+STREAM_BLOCK = 1024 * 1024
+READ_AHEAD = 2     # 変換スレッド数の何倍まで1ジョブのページを先に変換しておくか（出力は元の順番で書く）
+JOB_TTL = 3600     # 終わったジョブの出力を残しておく秒数
+ACTIVE = ('queued', 'running')
+
+_cv = threading.Condition()
+_jobs = {}         # ID -> ジョブ（dict）
+_queue = deque()   # 待っているジョブのID
+_state = {'workdir': None, 'max_queue': 16, 'align': archive_index.PAGE_ALIGN, 'pool': None, 'workers': 1}
+
+
+def parse_options(argv):
+    """--key=value 形式のオプションと位置引数を分離"""
+    args, opts = [], {}
+    for a in argv:
+        if a.startswith('--'):
+            key, _, value = a[2:].partition('=')
+            opts[key] = value
+        else:
+            args.append(a)
+    return args, opts
+
+
+def parse_address(addr):
+    host, _, port = addr.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+class AppendOnly:
+    """シークできないファイルとして zipfile に渡す
+    zipfile はローカルヘッダを後から書き戻さずにデータ記述子を使うので、書いた分は二度と変わらない。
+    """
+
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, data):
+        return self.f.write(data)
+
+    def tell(self):
+        return self.f.tell()
+
+    def seek(self, *args):
+        raise OSError('not seekable')
+
+    def flush(self):
+        self.f.flush()
+
+
+# --- ジョブ ---
+
+def job_status(job):
+    """APIで返すジョブの状態"""
+    keys = ('id', 'name', 'format', 'quality', 'max_size', 'status', 'pages', 'done', 'errors',
+            'in_bytes', 'written', 'created', 'started', 'finished', 'error')
+    status = {k: job[k] for k in keys}
+    if job['status'] == 'queued':
+        status['position'] = list(_queue).index(job['id']) + 1
+    return status
+
+
+def submit(name, fmt, quality, max_size, src):
+    """アップロード済みのアーカイブをジョブにして待ち行列に入れる"""
+    job_id = uuid.uuid4().hex[:12]
+    job = {'id': job_id, 'name': name, 'format': fmt, 'quality': quality, 'max_size': max_size,
+           'status': 'queued', 'pages': 0, 'done': 0, 'errors': 0,
+           'in_bytes': os.path.getsize(src), 'written': 0,
+           'created': time.time(), 'started': None, 'finished': None, 'error': None,
+           'dir': os.path.dirname(src), 'src': src, 'out': os.path.join(os.path.dirname(src), 'out.zip'),
+           'cancel': False}
+    with _cv:
+        _jobs[job_id] = job
+        _queue.append(job_id)
+        _cv.notify_all()
+    print(f"  Job {job_id}: queued {name} ({job['in_bytes'] / 1024 / 1024:.1f} MB, {fmt} q{quality})", flush=True)
+    return job
+
+
+def remove(job):
+    """ジョブをキャンセルし、終わっていれば一時ファイルごと消す"""
+    with _cv:
+        job['cancel'] = True
+        if job['status'] == 'queued':
+            _queue.remove(job['id'])
+            job['status'] = 'cancelled'
+            job['finished'] = time.time()
+        if job['status'] not in ACTIVE:
+            _jobs.pop(job['id'], None)
+            shutil.rmtree(job['dir'], ignore_errors=True)
+        _cv.notify_all()
+
+
+def expire():
+    """終わってから JOB_TTL 秒を過ぎたジョブを消す"""
+    now = time.time()
+    with _cv:
+        old = [j for j in _jobs.values() if j['status'] not in ACTIVE and now - j['finished'] > JOB_TTL]
+    for job in old:
+        remove(job)
+
+
+def member_list(job, encoder, reader):
+    """(出力名, ZipInfo または展開済みのパス) を自然順で返す（zip/cbz 以外は展開してから）"""
+    if reader:
+        entries = [(archive_index.safe_member_name(i.filename), i) for i in reader.members]
+    else:
+        ex_dir = os.path.join(job['dir'], 'x')
+        os.makedirs(ex_dir)
+        encoder.extract_archive(job['src'], ex_dir)
+        entries = []
+        for root, dirs, files in os.walk(ex_dir):
+            for f in files:
+                full = os.path.join(root, f)
+                entries.append((os.path.relpath(full, ex_dir).replace(os.sep, '/'), full))
+    entries = [(name, ref) for name, ref in entries if name]
+    entries.sort(key=lambda e: archive_index.natural_key(e[0]))
+    return entries
+
+
+def convert_entry(job, encoder, reader, idx, name, ref):
+    """1メンバを変換して (書く名前, データ, エラー) を返す（画像以外・縮まなかった画像は元のまま）"""
+    ext = archive_index.archive_ext(name)
+    if ext not in encoder.IMAGE_EXTS and ext not in encoder.ANIM_EXTS:
+        if reader:
+            return name, reader.read(ref), None
+        with open(ref, 'rb') as f:
+            return name, f.read(), None
+    fmt = job['format']
+    in_path = os.path.join(job['dir'], f"{idx}.{ext}") if reader else ref
+    out_path = os.path.join(job['dir'], f"{idx}.out.{fmt}")
+    conv = encoder.convert_animation if ext in encoder.ANIM_EXTS else encoder.convert_image
+    try:
+        result_path, err = encoder.extract_and_convert(reader, ref if reader else None, conv,
+                                                       (in_path, out_path, job['quality'], job['max_size']))
+        if result_path and os.path.exists(result_path) and os.path.getsize(result_path) < os.path.getsize(in_path):
+            with open(result_path, 'rb') as f:
+                return name.rsplit('.', 1)[0] + '.' + fmt, f.read(), None
+        with open(in_path, 'rb') as f:
+            return name, f.read(), err
+    except Exception as e:
+        if reader:
+            return name, reader.read(ref), str(e)
+        with open(ref, 'rb') as f:
+            return name, f.read(), str(e)
+    finally:
+        for p in (in_path, out_path) if reader else (out_path,):
+            if os.path.exists(p):
+                os.remove(p)
+
+
+def run_job(job):
+    """ジョブを変換し、出力ZIPを先頭から順に書く（共有の変換プールに先読み分だけ投入する）"""
+    encoder = importlib.import_module(ENCODER_MODULES[job['format']])
+    pool, window = _state['pool'], _state['workers'] * READ_AHEAD
+    ext = archive_index.archive_ext(job['name'])
+    reader = archive_index.ParallelZipReader(job['src']) if ext in ('zip', 'cbz') else None
+    try:
+        entries = member_list(job, encoder, reader)
+        job['pages'] = len(entries)
+        with open(job['out'], 'wb') as f, zipfile.ZipFile(AppendOnly(f), 'w', zipfile.ZIP_STORED) as zout:
+            pending = deque()
+            it = iter(enumerate(entries))
+            while True:
+                while len(pending) < window and not job['cancel']:
+                    item = next(it, None)
+                    if item is None:
+                        break
+                    idx, (name, ref) = item
+                    pending.append(pool.submit(convert_entry, job, encoder, reader, idx, name, ref))
+                if not pending:
+                    break
+                if job['cancel']:
+                    # 変換中のものが終わるのを待ってから閉じる（reader を使っている）
+                    for future in pending:
+                        future.cancel()
+                    wait(pending)
+                    break
+                name, data, err = pending.popleft().result()
+                archive_index.write_aligned(zout, name, data, _state['align'])
+                f.flush()
+                with _cv:
+                    job['done'] += 1
+                    job['errors'] += bool(err)
+                    job['written'] = f.tell()
+                    _cv.notify_all()
+                if err:
+                    print(f"  Job {job['id']}: ERROR {name}: {err.strip()}", flush=True)
+        # 中央ディレクトリは ZipFile を閉じたときに書かれる
+        with _cv:
+            job['written'] = os.path.getsize(job['out'])
+    finally:
+        if reader:
+            reader.close()
+
+
+def job_runner():
+    """待ち行列からジョブを1つずつ取り出して変換する（--jobs の数だけ動かす）"""
+    while True:
+        with _cv:
+            while not _queue:
+                _cv.wait()
+            job = _jobs[_queue.popleft()]
+            job['status'] = 'running'
+            job['started'] = time.time()
+        try:
+            run_job(job)
+            status, error = ('cancelled' if job['cancel'] else 'done'), None
+        except Exception as e:
+            status, error = 'failed', str(e)
+        with _cv:
+            job.update(status=status, error=error, finished=time.time())
+            _cv.notify_all()
+        ratio = f", {job['written'] / job['in_bytes'] * 100:.1f}%" if status == 'done' and job['in_bytes'] else ''
+        print(f"  Job {job['id']}: {status} in {job['finished'] - job['started']:.0f}s{ratio}"
+              f"{f' ({error})' if error else ''}", flush=True)
+        if job['cancel']:
+            remove(job)
+
+
+# --- HTTP ---
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, code, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def route(self):
+        """パスを (ジョブ, 続き) に分ける（/jobs なら (None, '')。該当しなければ 404 を返して False）"""
+        parts = [p for p in urlparse(self.path).path.split('/') if p]
+        if not parts or parts[0] != 'jobs' or len(parts) > 3:
+            self.send_json(404, {'error': 'not found'})
+            return False
+        if len(parts) == 1:
+            return None, ''
+        with _cv:
+            job = _jobs.get(parts[1])
+        if job is None:
+            self.send_json(404, {'error': f'no such job: {parts[1]}'})
+            return False
+        return job, parts[2] if len(parts) > 2 else ''
+
+    def read_body(self, f):
+        """リクエスト本体をブロックごとに f に書く（Content-Length と chunked に対応）"""
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip() or b'0', 16)
+                if size == 0:
+                    # トレーラを読み捨てる
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                self.copy_exact(f, size)
+                self.rfile.readline()
+        else:
+            self.copy_exact(f, int(self.headers.get('Content-Length') or 0))
+
+    def copy_exact(self, f, n):
+        while n > 0:
+            chunk = self.rfile.read(min(n, STREAM_BLOCK))
+            if not chunk:
+                raise ConnectionError('upload ended early')
+            f.write(chunk)
+            n -= len(chunk)
+
+    def do_POST(self):
+        route = self.route()
+        if route is False:
+            return
+        if route[0] is not None:
+            self.send_json(405, {'error': 'POST /jobs only'})
+            return
+        query = {k: v[-1] for k, v in parse_qs(urlparse(self.path).query).items()}
+        name = os.path.basename(query.get('name') or 'upload.zip')
+        fmt = query.get('format', 'avif')
+        try:
+            quality = int(query.get('quality', 70))
+            max_size = int(query.get('max_size', 3000))
+        except ValueError:
+            self.send_json(400, {'error': 'quality and max_size must be integers'})
+            return
+        error = None
+        if fmt not in ENCODER_MODULES:
+            error = f'unsupported format: {fmt}'
+        elif archive_index.archive_ext(name) not in ARCHIVE_EXTS:
+            error = f'unsupported archive: {name}'
+        elif not 1 <= quality <= 100:
+            error = f'quality out of range: {quality}'
+        if error:
+            # 本体を読まずに返すので接続は閉じる
+            self.close_connection = True
+            self.send_json(400, {'error': error})
+            return
+        expire()
+        with _cv:
+            full = len(_queue) >= _state['max_queue']
+        if full:
+            self.close_connection = True
+            self.send_response(503)
+            self.send_header('Retry-After', '30')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        job_dir = tempfile.mkdtemp(dir=_state['workdir'])
+        src = os.path.join(job_dir, 'src.' + archive_index.archive_ext(name))
+        try:
+            with open(src, 'wb') as f:
+                self.read_body(f)
+        except (OSError, ConnectionError, ValueError) as e:
+            shutil.rmtree(job_dir, ignore_errors=True)
+            self.close_connection = True
+            self.send_json(400, {'error': f'upload failed: {e}'})
+            return
+        job = submit(name, fmt, quality, max_size, src)
+        with _cv:
+            status = job_status(job)
+        self.send_response(202)
+        body = json.dumps(dict(status, result=f"/jobs/{job['id']}/result"), ensure_ascii=False).encode('utf-8')
+        self.send_header('Location', f"/jobs/{job['id']}")
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        route = self.route()
+        if route is False:
+            return
+        job, rest = route
+        if job is None:
+            with _cv:
+                self.send_json(200, [job_status(j) for j in sorted(_jobs.values(), key=lambda j: j['created'])])
+        elif rest == '':
+            with _cv:
+                status = job_status(job)
+            self.send_json(200, status)
+        elif rest == 'result':
+            self.stream_result(job)
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_DELETE(self):
+        route = self.route()
+        if route is False:
+            return
+        job, rest = route
+        if job is None or rest:
+            self.send_json(405, {'error': 'DELETE /jobs/ID only'})
+            return
+        remove(job)
+        self.send_json(200, {'id': job['id'], 'status': 'cancelled' if job['status'] in ACTIVE else job['status']})
+
+    def stream_result(self, job):
+        """出力ZIPを chunked で返す。変換中なら書けた分から順に流し、終わるまで待つ"""
+        if job['status'] in ('failed', 'cancelled'):
+            self.send_json(410 if job['status'] == 'cancelled' else 500, job_status(job))
+            return
+        stem = job['name'][:-len(archive_index.archive_ext(job['name'])) - 1]
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Disposition', f"attachment; filename=\"{stem}_{job['format']}.zip\"")
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        pos = 0
+        f = None
+        try:
+            while True:
+                with _cv:
+                    while job['written'] <= pos and job['status'] in ACTIVE:
+                        _cv.wait(1)
+                    end, status = job['written'], job['status']
+                if end > pos and f is None:
+                    f = open(job['out'], 'rb')
+                while pos < end:
+                    chunk = f.read(min(STREAM_BLOCK, end - pos))
+                    if not chunk:
+                        break
+                    self.wfile.write(f'{len(chunk):x}\r\n'.encode() + chunk + b'\r\n')
+                    pos += len(chunk)
+                if status not in ACTIVE:
+                    break
+        finally:
+            if f:
+                f.close()
+        if status != 'done':
+            # 終端のチャンクを送らずに切る（受け手は途中で切れたと分かる）
+            self.close_connection = True
+            return
+        self.wfile.write(b'0\r\n\r\n')
+
+
+def main():
+    args, opts = parse_options(sys.argv[1:])
+    if 'help' in opts:
+        print("Usage: python3 zip_service.py [並列数] [--bind=HOST:PORT] [--jobs=N] [--max-queue=N] [--encoder=NAME] [--align=N]")
+        print(f"  --bind: 待ち受けるアドレス（デフォルト{DEFAULT_BIND}、ローカルのみ）")
+        print("  --jobs: 同時に変換するジョブ数（デフォルト2。変換スレッドは全ジョブで共有）")
+        print("  --max-queue: 待ち行列に入れられるジョブ数（超えたら 503、デフォルト16）")
+        sys.exit(1)
+
+    workers = int(args[0]) if args else (os.cpu_count() or 1)
+    jobs = int(opts.get('jobs') or 2)
+    bind = parse_address(opts.get('bind') or DEFAULT_BIND)
+    _state.update(workers=workers, max_queue=int(opts.get('max-queue') or 16),
+                  align=int(opts.get('align') or archive_index.PAGE_ALIGN))
+    try:
+        encoders.select_backend(workers, opts.get('encoder') or None)
+    except ValueError as e:
+        print(f"  WARNING: {e} (AVIF jobs will fail)", flush=True)
+
+    with tempfile.TemporaryDirectory(prefix='zip_service_') as workdir, \
+            ThreadPoolExecutor(max_workers=workers) as pool:
+        _state.update(workdir=workdir, pool=pool)
+        for _ in range(jobs):
+            threading.Thread(target=job_runner, daemon=True).start()
+        server = ThreadingHTTPServer(bind, ServiceHandler)
+        server.daemon_threads = True
+        # systemd などから止められたときも一時ディレクトリを消す
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        host, port = server.server_address[:2]
+        print(f"Serving on http://{host}:{port}/jobs ({workers} workers, {jobs} jobs at a time)", flush=True)
+        try:
+            server.serve_forever()
+        except (KeyboardInterrupt, SystemExit):
+            print("\nService stopped.", flush=True)
+        finally:
+            server.server_close()
+            with _cv:
+                for job in _jobs.values():
+                    job['cancel'] = True
+                _queue.clear()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,16 +2,39 @@ import zipfile
 import os
 import sys
 import io
+import json
+import resource
+import signal
+import struct
 import subprocess
 import tempfile
+import threading
 import time
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import pillow_avif
-from PIL import Image
+from PIL import Image, ImageSequence
+
+import archive_index
+import governor
+import pages
+import quarantine
 
 IMAGE_EXTS = {'jpg', 'jpeg', 'png', 'webp', 'bmp'}
 ARCHIVE_EXTS = {'zip', 'rar', '7z', 'cbz', 'cbr'}
+ANIM_EXTS = {'gif'}
+READ_AHEAD = 2  # 並列数の何倍まで先に読み込んで変換しておくか（出力は元の順番で書く）
+SANDBOX_FLAG = '--sandbox-worker'
+WORKER_MEM_LIMIT = 3 * 1024 ** 3  # 変換ワーカー1プロセスのアドレス空間の上限（RLIMIT_AS）
+WORKER_CPU_SEC = 300              # 画像1枚あたりのCPU時間の上限（RLIMIT_CPU）
+MAX_PIXELS = 100_000_000          # これを超える画素数の画像は開かない（展開爆弾対策）
+
+_lock = threading.Lock()
+_local = threading.local()
+_sandbox = {'mem_limit': WORKER_MEM_LIMIT, 'cpu_sec': WORKER_CPU_SEC, 'workers': [], 'crashed': 0}
 
 
 def to_wsl_path(p):
@@ -41,17 +64,261 @@ def extract_archive(src, dest_dir):
         raise ValueError(f"未対応の形式: .{ext}")
 
 
-if len(sys.argv) < 4:
-    print("Usage: python3 zip_to_avif.py <入力アーカイブ> <出力ZIP> <品質(1-100)> [最大辺px]")
+def is_grayscale(data):
+    """縮小デコードした画素からグレースケール（ほぼグレー含む）か判定（NumPyが無ければ False）"""
+    small = Image.open(io.BytesIO(data))
+    small.draft('RGB', (pages.CLASSIFY_SIZE, pages.CLASSIFY_SIZE))  # JPEGはDCTスケーリングで縮小デコード
+    return pages.classify_decoded(small) in ('gray', 'near_gray')
+
+
+def encode_animation(data, quality, max_size):
+    """アニメーションGIFを全フレームのアニメーションAVIFに変換"""
+    img = Image.open(io.BytesIO(data))
+    n_frames = getattr(img, 'n_frames', 1)
+    w, h = img.size
+    if pages.too_large_animation(w, h, n_frames):
+        raise ValueError(f"too large animation ({n_frames} frames, {w}x{h})")
+    size = None
+    if max_size > 0 and max(w, h) > max_size:
+        scale = max_size / max(w, h)
+        size = (int(w * scale), int(h * scale))
+
+    frames = []
+    durations = []
+    for frame in ImageSequence.Iterator(img):
+        f = frame.convert('RGBA')
+        if size:
+            f = f.resize(size, Image.LANCZOS)
+        frames.append(f)
+        durations.append(frame.info.get('duration', 100))
+
+    buf = io.BytesIO()
+    frames[0].save(buf, format='AVIF', save_all=True, append_images=frames[1:],
+                   duration=durations, loop=0, quality=quality, speed=6)
+    return buf.getvalue()
+
+
+def convert_member(data, rel_name, quality, max_size):
+    """1メンバを変換し、(書き込む名前, データ, 縮小したか, エラー) を返す
+    失敗・逆効果の場合は元の名前とデータを返す。
+    """
+    ext_f = rel_name.rsplit('.', 1)[-1].lower() if '.' in rel_name else ''
+    if ext_f in ANIM_EXTS:
+        try:
+            out_data = encode_animation(data, quality, max_size)
+        except Exception as e:
+            return rel_name, data, False, str(e)
+        # 元より大きければ元を採用
+        if out_data and len(out_data) < len(data):
+            return rel_name.rsplit('.', 1)[0] + '.avif', out_data, False, None
+        return rel_name, data, False, None
+    if ext_f not in IMAGE_EXTS:
+        return rel_name, data, False, None
+
+    try:
+        img = Image.open(io.BytesIO(data))
+        gray = img.mode in ('L', 'LA', '1') or (img.mode != 'P' and is_grayscale(data))
+        w, h = img.size
+        longest = max(w, h)
+        resized = False
+        if max_size > 0 and longest > max_size:
+            scale = max_size / longest
+            new_w = int(w * scale)
+            new_h = int(h * scale)
+            img = img.resize((new_w, new_h), Image.LANCZOS)
+            resized = True
+        if img.mode in ('RGBA', 'P'):
+            img = img.convert('RGBA')
+        else:
+            img = img.convert('RGB')
+        buf = io.BytesIO()
+        # グレースケールはモノクロ(4:0:0)で符号化。並列に複数枚を処理するので1枚は1スレッド
+        subsampling = '4:0:0' if gray else '4:2:0'
+        img.save(buf, format='AVIF', quality=quality, speed=6, subsampling=subsampling, max_threads=1)
+        return rel_name.rsplit('.', 1)[0] + '.avif', buf.getvalue(), resized, None
+    except Exception as e:
+        return rel_name, data, False, str(e)
+
+
+def write_msg(f, header, payload=b''):
+    """ヘッダ(JSON)と本体の長さ付きで1メッセージ書く（zip_cluster と同じ形式）"""
+    head = json.dumps(header).encode('utf-8')
+    f.write(struct.pack('>II', len(head), len(payload)) + head + payload)
+    f.flush()
+
+
+def read_msg(f):
+    """1メッセージ読んで (header, payload) を返す（相手が終了していれば None）"""
+    prefix = f.read(8)
+    if len(prefix) < 8:
+        return None
+    head_len, body_len = struct.unpack('>II', prefix)
+    head = f.read(head_len)
+    payload = f.read(body_len)
+    if len(head) < head_len or len(payload) < body_len:
+        return None
+    return json.loads(head.decode('utf-8')), payload
+
+
+def _lower_limit(kind, soft):
+    """rlimit の soft を設定（hard はそのまま。hard より上には上げられない）"""
+    _, hard = resource.getrlimit(kind)
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(kind, (soft, hard))
+
+
+def sandbox_main(mem_limit, cpu_sec):
+    """変換ワーカー（子プロセス）: 標準入力から画像を受け取り、変換結果を標準出力に返す"""
+    # 端末の Ctrl-C はプロセスグループ全体に届く。ここで落ちると変換中の画像が隔離されるので、親が入力を閉じるのを待つ
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _lower_limit(resource.RLIMIT_AS, mem_limit)
+    Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+    warnings.simplefilter('error', Image.DecompressionBombWarning)
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    sys.stdout = sys.stderr  # 応答に余計な出力が混ざらないように
+    while True:
+        msg = read_msg(stdin)
+        if msg is None:
+            return
+        header, data = msg
+        # RLIMIT_CPU はプロセスの累積なので、1枚ごとに「これまでの使用量 + 上限」に設定し直す（超えると SIGXCPU で終了）
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        _lower_limit(resource.RLIMIT_CPU, int(usage.ru_utime + usage.ru_stime) + cpu_sec)
+        name, out, resized, err = convert_member(data, header['name'], header['quality'], header['max_size'])
+        # 元のままなら送り返さない
+        same = out is data
+        write_msg(stdout, {'name': name, 'resized': resized, 'err': err, 'same': same}, b'' if same else out)
+
+
+def describe_exit(code, cpu_sec):
+    """ワーカーの終了コードを説明する文字列に"""
+    if code == -signal.SIGXCPU:
+        return f'CPU limit {cpu_sec}s exceeded'
+    if code == -signal.SIGKILL:
+        return 'killed (out of memory?)'
+    if code < 0:
+        try:
+            return signal.Signals(-code).name
+        except ValueError:
+            return f'signal {-code}'
+    return f'exit code {code}'
+
+
+class SandboxWorker:
+    """デコード・エンコードを行う子プロセス（変換スレッドごとに1つ）
+    子プロセスには RLIMIT_AS と1枚ごとの RLIMIT_CPU をかけ、画素数の上限を超える画像は開かない。
+    落ちたらその画像を元のまま残して隔離リストに加え、次の画像で新しい子プロセスを起動する。
+    """
+
+    def __init__(self, mem_limit, cpu_sec):
+        self.cpu_sec = cpu_sec
+        self.cmd = [sys.executable, os.path.abspath(__file__), SANDBOX_FLAG,
+                    f'--mem-limit={mem_limit}', f'--cpu-limit={cpu_sec}']
+        self.proc = None
+
+    def convert(self, data, rel_name, quality, max_size):
+        key = quarantine.data_key(data)
+        reason = quarantine.is_quarantined(rel_name, key)
+        if reason:
+            return rel_name, data, False, f'quarantined ({reason})'
+        if self.proc is None:
+            # 数値計算ライブラリのスレッドごとの確保でアドレス空間の上限に当たらないよう1スレッドに
+            env = dict(os.environ, OPENBLAS_NUM_THREADS='1', OMP_NUM_THREADS='1')
+            self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+        try:
+            write_msg(self.proc.stdin, {'name': rel_name, 'quality': quality, 'max_size': max_size}, data)
+            msg = read_msg(self.proc.stdout)
+        except (OSError, ValueError):
+            msg = None
+        if msg is None:
+            reason = self._replace()
+            quarantine.add(rel_name, f'worker crashed ({reason})', key)
+            return rel_name, data, False, f'worker crashed ({reason}), quarantined'
+        header, out = msg
+        return header['name'], data if header['same'] else out, header['resized'], header['err']
+
+    def _replace(self):
+        """落ちた子プロセスを片付ける（次の convert で起動し直す）"""
+        proc, self.proc = self.proc, None
+        proc.kill()
+        code = proc.wait()
+        _close_pipe(proc.stdin)
+        _close_pipe(proc.stdout)
+        with _lock:
+            _sandbox['crashed'] += 1
+        return describe_exit(code, self.cpu_sec)
+
+    def close(self):
+        if self.proc:
+            _close_pipe(self.proc.stdin)
+            self.proc.wait()
+            _close_pipe(self.proc.stdout)
+            self.proc = None
+
+
+def _close_pipe(f):
+    """子プロセスへのパイプを閉じる（子が読みかけで落ちていると、残りの flush で BrokenPipeError になる）"""
+    try:
+        f.close()
+    except OSError:
+        pass
+
+
+def convert_sandboxed(data, rel_name, quality, max_size):
+    """このスレッドのワーカープロセスで1メンバを変換（convert_member と同じ値を返す）"""
+    worker = getattr(_local, 'worker', None)
+    if worker is None:
+        worker = _local.worker = SandboxWorker(_sandbox['mem_limit'], _sandbox['cpu_sec'])
+        with _lock:
+            _sandbox['workers'].append(worker)
+    return worker.convert(data, rel_name, quality, max_size)
+
+
+def close_sandboxes():
+    for worker in _sandbox['workers']:
+        worker.close()
+
+
+def convert_in_order(entries, load, workers):
+    """entries を並列に読み込み・変換し、元の順番で結果を返す（先読みは workers*READ_AHEAD 件まで）
+    zlib の伸長と Pillow のデコード・エンコードは GIL を解放するのでスレッドで並列に進む。
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for entry in entries:
+            pending.append(executor.submit(load, entry))
+            if len(pending) >= workers * READ_AHEAD:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+ARGS = [a for a in sys.argv[1:] if not a.startswith('--')]
+OPTS = dict(a[2:].partition('=')[::2] for a in sys.argv[1:] if a.startswith('--'))
+
+if SANDBOX_FLAG in sys.argv[1:]:
+    sandbox_main(int(OPTS['mem-limit']), int(OPTS['cpu-limit']))
+    sys.exit(0)
+
+if len(ARGS) < 3:
+    print("Usage: python3 zip_to_avif.py <入力アーカイブ> <出力ZIP> <品質(1-100)> [最大辺px] [--mem-limit=3G] [--cpu-limit=SEC] [--no-sandbox]")
     print("  対応形式: zip, rar, 7z, cbz, cbr")
     print("  品質の目安: 60=最大圧縮, 75=推奨, 85=高画質")
     print("  最大辺: 長辺がこのpxを超える画像を縮小（デフォルト3000、0で無効）")
+    print("  --mem-limit / --cpu-limit: 変換ワーカー1プロセスのメモリ上限と、1枚あたりのCPU時間の上限")
+    print("  --no-sandbox: 子プロセスを使わずにこのプロセスで変換する")
     sys.exit(1)
 
-SRC = to_wsl_path(sys.argv[1])
-DST = to_wsl_path(sys.argv[2])
-QUALITY = int(sys.argv[3])
-MAX_SIZE = int(sys.argv[4]) if len(sys.argv) > 4 else 3000
+SRC = to_wsl_path(ARGS[0])
+DST = to_wsl_path(ARGS[1])
+QUALITY = int(ARGS[2])
+MAX_SIZE = int(ARGS[3]) if len(ARGS) > 3 else 3000
+SANDBOX = 'no-sandbox' not in OPTS
+if OPTS.get('mem-limit'):
+    _sandbox['mem_limit'] = governor.parse_size(OPTS['mem-limit'])
+if OPTS.get('cpu-limit'):
+    _sandbox['cpu_sec'] = int(OPTS['cpu-limit'])
 
 if not os.path.isfile(SRC):
     print(f"エラー: ファイルが見つかりません: {SRC}")
@@ -69,64 +336,65 @@ with tempfile.TemporaryDirectory() as tmpdir:
     in_dir = os.path.join(tmpdir, 'in')
     os.makedirs(in_dir)
 
-    # アーカイブを展開
-    print("Extracting archive...", flush=True)
-    extract_archive(SRC, in_dir)
+    # ZIPは展開せずにメンバを並列に読み、それ以外は展開してから読む
+    reader = None
+    if ext in ('zip', 'cbz'):
+        reader = archive_index.ParallelZipReader(SRC)
+        entries = [(info, archive_index.safe_member_name(info.filename)) for info in reader.members]
+        entries = [(ref, rel) for ref, rel in entries if rel]
+    else:
+        print("Extracting archive...", flush=True)
+        extract_archive(SRC, in_dir)
+        entries = []
+        for root, dirs, files in os.walk(in_dir):
+            for f in files:
+                full = os.path.join(root, f)
+                entries.append((full, os.path.relpath(full, in_dir)))
 
-    # 展開されたファイルを走査
-    all_files = []
-    for root, dirs, files in os.walk(in_dir):
-        for f in files:
-            full = os.path.join(root, f)
-            rel = os.path.relpath(full, in_dir)
-            all_files.append((full, rel))
+    total = len(entries)
+    workers = os.cpu_count() or 1
+    if SANDBOX:
+        # メモリの上限はワーカーごとなので、全員が上限まで使っても空きメモリに収まる数にする
+        avail = governor.mem_available()
+        if avail:
+            workers = max(1, min(workers, avail // _sandbox['mem_limit']))
+    print(f"  {total} files (workers={workers})", flush=True)
+    if SANDBOX:
+        print(f"  Sandbox: {_sandbox['mem_limit'] / 1024 ** 3:.1f}GB, {_sandbox['cpu_sec']}s CPU per image, "
+              f"max {MAX_PIXELS / 1e6:.0f}MP", flush=True)
+    convert = convert_sandboxed if SANDBOX else convert_member
 
-    total = len(all_files)
-    print(f"  {total} files extracted", flush=True)
+    def load_and_convert(entry):
+        ref, rel_name = entry
+        if reader:
+            data = reader.read(ref)
+        else:
+            with open(ref, 'rb') as f:
+                data = f.read()
+        return (rel_name, len(data)) + convert(data, rel_name, QUALITY, MAX_SIZE)
 
     total_in = 0
     total_out = 0
     resized_count = 0
 
     with zipfile.ZipFile(DST, 'w', zipfile.ZIP_STORED) as zout:
-        for i, (full_path, rel_name) in enumerate(all_files, 1):
-            data = open(full_path, 'rb').read()
-            total_in += len(data)
-            ext_f = rel_name.rsplit('.', 1)[-1].lower() if '.' in rel_name else ''
-
-            if ext_f in IMAGE_EXTS:
-                try:
-                    img = Image.open(io.BytesIO(data))
-                    w, h = img.size
-                    longest = max(w, h)
-                    if MAX_SIZE > 0 and longest > MAX_SIZE:
-                        scale = MAX_SIZE / longest
-                        new_w = int(w * scale)
-                        new_h = int(h * scale)
-                        img = img.resize((new_w, new_h), Image.LANCZOS)
-                        resized_count += 1
-                    if img.mode in ('RGBA', 'P'):
-                        img = img.convert('RGBA')
-                    else:
-                        img = img.convert('RGB')
-                    buf = io.BytesIO()
-                    img.save(buf, format='AVIF', quality=QUALITY, speed=6)
-                    out_data = buf.getvalue()
-                    new_name = rel_name.rsplit('.', 1)[0] + '.avif'
-                    zout.writestr(new_name, out_data)
-                    total_out += len(out_data)
-                    ratio = len(out_data) / len(data) * 100
-                    if i % 20 == 0 or i == total:
-                        elapsed = time.time() - start
-                        eta = elapsed / i * (total - i)
-                        print(f"[{i}/{total}] {ratio:.0f}% | Elapsed: {elapsed:.0f}s | ETA: {eta:.0f}s", flush=True)
-                except Exception as e:
-                    print(f"  ERROR converting {rel_name}: {e}, keeping original", flush=True)
-                    zout.writestr(rel_name, data)
-                    total_out += len(data)
-            else:
-                zout.writestr(rel_name, data)
-                total_out += len(data)
+        results = convert_in_order(entries, load_and_convert, workers)
+        for i, (rel_name, in_len, name, out_data, resized, err) in enumerate(results, 1):
+            total_in += in_len
+            total_out += len(out_data)
+            resized_count += resized
+            zout.writestr(name, out_data)
+            if err:
+                print(f"  ERROR converting {rel_name}: {err}, keeping original", flush=True)
+            elif name != rel_name and (i % 20 == 0 or i == total):
+                ratio = len(out_data) / in_len * 100
+                elapsed = time.time() - start
+                eta = elapsed / i * (total - i)
+                print(f"[{i}/{total}] {ratio:.0f}% | Elapsed: {elapsed:.0f}s | ETA: {eta:.0f}s", flush=True)
+
+    if reader:
+        reader.close()
+    close_sandboxes()
 
 in_size = os.path.getsize(SRC)
 out_size = os.path.getsize(DST)
@@ -136,3 +404,5 @@ print(f"Input:  {in_size/1024/1024:.1f} MB")
 print(f"Output: {out_size/1024/1024:.1f} MB")
 print(f"Ratio: {out_size/in_size*100:.1f}%")
 print(f"Resized: {resized_count} images (max {MAX_SIZE}px)")
+if _sandbox['crashed']:
+    print(f"Sandbox: {_sandbox['crashed']} workers crashed and were replaced")
@@ -6,16 +6,46 @@
 import os
 import sys
 import re
-import zipfile
+import json
+import shutil
+import signal
 import subprocess
+import tempfile
+import threading
 import time
+import zipfile
 from collections import Counter
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-ARCHIVE_EXTS = {'zip', 'rar', '7z', 'cbz', 'cbr'}
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+import archive_index
+import encoders
+import governor
+import history_db
+import pages
+import quarantine
+import tuner
+import verify
+
+ARCHIVE_EXTS = {'zip', 'rar', '7z', 'cbz', 'cbr'} | archive_index.TAR_EXTS
+OUTPUT_EXTS = {'zip', 'cbz'} | archive_index.TAR_EXTS
 IMAGE_EXTS = {'jpg', 'jpeg', 'png', 'webp', 'avif', 'bmp', 'gif'}
-HEAVY_EXTS = {'jpg', 'jpeg', 'png', 'bmp'}
+HEAVY_EXTS = {'jpg', 'jpeg', 'png', 'bmp', 'gif'}
+ANIM_EXTS = {'gif'}
 LIGHT_EXTS = {'avif', 'webp'}
+RETARGET_SAMPLES = 5  # --retarget で最大辺を超えるページがあるか調べる枚数
+STATE_DIR = os.path.expanduser('~/.cache/zip_to_avif')
+NOT_WORTH_FILE = os.path.join(STATE_DIR, 'not_worth.json')
+EXIT_NOT_WORTH = 3
+STAGE_BLOCK = 8 * 1024 * 1024
+STAGE_PROBE_BLOCK = 32 * 1024
+STAGE_PROBE_FILES = 3
+PROGRESS_FILE = '.zip_to_avif_progress.jsonl'
+QUEUE_LOG = os.path.join(STATE_DIR, 'queue.log')  # キューで変換したアーカイブの変換スクリプトの出力
+ARCHIVE_TIMEOUT = 3600
+STOP_GRACE = 30  # SIGINT を送ってから変換スクリプトの片付けを待つ秒数（過ぎたらグループごと SIGKILL）
+DEFAULT_RATIO = {'jpg': 0.7, 'jpeg': 0.7, 'png': 0.35, 'bmp': 0.1, 'gif': 0.6}  # 実績が無いときの出力/入力
+DEFAULT_RATE = 2 * 1024 * 1024  # 実績が無いときの1ワーカーあたりの処理速度（入力バイト/秒）
+ARCHIVE_OVERHEAD = 10.0  # アーカイブの展開とZIP作成にかかる固定時間の見込み（秒）
 
 
 def to_wsl_path(p):
@@ -27,96 +57,125 @@ def to_wsl_path(p):
     return p
 
 
+def parse_options(argv):
+    """--key=value 形式のオプションと位置引数を分離"""
+    args, opts = [], {}
+    for a in argv:
+        if a.startswith('--'):
+            key, _, value = a[2:].partition('=')
+            opts[key] = value
+        else:
+            args.append(a)
+    return args, opts
+
+
 # --- アーカイブ分析 ---
 
 def list_archive_images(path):
     """アーカイブ内の画像ファイル拡張子リストを返す（展開せず）"""
-    ext = path.rsplit('.', 1)[-1].lower()
-    entries = []
-
     try:
-        if ext in ('zip', 'cbz'):
-            with zipfile.ZipFile(path, 'r') as z:
-                entries = [n for n in z.namelist() if not n.endswith('/')]
-        elif ext in ('rar', 'cbr'):
-            result = subprocess.run(
-                ['unar', '-l', path],
-                capture_output=True, text=True, timeout=30
-            )
-            if result.returncode == 0:
-                in_list = False
-                for line in result.stdout.splitlines():
-                    stripped = line.strip()
-                    if stripped.startswith('..'):
-                        in_list = True
-                        continue
-                    if in_list and stripped and not stripped.startswith('('):
-                        if '/' != stripped[-1:]:
-                            entries.append(stripped)
-        elif ext == '7z':
-            result = subprocess.run(
-                ['7z', 'l', '-slt', path],
-                capture_output=True, text=True, timeout=30
-            )
-            if result.returncode == 0:
-                for line in result.stdout.splitlines():
-                    if line.startswith('Path = ') and line.count('.') > 0:
-                        entries.append(line[7:])
+        entries = archive_index.list_entries(path)
     except Exception:
-        pass
+        entries = []
 
     image_exts = []
-    for entry in entries:
-        if '.' in entry:
-            e = entry.rsplit('.', 1)[-1].lower()
+    for name, size in entries:
+        if '.' in name:
+            e = name.rsplit('.', 1)[-1].lower()
             if e in IMAGE_EXTS:
                 image_exts.append(e)
     return image_exts
 
+def has_oversized_pages(path, max_size):
+    """ZIPの軽いページ（AVIF/WebP）を数枚だけヘッダを読み、長辺が max_size を超えるものがあるか
+    rar/7z/tar はメンバを安く読めないので調べない（False）。
+    """
+    if archive_index.archive_ext(path) not in ('zip', 'cbz'):
+        return False
+    try:
+        with zipfile.ZipFile(path, 'r') as z:
+            light = [i for i in z.infolist() if i.filename.rsplit('.', 1)[-1].lower() in LIGHT_EXTS]
+            # 表紙（先頭）は大きさが違うことが多いので、等間隔の区間の中ほどを見る
+            n = min(len(light), RETARGET_SAMPLES)
+            for info in [light[(2 * k + 1) * len(light) // (2 * n)] for k in range(n)]:
+                with z.open(info) as f:
+                    size = archive_index.image_dimensions(f.read(archive_index.HEADER_BYTES))
+                if size and max(size) > max_size:
+                    return True
+    except (OSError, zipfile.BadZipFile):
+        pass
+    return False
 
-def analyze_archive(path):
-    """アーカイブを分析して情報を返す"""
+
+def analyze_archive(path, st=None):
+    """アーカイブを分析して情報を返す（st: 走査時に取得済みのstat結果）"""
     basename = os.path.basename(path)
-    size = os.path.getsize(path)
+    st = st or os.stat(path)
     exts = list_archive_images(path)
 
-    return _build_info(path, basename, size, exts, entry_type='archive')
-
-
-# --- 画像フォルダ分析 ---
-
-def list_folder_images(dir_path):
-    """フォルダ内の画像ファイル拡張子リストを返す（再帰）"""
-    exts = []
-    for root, dirs, files in os.walk(dir_path):
-        for f in files:
-            if '.' in f:
-                e = f.rsplit('.', 1)[-1].lower()
-                if e in IMAGE_EXTS:
-                    exts.append(e)
-    return exts
-
-
-def get_folder_size(dir_path):
-    """フォルダの合計サイズ（全ファイル）"""
-    total = 0
-    for root, dirs, files in os.walk(dir_path):
-        for f in files:
-            try:
-                total += os.path.getsize(os.path.join(root, f))
-            except OSError:
-                pass
-    return total
+    info = _build_info(path, basename, st.st_size, exts, entry_type='archive')
+    if info['status'] == 'compress' and is_not_worth(path, st):
+        info['status'] = 'not worth'
+    return info
 
 
-def analyze_folder(dir_path, base_dir):
-    """画像フォルダを分析して情報を返す"""
-    rel = os.path.relpath(dir_path, base_dir)
-    basename = rel + '/'
-    size = get_folder_size(dir_path)
-    exts = list_folder_images(dir_path)
+def is_not_worth(path, st=None):
+    """変換スクリプトが早期中止したアーカイブか（サイズ・更新日時が同じ場合のみ）"""
+    try:
+        with open(NOT_WORTH_FILE, 'r', encoding='utf-8') as f:
+            table = json.load(f)
+    except (OSError, ValueError):
+        return False
+    rec = table.get(f"avif:{os.path.abspath(path)}")
+    if not rec:
+        return False
+    st = st or os.stat(path)
+    return rec['size'] == st.st_size and rec['mtime'] == int(st.st_mtime)
+
+
+# --- ディレクトリ走査 ---
+
+def scan_tree(dir_path):
+    """os.scandirで1回だけ走査し、アーカイブ・直下フォルダごとの画像・直下のバラ画像を集める
+    DirEntry のstat結果を使い回す（NASやWSLの /mnt ではstatが高い）
+    """
+    archives = []   # (path, stat)
+    folders = {}    # 直下のフォルダ名 -> {'size': 全ファイル合計, 'exts': 画像拡張子リスト}
+    loose = {'size': 0, 'exts': []}
+
+    stack = [(dir_path, None)]
+    while stack:
+        path, top = stack.pop()
+        try:
+            it = os.scandir(path)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        name = top or entry.name
+                        folders.setdefault(name, {'size': 0, 'exts': []})
+                        stack.append((entry.path, name))
+                        continue
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                ext = archive_index.archive_ext(entry.name)
+                if ext in ARCHIVE_EXTS:
+                    archives.append((entry.path, st))
+                if top:
+                    folder = folders[top]
+                    folder['size'] += st.st_size
+                    if ext in IMAGE_EXTS:
+                        folder['exts'].append(ext)
+                elif ext in IMAGE_EXTS:
+                    loose['size'] += st.st_size
+                    loose['exts'].append(ext)
 
-    return _build_info(dir_path, basename, size, exts, entry_type='folder')
+    return archives, folders, loose
 
 
 # --- 共通 ---
@@ -152,6 +211,7 @@ def _build_info(path, basename, size, exts, entry_type):
         'type': entry_type,
         'image_count': total,
         'heavy_count': heavy,
+        'heavy_exts': dict(Counter(e for e in exts if e in HEAVY_EXTS)),
         'light_pct': light_pct,
     }
 
@@ -193,49 +253,195 @@ def get_image_size(path):
         '-show_entries', 'stream=width,height', '-of', 'csv=p=0', path
     ]
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
+        result = subprocess.run(cmd, capture_output=True, text=True,
+                                timeout=quarantine.probe_timeout(path))
         if result.returncode == 0 and result.stdout.strip():
             parts = result.stdout.strip().split(',')
             return int(parts[0]), int(parts[1])
+    except subprocess.TimeoutExpired:
+        quarantine.add(path, 'ffprobe timeout')
     except Exception:
         pass
     return None, None
 
 
 def convert_single_image(args):
-    """ffmpeg av1_nvencで1枚の画像をAVIFに変換"""
+    """ffmpegで1枚の画像をAVIFに変換（エンコーダは encoders.select_backend で選んだもの）"""
     in_path, out_path, quality, max_size = args
-    cq = max(1, min(51, int(51 - quality * 0.51)))
+    reason = quarantine.is_quarantined(in_path)
+    if reason:
+        return False, f'quarantined: {reason}'
 
     vf_filters = []
-    if max_size > 0:
-        w, h = get_image_size(in_path)
-        if w and h and max(w, h) > max_size:
-            if w >= h:
-                vf_filters.append(f'scale={max_size}:-2')
-            else:
-                vf_filters.append(f'scale=-2:{max_size}')
+    w, h = get_image_size(in_path)
+    if max_size > 0 and w and h and max(w, h) > max_size:
+        if w >= h:
+            vf_filters.append(f'scale={max_size}:-2')
+        else:
+            vf_filters.append(f'scale=-2:{max_size}')
+    gray = pages.classify_image(in_path, w, h) in ('gray', 'near_gray')
+    # 画素数と実測の処理速度からタイムアウトを決める（寸法不明ならファイルサイズから推定）
+    pixels = w * h if w and h else os.path.getsize(in_path) * 4
+    t = time.time()
+    if encoders.uses_pillow():
+        # Pillow も子プロセスで動かし、ffmpeg と同じくタイムアウト・検証・実績の記録を通す
+        cmd = encoders.pillow_cmd(in_path, out_path, quality, max_size, gray)
+    else:
+        if gray and not encoders.is_gray_capable():
+            # nvenc/svtはyuv400非対応のため、輝度だけにしてから yuv420p に戻す（色差面が一定になる）
+            vf_filters.append('format=gray')
+
+        cmd = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-i', in_path]
+        if vf_filters:
+            cmd += ['-vf', ','.join(vf_filters)]
+        cmd += encoders.av1_args(quality, gray)
+        cmd += ['-frames:v', '1', '-f', 'avif', out_path]
+    err = quarantine.run_guarded(cmd, in_path, quarantine.encode_timeout(encoders.current_backend()['name'], pixels))
+    if err:
+        return False, err
+    quarantine.record_speed(encoders.current_backend()['name'], pixels, time.time() - t)
+    history_db.note_pixels(in_path, pixels)
+    tuner.add_pixels(pixels)
+    err = verify.check(in_path, out_path, w, h)
+    if err:
+        return False, err
+    return True, None
 
-    cmd = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-i', in_path]
-    if vf_filters:
-        cmd += ['-vf', ','.join(vf_filters)]
-    cmd += ['-c:v', 'av1_nvenc', '-cq', str(cq),
-            '-pix_fmt', 'yuv420p', '-frames:v', '1', out_path]
 
-    result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
-    if result.returncode != 0:
-        return False, result.stderr
+def convert_animation(args):
+    """アニメーションGIFをアニメーションAVIFに変換（pages.convert_animation）"""
+    in_path, out_path, quality, max_size = args
+    err = pages.convert_animation(in_path, out_path, quality, max_size, 'avif')
+    if err:
+        return False, err
     return True, None
 
 
-def convert_folder(dir_path, quality, workers, max_size):
-    """フォルダ内の重い画像をAVIFに変換（元ファイルは変換成功後に削除）"""
+def copy_sequential(src, dst, block=STAGE_BLOCK):
+    """大きなブロックで順次コピー（drvfs/9P越しの細かいI/Oを避ける）"""
+    with open(src, 'rb') as fi, open(dst, 'wb') as fo:
+        shutil.copyfileobj(fi, fo, block)
+
+
+def write_back(local_path, dst):
+    """ローカルの出力を一時名で書き戻し、renameで置き換える"""
+    tmp = dst + '.part'
+    copy_sequential(local_path, tmp)
+    os.replace(tmp, dst)
+
+
+def load_progress(dir_path):
+    """フォルダの進捗ジャーナルを読み込む（途中で切れた行は無視）"""
+    records = {}
+    try:
+        with open(os.path.join(dir_path, PROGRESS_FILE), 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                if rec.get('fmt') == 'avif':
+                    records[rec['src']] = rec
+    except OSError:
+        pass
+    return records
+
+
+def output_ok(path):
+    """残っていた出力が読める画像か確認"""
+    try:
+        if os.path.getsize(path) == 0:
+            return False
+    except OSError:
+        return False
+    w, h = get_image_size(path)
+    return bool(w and h)
+
+
+def ext_profile(ext, hist):
+    """拡張子ごとの (出力/入力の比, 1ワーカーあたりの処理速度 バイト/秒)（hist は history_db.ext_table）"""
+    h = hist.get(ext)
+    if h:
+        return min(1.0, h['ratio']), h['rate']
+    return DEFAULT_RATIO.get(ext, 0.8), DEFAULT_RATE
+
+
+def estimate_item(info, workers, hist):
+    """アーカイブ・フォルダの (見込み節約バイト, 見込み処理秒)
+    画像1枚あたりのサイズは全体の平均とし、拡張子ごとの実績の圧縮率・処理速度を掛ける。
+    同じシリーズの実績（history.db）があれば、そのシリーズの圧縮率と1ページあたりの時間を使う。
+    """
+    per_image = info['size'] / info['image_count'] if info['image_count'] else 0
+    saved = 0.0
+    sec = ARCHIVE_OVERHEAD if info['type'] == 'archive' else 0.0
+    h = info.get('hist')
+    if h:
+        n = info['heavy_count']
+        return n * per_image * (1 - min(1.0, h['ratio'])), max(sec + n * h['sec_per_page'] / workers, 1.0)
+    for ext, n in info['heavy_exts'].items():
+        ratio, rate = ext_profile(ext, hist)
+        saved += n * per_image * (1 - ratio)
+        sec += n * per_image / rate / workers
+    return saved, max(sec, 1.0)
+
+
+def timed_call(func, args):
+    """func(args) の結果と所要秒数を返す（--adaptive なら枠が空くまで待ってから始める）"""
+    with tuner.slot():
+        t = time.time()
+        return func(args), time.time() - t
+
+
+def folder_reporter(queue_item):
+    """convert_folder の表示先（キューの項目なら途中経過とキューのログに書き、プロンプトには出さない）"""
+    if queue_item is None:
+        return print
+
+    def say(line=''):
+        line = line.strip()
+        if not line:
+            return
+        queue_item['progress'] = line
+        write_queue_log(line)
+    return say
+
+
+def write_queue_log(line):
+    """キューのログに1行書く（バックグラウンドの表示をプロンプトに混ぜないため）"""
+    os.makedirs(STATE_DIR, exist_ok=True)
+    with open(QUEUE_LOG, 'a', encoding='utf-8') as log:
+        log.write(line.strip() + '\n')
+
+
+def convert_folder(dir_path, quality, workers, max_size, stage=False, deadline=None, queue_item=None):
+    """フォルダ内の重い画像をAVIFに変換（元ファイルは変換成功後に削除）
+    出力は一時名(.part)に書いてから rename し、変換の開始と結果を進捗ジャーナルに追記する。
+    中断後に再実行すると、完了済みのペアと前回元を残した画像は飛ばし、ジャーナルにある書きかけの .part だけ消す。
+    最後まで変換し終えたらジャーナルを消す。
+    stage=True の場合、入力をLinux側の一時領域に順次コピーしてから変換し、
+    出力も順次書き戻して rename する（/mnt 越しのI/Oをまとめる）。
+    deadline（time.time() の値）を過ぎたら新しい画像を投入せず、変換中の分だけ終えて戻る。
+    queue_item（変換キューの項目）を渡すと、途中経過と結果を queue_item['progress'] とキューのログに書き
+    （プロンプトに混ざらないよう表示はしない）、queue_item['cancel'] が立ったら締切と同じように止まる。
+    戻り値は締切・取り消しで変換しなかった枚数。
+    """
     quality_i = int(quality)
     workers_i = int(workers)
     max_size_i = int(max_size)
-
-    # 変換対象を収集
+    pool = tuner.pool_size(workers_i)
+    say = folder_reporter(queue_item)
+
+    # 変換対象を収集（前回の進捗ジャーナルがあれば完了済みのペアを飛ばす）
+    progress = load_progress(dir_path)
+    for rel in progress:
+        # 中断された書き込みの残骸（ジャーナルに載っているペアの分だけ。他の .part には触らない）
+        part = os.path.join(dir_path, rel.rsplit('.', 1)[0] + '.avif.part')
+        if os.path.exists(part):
+            os.remove(part)
     tasks = []
+    src_stat = {}
+    resumed = 0
+    skipped = 0
     for root, dirs, files in os.walk(dir_path):
         for f in files:
             if '.' not in f:
@@ -244,88 +450,588 @@ def convert_folder(dir_path, quality, workers, max_size):
             if ext in HEAVY_EXTS:
                 full = os.path.join(root, f)
                 out = os.path.join(root, f.rsplit('.', 1)[0] + '.avif')
+                st = os.stat(full)
+                src_stat[full] = (st.st_size, int(st.st_mtime))
+                rec = progress.get(os.path.relpath(full, dir_path))
+                if rec and (rec['size'], rec['mtime']) == src_stat[full]:
+                    if rec['state'] == 'kept':
+                        skipped += 1
+                        continue
+                    if rec['state'] == 'done' and output_ok(out):
+                        # 出力の確定後、元ファイル削除前に中断していた
+                        os.remove(full)
+                        resumed += 1
+                        continue
                 tasks.append((full, out))
 
+    if resumed or skipped:
+        say(f"  Resume: {resumed} finished pairs cleaned up, {skipped} skipped (kept original last time)")
     if not tasks:
-        print("  No heavy images to convert.")
-        return
+        say("  No heavy images to convert.")
+        return 0
+    if deadline:
+        # 締切がある場合は、実績上1秒あたりの節約量が大きい拡張子から変換する
+        hist = history_db.ext_table('avif')
+
+        def page_value(task):
+            ratio, rate = ext_profile(task[0].rsplit('.', 1)[-1].lower(), hist)
+            return (1 - ratio) * rate
+        tasks.sort(key=page_value, reverse=True)
 
-    print(f"  Converting {len(tasks)} images (workers={workers_i}, max_size={max_size_i})...")
+    mode = ', staged' if stage else ''
+    say(f"  Converting {len(tasks)} images (workers={workers_i}, max_size={max_size_i}{mode})...")
 
     done = 0
     errors = 0
     kept_original = 0
     total_in_size = 0
     total_out_size = 0
+    left = 0
     start = time.time()
 
-    with ThreadPoolExecutor(max_workers=workers_i) as executor:
-        futures = {}
-        for in_path, out_path in tasks:
-            f = executor.submit(convert_single_image,
-                                (in_path, out_path, quality_i, max_size_i))
-            futures[f] = (in_path, out_path)
-
-        for future in as_completed(futures):
-            in_path, out_path = futures[future]
-            done += 1
-            success, err = future.result()
-
-            in_size = os.path.getsize(in_path)
-            total_in_size += in_size
-
-            if success and os.path.exists(out_path) and os.path.getsize(out_path) > 0:
-                out_size = os.path.getsize(out_path)
-                if out_size < in_size:
-                    # 小さくなった → 元ファイルを削除
-                    os.remove(in_path)
-                    total_out_size += out_size
+    series = history_db.series_of(dir_path)
+    stage_dir = tempfile.mkdtemp(prefix='zip_to_avif_stage_') if stage else None
+    io_stats = {'probe_bytes': 0, 'probe_time': 0.0, 'in_bytes': 0, 'in_time': 0.0,
+          'out_bytes': 0, 'out_time': 0.0}
+
+    def stage_in(idx, in_path, out_path):
+        """入力をステージング領域へコピーし、変換に使うパスを返す"""
+        if not stage:
+            return in_path, out_path + '.part'
+        work_in = os.path.join(stage_dir, f"{idx}.{in_path.rsplit('.', 1)[-1]}")
+        work_out = os.path.join(stage_dir, f"{idx}.avif")
+        # 最初の数枚は小さいブロックで読み、直接I/Oした場合の所要時間の見積もりに使う
+        probe = idx < STAGE_PROBE_FILES
+        t = time.time()
+        copy_sequential(in_path, work_in, STAGE_PROBE_BLOCK if probe else STAGE_BLOCK)
+        elapsed = time.time() - t
+        size = os.path.getsize(work_in)
+        if probe:
+            io_stats['probe_bytes'] += size
+            io_stats['probe_time'] += elapsed
+        else:
+            io_stats['in_bytes'] += size
+            io_stats['in_time'] += elapsed
+        return work_in, work_out
+
+    journal = open(os.path.join(dir_path, PROGRESS_FILE), 'a', encoding='utf-8')
+
+    def record(in_path, state):
+        """ペアの結果をジャーナルに追記（再実行時に参照）"""
+        size, mtime = src_stat[in_path]
+        journal.write(json.dumps({'fmt': 'avif', 'src': os.path.relpath(in_path, dir_path),
+                                  'state': state, 'size': size, 'mtime': mtime},
+                                 ensure_ascii=False) + '\n')
+        journal.flush()
+
+    def finish(future):
+        nonlocal done, errors, kept_original, total_in_size, total_out_size
+        in_path, out_path, work_in, work_out = futures.pop(future)
+        done += 1
+        (success, err), sec = future.result()
+
+        in_size = os.path.getsize(work_in)
+        total_in_size += in_size
+        stat_ext = in_path.rsplit('.', 1)[-1].lower()
+        out_before = total_out_size
+
+        if success and os.path.exists(work_out) and os.path.getsize(work_out) > 0:
+            out_size = os.path.getsize(work_out)
+            if out_size < in_size:
+                # 小さくなった → 出力を確定してから元ファイルを削除
+                if stage:
+                    t = time.time()
+                    write_back(work_out, out_path)
+                    io_stats['out_time'] += time.time() - t
+                    io_stats['out_bytes'] += out_size
+                    os.remove(work_out)
                 else:
-                    # 逆に大きくなった → avifを捨てて元を残す
-                    os.remove(out_path)
-                    total_out_size += in_size
-                    kept_original += 1
+                    os.replace(work_out, out_path)
+                record(in_path, 'done')
+                os.remove(in_path)
+                total_out_size += out_size
             else:
-                errors += 1
+                # 逆に大きくなった → avifを捨てて元を残す
+                os.remove(work_out)
+                record(in_path, 'kept')
                 total_out_size += in_size
-                if os.path.exists(out_path):
-                    os.remove(out_path)
-                if err:
-                    print(f"    ERROR {os.path.basename(in_path)}: {err.strip()}")
-
-            if done % 20 == 0 or done == len(tasks):
-                elapsed = time.time() - start
-                eta = elapsed / done * (len(tasks) - done) if done > 0 else 0
-                ratio = total_out_size / total_in_size * 100 if total_in_size > 0 else 0
-                print(f"    [{done}/{len(tasks)}] {ratio:.0f}% | Elapsed: {elapsed:.0f}s | ETA: {eta:.0f}s")
+                kept_original += 1
+        else:
+            errors += 1
+            record(in_path, 'failed')
+            total_out_size += in_size
+            if os.path.exists(work_out):
+                os.remove(work_out)
+            if err:
+                say(f"    ERROR {os.path.basename(in_path)}: {err.strip()}")
+        if stage:
+            os.remove(work_in)
+        history_db.add_image(work_in, series, stat_ext, in_size, total_out_size - out_before, sec, success)
+
+        elapsed = time.time() - start
+        eta = elapsed / done * (len(tasks) - done) if done > 0 else 0
+        ratio = total_out_size / total_in_size * 100 if total_in_size > 0 else 0
+        line = f"[{done}/{len(tasks)}] {ratio:.0f}% | Elapsed: {elapsed:.0f}s | ETA: {eta:.0f}s"
+        if queue_item is not None:
+            queue_item['progress'] = line
+        elif done % 20 == 0 or done == len(tasks):
+            say(f"    {line}")
+
+    def stopping():
+        return bool(deadline and time.time() >= deadline) or bool(queue_item and queue_item['cancel'])
+
+    futures = {}
+    try:
+        with ThreadPoolExecutor(max_workers=pool) as executor:
+            for idx, (in_path, out_path) in enumerate(tasks):
+                # ステージング中のファイルが溜まりすぎないよう（締切・取り消しで止まれるよう）、
+                # ガバナーがあればその同時変換数（0なら一時停止）まで、先に終わった分を処理
+                while True:
+                    cap = governor.limit(pool * 2 if stage or deadline or queue_item is not None else None)
+                    if cap is None or len(futures) < cap or stopping():
+                        break
+                    if futures:
+                        finished, _ = wait(futures, timeout=governor.CHECK_INTERVAL, return_when=FIRST_COMPLETED)
+                        for fut in finished:
+                            finish(fut)
+                    else:
+                        time.sleep(governor.CHECK_INTERVAL)
+                if stopping():
+                    left = len(tasks) - idx
+                    break
+                # 書きかけの .part を再実行時に消せるよう、投入する前にジャーナルに載せる
+                record(in_path, 'started')
+                work_in, work_out = stage_in(idx, in_path, out_path)
+                conv = convert_animation if in_path.rsplit('.', 1)[-1].lower() in ANIM_EXTS else convert_single_image
+                f = executor.submit(timed_call, conv, (work_in, work_out, quality_i, max_size_i))
+                futures[f] = (in_path, out_path, work_in, work_out)
+
+            for future in as_completed(list(futures)):
+                finish(future)
+    finally:
+        journal.close()
+        if stage_dir:
+            shutil.rmtree(stage_dir, ignore_errors=True)
+        history_db.add_busy(done, time.time() - start)
+        history_db.flush()
+    if not left:
+        # 最後まで終えたフォルダに再開用のジャーナルは要らない
+        try:
+            os.remove(os.path.join(dir_path, PROGRESS_FILE))
+        except OSError:
+            pass
 
     ratio = total_out_size / total_in_size * 100 if total_in_size > 0 else 0
     saved = total_in_size - total_out_size
-    print(f"  Result: {format_size(total_in_size)} -> {format_size(total_out_size)} ({ratio:.0f}%, -{format_size(saved)})")
+    say(f"  Result: {format_size(total_in_size)} -> {format_size(total_out_size)} ({ratio:.0f}%, -{format_size(saved)})")
     if kept_original:
-        print(f"  {kept_original} files kept original (avif was larger)")
+        say(f"  {kept_original} files kept original (avif was larger)")
     if errors:
-        print(f"  {errors} files failed (originals kept)")
+        say(f"  {errors} files failed (originals kept)")
+    if stage:
+        print_stage_summary(io_stats, say)
+    tuner.report(say)
+    if left:
+        reason = 'Cancelled' if queue_item and queue_item['cancel'] else 'Deadline reached'
+        say(f"  {reason}: {left} images left (run again to continue)")
+    return left
+
+
+def print_stage_summary(io_stats, say=print):
+    """ステージングのI/O時間と、直接I/Oした場合との差の見積もりを表示"""
+    in_bytes = io_stats['probe_bytes'] + io_stats['in_bytes']
+    in_time = io_stats['probe_time'] + io_stats['in_time']
+    say(f"  Staging: read {format_size(in_bytes)} in {in_time:.1f}s, "
+        f"wrote back {format_size(io_stats['out_bytes'])} in {io_stats['out_time']:.1f}s")
+    if io_stats['probe_bytes'] and io_stats['in_bytes'] and io_stats['in_time'] > 0:
+        small_rate = io_stats['probe_time'] / io_stats['probe_bytes']
+        big_rate = io_stats['in_time'] / io_stats['in_bytes']
+        est_saved = (io_stats['in_bytes'] + io_stats['out_bytes']) * (small_rate - big_rate)
+        say(f"  Est. I/O time saved: {est_saved:.1f}s "
+            f"({STAGE_PROBE_BLOCK // 1024}KB blocks: {1 / small_rate / 1024 / 1024:.0f}MB/s, "
+            f"{STAGE_BLOCK // 1024 // 1024}MB blocks: {1 / big_rate / 1024 / 1024:.0f}MB/s)")
+
+
+def output_path(src, out_ext):
+    """アーカイブの出力先（'Title.tar.zst' -> 'Title_avif.zip' など、拡張子は out_ext）"""
+    ext = archive_index.archive_ext(src)
+    base = os.path.basename(src)
+    return os.path.join(os.path.dirname(src), f"{base[:-len(ext) - 1] if ext else base}_avif.{out_ext}")
+
+
+# --- 締切モード ---
+
+def parse_duration(text):
+    """'2h' / '90m' / '45s' / '3600' を秒数に変換"""
+    m = re.fullmatch(r'(\d+(?:\.\d+)?)([hms]?)', text.strip())
+    if not m:
+        raise ValueError(f'invalid duration: {text}')
+    return float(m.group(1)) * {'h': 3600, 'm': 60, 's': 1, '': 1}[m.group(2)]
+
+
+def start_archive(cmd, **kwargs):
+    """変換スクリプトを新しいプロセスグループで起動する（止めるときに ffmpeg ごとシグナルを送れる）"""
+    return subprocess.Popen(cmd, stdin=subprocess.DEVNULL, start_new_session=True, **kwargs)
+
+
+def signal_group(proc, sig):
+    """変換スクリプトのプロセスグループ全体にシグナルを送る（もう居なければ何もしない）"""
+    try:
+        os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def stop_archive(proc, grace=STOP_GRACE):
+    """SIGINT で止めて一時ディレクトリを片付けさせ、grace 秒で終わらなければグループごと SIGKILL"""
+    signal_group(proc, signal.SIGINT)
+    try:
+        proc.wait(timeout=grace)
+    except subprocess.TimeoutExpired:
+        pass
+    # 残った ffmpeg も止める
+    signal_group(proc, signal.SIGKILL)
+    proc.wait()
+
+
+def run_archive(cmd, timeout):
+    """変換スクリプトを実行し、timeout 秒を過ぎたら中断する（中断したら None）"""
+    proc = start_archive(cmd)
+    try:
+        return proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        stop_archive(proc)
+        return None
+    except KeyboardInterrupt:
+        # 別のセッションなので端末の Ctrl-C は届かない
+        stop_archive(proc)
+        raise
+
+
+def run_deadline(infos, budget, quality, workers, max_size, stage, archive_cmd, out_ext='zip'):
+    """時間予算の中で、見込み節約量/秒の大きいものから順に変換し、やり残しを報告する
+    アーカイブは見込み時間が残り時間に収まるものだけ始め（締切を過ぎたら中断して出力を消す）、
+    フォルダは締切で新しい画像の投入をやめる。見込みは変換実績（history.db）から出す。
+    """
+    start = time.time()
+    end = start + budget
+    hist = history_db.ext_table('avif')
+    plan = []
+    for info in infos:
+        if info['status'] != 'compress' or info['heavy_count'] == 0:
+            continue
+        saved, sec = estimate_item(info, int(workers), hist)
+        plan.append((saved / sec, saved, sec, info))
+    plan.sort(key=lambda p: p[0], reverse=True)
+    print(f"Deadline mode: {len(plan)} candidates, budget {budget / 60:.1f} min")
+
+    converted = 0
+    left = []  # (見込み節約バイト, 見込み秒, info, 理由)
+    for value, saved, sec, info in plan:
+        governor.wait_ready()
+        remaining = end - time.time()
+        if remaining <= 0:
+            left.append((saved, sec, info, 'not started'))
+            continue
+        if info['type'] == 'archive' and sec > remaining:
+            left.append((saved, sec, info, 'does not fit'))
+            continue
+        print(f"\n[{format_size(value)}/s] Converting {info['type']}: {info['basename']} "
+              f"(est. -{format_size(saved)} in {sec:.0f}s)")
+
+        if info['type'] == 'folder':
+            tuner.reset()
+            n = convert_folder(info['path'], quality, workers, max_size, stage, deadline=end)
+            if n:
+                share = n / info['heavy_count']
+                left.append((saved * share, sec * share, info, f'{n} images left'))
+            converted += 1
+            continue
+
+        src = info['path']
+        out_path = output_path(src, out_ext)
+        if os.path.exists(out_path):
+            print(f"  Skipped: {os.path.basename(out_path)} exists")
+            continue
+        rc = run_archive(archive_cmd(src, out_path), remaining)
+        if rc is None:
+            # 締切で中断 → 書きかけの出力は残さない
+            for p in (out_path, out_path + '.part'):
+                if os.path.exists(p):
+                    os.remove(p)
+            left.append((saved, sec, info, 'interrupted at deadline'))
+        elif rc == EXIT_NOT_WORTH:
+            print(f"  Skipped: {info['basename']} is not worth converting")
+        elif rc != 0:
+            print(f"  ERROR: conversion failed for {info['basename']}")
+        else:
+            converted += 1
+
+    print(f"\nDeadline report: {converted} items converted in {(time.time() - start) / 60:.1f} min")
+    if not left:
+        print("  Nothing left undone.")
+        return
+    print(f"  Left undone: {len(left)} items (est. -{format_size(sum(l[0] for l in left))}, "
+          f"{sum(l[1] for l in left) / 60:.0f} min)")
+    for saved, sec, info, reason in left:
+        print(f"    {truncate_name(info['basename'], 50):<50} est. -{format_size(saved):>7} "
+              f"{sec / 60:6.1f} min  {reason}")
+
+
+# --- 変換キュー ---
+# 一覧の操作と並行して、選んだものを1件ずつ（各件は全ワーカーを使う）バックグラウンドで変換する。
+
+_queue_cv = threading.Condition()
+_queue = {'items': [], 'running': None, 'next_id': 1, 'finished': 0}
+
+
+def enqueue(info, out_path=None):
+    """変換キューの末尾に加える（out_path はアーカイブの出力先）"""
+    with _queue_cv:
+        item = {'id': _queue['next_id'], 'info': info, 'out_path': out_path, 'state': 'queued',
+                'progress': '', 'started': None, 'cancel': None, 'proc': None}
+        _queue['next_id'] += 1
+        _queue['items'].append(item)
+        _queue_cv.notify_all()
+    return item
+
+
+def queue_states():
+    """キューにある項目のパス -> 状態（queued / running）"""
+    with _queue_cv:
+        items = _queue['items'] + ([_queue['running']] if _queue['running'] else [])
+        return {item['info']['path']: item['state'] for item in items}
+
+
+def queue_idle():
+    with _queue_cv:
+        return not _queue['items'] and _queue['running'] is None
+
+
+def wait_queue():
+    """キューが空になり、変換中のものが終わるまで待つ"""
+    with _queue_cv:
+        while _queue['items'] or _queue['running']:
+            _queue_cv.wait(1.0)
+
+
+def _stop_item(item, reason):
+    """変換中の項目を止める（アーカイブは SIGINT で一時ディレクトリを片付けさせる）
+    STOP_GRACE 秒で終わらなければグループごと SIGKILL する（出力を読んでいるキューのスレッドが詰まらないように）。
+    """
+    item['cancel'] = reason
+    proc = item['proc']
+    if proc and proc.poll() is None:
+        signal_group(proc, signal.SIGINT)
+        timer = threading.Timer(STOP_GRACE, lambda: proc.poll() is None and signal_group(proc, signal.SIGKILL))
+        timer.daemon = True
+        timer.start()
+
+
+def cancel_items(ids):
+    """キュー番号（#N）の項目を取り消す（変換中なら止める）"""
+    with _queue_cv:
+        for item_id in ids:
+            item = next((i for i in _queue['items'] if i['id'] == item_id), None)
+            if item:
+                _queue['items'].remove(item)
+                print(f"  Cancelled #{item_id} {item['info']['basename']}")
+            elif _queue['running'] and _queue['running']['id'] == item_id:
+                _stop_item(_queue['running'], 'cancelled')
+                print(f"  Stopping #{item_id} {_queue['running']['info']['basename']} ...")
+            else:
+                print(f"  #{item_id} is not in the queue")
+        _queue_cv.notify_all()
+
+
+def move_to_front(ids):
+    """キュー番号の項目を指定した順でキューの先頭に移す（次に変換される）"""
+    with _queue_cv:
+        front = []
+        for item_id in ids:
+            item = next((i for i in _queue['items'] if i['id'] == item_id), None)
+            if item:
+                _queue['items'].remove(item)
+                front.append(item)
+            else:
+                print(f"  #{item_id} is not waiting in the queue")
+        _queue['items'][:0] = front
+
+
+def stop_queue():
+    """待ち中の項目を捨て、変換中のものを止めて終わるのを待つ"""
+    with _queue_cv:
+        _queue['items'].clear()
+        running = _queue['running']
+        if running:
+            _stop_item(running, 'cancelled')
+    if running:
+        print(f"  Stopping #{running['id']} {running['info']['basename']} ...")
+        wait_queue()
+
+
+def show_queue():
+    """変換中の項目の途中経過と待ち行列を表示"""
+    with _queue_cv:
+        running, items = _queue['running'], _queue['items'][:]
+    if not running and not items and not governor.status():
+        return
+    print("Queue:")
+    if governor.status():
+        print(f"  {governor.status()}")
+    if running:
+        elapsed = time.time() - running['started']
+        print(f"  now #{running['id']:<3} {truncate_name(running['info']['basename'], 40):<40} "
+              f"{elapsed:>5.0f}s  {running['progress']}")
+    for pos, item in enumerate(items, 1):
+        print(f"  {pos:>3} #{item['id']:<3} {truncate_name(item['info']['basename'], 40):<40} "
+              f"{format_size(item['info']['size']):>7}")
+    print()
+
+
+def parse_ids(text):
+    """'3' / '3,5' をキュー番号のリストに（エラー時は None）"""
+    try:
+        return [int(part.strip().lstrip('#')) for part in text.split(',') if part.strip()]
+    except ValueError:
+        print(f"Error: invalid queue number '{text}'")
+        return None
+
+
+def run_queue_item(item, quality, workers, max_size, stage, archive_cmd):
+    """キューの項目を1件変換し、結果の文字列を返す"""
+    info = item['info']
+    # --adaptive の並列数は項目ごとに測り直す（前の項目の速度と比べない）
+    tuner.reset()
+    if info['type'] == 'folder':
+        left = convert_folder(info['path'], quality, workers, max_size, stage, queue_item=item)
+        return f"cancelled, {left} images left" if item['cancel'] else 'done'
+
+    src, out_path = info['path'], item['out_path']
+    proc = start_archive(archive_cmd(src, out_path), stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT, text=True, errors='replace')
+    item['proc'] = proc
+    timer = threading.Timer(ARCHIVE_TIMEOUT, _stop_item, (item, f'timeout after {ARCHIVE_TIMEOUT}s'))
+    timer.start()
+    # 変換スクリプトの出力はプロンプトに混ざらないようログに回し、最後の行を途中経過として見せる
+    summary = ''
+    os.makedirs(STATE_DIR, exist_ok=True)
+    with open(QUEUE_LOG, 'a', encoding='utf-8') as log:
+        log.write(f"\n=== {time.strftime('%Y-%m-%d %H:%M:%S')} {src}\n")
+        for line in proc.stdout:
+            log.write(line)
+            line = line.strip()
+            if line:
+                item['progress'] = line
+            if line.startswith('Ratio:'):
+                summary = line
+    try:
+        rc = proc.wait(timeout=STOP_GRACE)
+    except subprocess.TimeoutExpired:
+        signal_group(proc, signal.SIGKILL)
+        rc = proc.wait()
+    timer.cancel()
+    if item['cancel']:
+        # 片付けの終わっていない ffmpeg が残っていれば止める
+        signal_group(proc, signal.SIGKILL)
+        # 中断 → 書きかけの出力は残さない
+        for p in (out_path, out_path + '.part'):
+            if os.path.exists(p):
+                os.remove(p)
+        return item['cancel']
+    if rc == EXIT_NOT_WORTH:
+        return 'not worth converting'
+    if rc != 0:
+        return f'failed (see {QUEUE_LOG})'
+    return f"done, {summary}" if summary else 'done'
+
+
+def queue_worker(quality, workers, max_size, stage, archive_cmd):
+    """キューの先頭から1件ずつ変換し続ける（デーモンスレッド）"""
+    while True:
+        with _queue_cv:
+            while not _queue['items']:
+                _queue_cv.wait()
+            item = _queue['items'].pop(0)
+            item['state'] = 'running'
+            item['started'] = time.time()
+            _queue['running'] = item
+        if governor.limit(1) == 0:
+            item['progress'] = 'paused by governor'
+        governor.wait_ready()
+        try:
+            result = run_queue_item(item, quality, workers, max_size, stage, archive_cmd)
+        except Exception as e:
+            result = f'failed: {e}'
+        print(f"\n  Queue #{item['id']} {item['info']['basename']}: {result} "
+              f"({time.time() - item['started']:.0f}s)", flush=True)
+        with _queue_cv:
+            item['state'] = 'finished'
+            _queue['running'] = None
+            _queue['finished'] += 1
+            _queue_cv.notify_all()
 
 
 # --- メイン ---
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python3 zip_to_avif_dir.py <directory> [quality] [workers] [max_size]")
+    args, opts = parse_options(sys.argv[1:])
+    if len(args) < 1:
+        print("Usage: python3 zip_to_avif_dir.py <directory> [quality] [workers] [max_size] [--cluster=HOST:PORT] [--stage] [--deadline=2h] [--encoder=NAME]")
+        print("  --cluster: アーカイブ変換をジョブサーバ経由で zip_cluster.py のワーカーに分散")
+        print("  --stage: 入出力をLinux側の一時領域にまとめてコピーして変換（/mnt 上のフォルダ向け）")
+        print("  --output=zip|cbz|tar|cbt|tar.zst: アーカイブの出力形式（tar系は先頭から順に1回書くだけ、遅いディスク向け）")
+        print("  --verify=R: 出力を元画像と比べて検証する割合（デフォルト1=全数、0で無効）、--min-psnr=DB: 合格ライン")
+        print("  --deadline: 選択せずに、時間内で節約量の見込みが大きいものから変換（例: 2h, 90m）")
+        print("  --background: 共用マシン向け（nice 10, ionice idle, ロード上限=コア数, 空きメモリ1GB未満で一時停止）")
+        print("  --nice=N, --ionice=idle|low, --max-load=L, --max-rss=8G, --min-free=2G: 優先度と負荷の閾値を個別に指定")
+        print("  --adaptive[=LO-HI]: 完了した画素数/秒を見て並列数を実行中に増減（アーカイブ変換にも渡す）")
+        print("  --retarget: AVIF/WebPが多いアーカイブも、最大辺を超えるページがあれば一覧に出して縮小し直す")
+        print("  --encoder: AV1エンコーダを指定（省略時は使えるものから最速を自動選択）")
+        print("  --best-of: アーカイブ変換でページごとにAVIFとWebPの小さい方を採用")
+        print("  --pipe: アーカイブ変換でPillowでデコードした画素をffmpegに直接流す（要Pillow）")
         sys.exit(1)
 
-    dir_path = to_wsl_path(sys.argv[1])
-    quality = sys.argv[2] if len(sys.argv) > 2 else '70'
-    workers = sys.argv[3] if len(sys.argv) > 3 else '4'
-    max_size = sys.argv[4] if len(sys.argv) > 4 else '2160'
+    dir_path = to_wsl_path(args[0])
+    quality = args[1] if len(args) > 1 else '70'
+    # 並列数を省略したら、実績上ページ/秒が最も高かった並列数を使う
+    best = None if len(args) > 2 else history_db.best_workers('avif')
+    workers = args[2] if len(args) > 2 else str(best or 4)
+    if best:
+        print(f"Workers: {best} (best throughput in history)")
+    max_size = args[3] if len(args) > 3 else '2160'
+    cluster = opts.get('cluster')
+    stage = 'stage' in opts
+    # --retarget: 軽い形式のアーカイブでも、最大辺を超えるページだけ縮小し直す
+    retarget = int(max_size) if 'retarget' in opts else 0
+    out_ext = (opts.get('output') or 'zip').lower().lstrip('.')
+    if out_ext not in OUTPUT_EXTS:
+        print(f"Error: unsupported output format: {out_ext} (choices: {', '.join(sorted(OUTPUT_EXTS))})")
+        sys.exit(1)
+    verify.configure(float(opts.get('verify') or 1), float(opts.get('min-psnr') or verify.MIN_PSNR))
+    try:
+        governor.options_to_config(opts, int(workers))
+        tuner.options_to_config(opts, int(workers))
+        budget = parse_duration(opts['deadline']) if opts.get('deadline') else None
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    encoder = opts.get('encoder') or None
 
     if not os.path.isdir(dir_path):
         print(f"Error: not a directory: {dir_path}")
         sys.exit(1)
 
+    try:
+        encoders.select_backend(int(workers), encoder)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    history_db.start_run('zip_to_avif_dir', 'avif', quality, workers, max_size, encoders.current_backend()['name'])
+
     # --- 探索・分析 ---
-    infos = scan_directory(dir_path)
+    infos = scan_directory(dir_path, retarget)
 
     if not infos:
         print(f"No archives or image folders found in {dir_path}")
@@ -333,99 +1039,153 @@ def main():
 
     # --- 表示→選択→変換のループ ---
     script = os.path.expanduser('~/bin/zip_to_avif_gpu.py')
+    cluster_script = os.path.expanduser('~/bin/zip_cluster.py')
+
+    def archive_cmd(src, out_path):
+        # zip_cluster.py は tar を扱わないので、tar の入出力はこのマシンで変換する
+        if cluster and archive_index.archive_ext(src) not in archive_index.TAR_EXTS \
+                and out_ext not in archive_index.TAR_EXTS:
+            return ['python3', cluster_script, 'serve', src, out_path, quality, max_size,
+                    '--format=avif', f'--bind={cluster}'] + (['--stage'] if stage else [])
+        # ガバナーの同時変換数には、変換スクリプトが変換中も従う（governor.follow）
+        cmd = ['python3', script, src, out_path, quality, workers, max_size]
+        if stage:
+            cmd.append('--stage')
+        for key in ('verify', 'min-psnr', 'align', 'adaptive'):
+            if key in opts:
+                cmd.append(f'--{key}={opts[key]}')
+        if encoder:
+            cmd.append(f'--encoder={encoder}')
+        for flag in ('best-of', 'pipe', 'retarget'):
+            if flag in opts:
+                cmd.append(f'--{flag}')
+        return cmd
+
+    if budget:
+        run_deadline(infos, budget, quality, workers, max_size, stage, archive_cmd, out_ext)
+        return
 
+    # 選んだものはバックグラウンドのキューで変換し、その間も一覧の操作を続けられる
+    # （ガバナーの変更はプロンプトに混ざらないようキューのログに書き、一覧の下に状態を出す）
+    governor.set_output(write_queue_log)
+    threading.Thread(target=queue_worker, args=(quality, workers, max_size, stage, archive_cmd),
+                     daemon=True).start()
+    scanned = 0  # 最後にスキャンした時点の変換済み件数
     while True:
-        show_list(infos)
+        # キューが空になったら、変換の結果を一覧に反映するため再スキャン
+        if queue_idle() and _queue['finished'] != scanned:
+            scanned = _queue['finished']
+            infos = scan_directory(dir_path, retarget)
+            if not infos:
+                print("No more items found.")
+                break
+        show_list(infos, queue_states())
+        show_queue()
         try:
-            sel = input("Select (e.g. 1,2 / all / r=rescan / q): ").strip()
+            sel = input("Select (e.g. 1,2 / all / Enter=refresh / c N=cancel / n N=next / r=rescan / q): ").strip()
         except (KeyboardInterrupt, EOFError):
             print("\nAborted.")
+            stop_queue()
             break
 
-        if sel.lower() == 'q' or sel == '':
+        if sel.lower() == 'q':
+            if not queue_idle():
+                print("Waiting for the queue to finish (Ctrl-C to abort) ...")
+                try:
+                    wait_queue()
+                except KeyboardInterrupt:
+                    print("\nAborted.")
+                    stop_queue()
+                    break
             print("Done.")
             break
 
+        if sel == '':
+            continue
+
         if sel.lower() == 'r':
-            infos = scan_directory(dir_path)
-            if not infos:
+            infos = scan_directory(dir_path, retarget)
+            scanned = _queue['finished']
+            if not infos and queue_idle():
                 print("No archives or image folders found.")
                 break
             continue
 
+        m = re.fullmatch(r'([cn])\s+(.+)', sel, re.IGNORECASE)
+        if m:
+            ids = parse_ids(m.group(2))
+            if ids:
+                (cancel_items if m.group(1).lower() == 'c' else move_to_front)(ids)
+            continue
+
         selected = parse_selection(sel, len(infos))
         if selected is None:
             continue
-
-        # 変換実行
-        total = len(selected)
-        for i, idx in enumerate(selected, 1):
+        if sel.lower() == 'all':
+            # all は一覧で -> の付いた変換対象だけ（not worth などは番号で選んだときだけ変換する）
+            wanted = ('compress', 'retarget') if retarget else ('compress',)
+            selected = [idx for idx in selected if infos[idx]['status'] in wanted]
+
+        # キューに追加（上書きの確認はここで済ませる）
+        states = queue_states()
+        for idx in selected:
             info = infos[idx]
-
+            if info['path'] in states:
+                print(f"  Already {states[info['path']]}: {info['basename']}")
+                continue
             if info['type'] == 'folder':
                 if info['heavy_count'] == 0:
-                    print(f"\n[{i}/{total}] Skipping {info['basename']} (no heavy images)")
+                    print(f"  Skipping {info['basename']} (no heavy images)")
                     continue
-                print(f"\n[{i}/{total}] Converting folder: {info['basename']} "
-                      f"({format_size(info['size'])}, {info['heavy_count']} heavy images)")
-                convert_folder(info['path'], quality, workers, max_size)
+                item = enqueue(info)
             else:
                 src = info['path']
-                name_base = os.path.basename(src).rsplit('.', 1)[0]
-                out_path = os.path.join(os.path.dirname(src), f"{name_base}_avif.zip")
-
+                out_path = output_path(src, out_ext)
                 if os.path.exists(out_path):
                     ans = input(f"  WARNING: {os.path.basename(out_path)} exists. Overwrite? (y/N): ").strip()
                     if ans.lower() != 'y':
                         print("  Skipped.")
                         continue
+                item = enqueue(info, out_path)
+            print(f"  Queued #{item['id']} {info['basename']} ({format_size(info['size'])})")
 
-                print(f"\n[{i}/{total}] Converting archive: {info['basename']} ({format_size(info['size'])})")
-                print(f"  -> {os.path.basename(out_path)}")
-
-                result = subprocess.run(
-                    ['python3', script, src, out_path, quality, workers, max_size],
-                    stdin=subprocess.DEVNULL, timeout=3600
-                )
-                if result.returncode != 0:
-                    print(f"  ERROR: conversion failed for {info['basename']}")
-
-        print(f"\nBatch done. {total} items processed.")
-
-        # 再スキャンして一覧を更新
-        infos = scan_directory(dir_path)
-        if not infos:
-            print("No more items found.")
-            break
-        print()
-
-
-def scan_directory(dir_path):
+def scan_directory(dir_path, retarget=0):
     """ディレクトリをスキャンしてアーカイブ・画像フォルダの情報リストを返す"""
     print(f"\nScanning {dir_path} ...")
 
     infos = []
 
-    # アーカイブを再帰探索
-    for root, dirs, files in os.walk(dir_path):
-        for f in files:
-            ext = f.rsplit('.', 1)[-1].lower() if '.' in f else ''
-            if ext in ARCHIVE_EXTS:
-                infos.append(analyze_archive(os.path.join(root, f)))
+    archives, folders, loose = scan_tree(dir_path)
 
-    # 画像フォルダ探索（直下のサブディレクトリ単位）
-    for entry in os.listdir(dir_path):
-        full = os.path.join(dir_path, entry)
-        if os.path.isdir(full) and list_folder_images(full):
-            infos.append(analyze_folder(full, dir_path))
+    # アーカイブ（再帰）
+    for path, st in archives:
+        infos.append(analyze_archive(path, st))
 
-    # 直下のバラ画像
-    info = _build_info_loose(dir_path)
-    if info:
-        infos.append(info)
+    # 画像フォルダ（直下のサブディレクトリ単位）
+    for name, folder in folders.items():
+        if folder['exts']:
+            infos.append(_build_info(os.path.join(dir_path, name), name + '/',
+                                     folder['size'], folder['exts'], entry_type='folder'))
 
+    # 直下のバラ画像
+    if loose['exts']:
+        infos.append(_build_info(dir_path, './', loose['size'], loose['exts'], entry_type='folder'))
+
+    if retarget:
+        # 軽い形式が多くても、最大辺を超えるページがあれば縮小し直す候補にする
+        for info in infos:
+            if info['type'] == 'archive' and info['light_pct'] >= 50 and info['status'] != 'not worth' \
+                    and not is_not_worth(info['path']) and has_oversized_pages(info['path'], retarget):
+                info['status'] = 'retarget'
     # avif/webpが50%以上のものは除外
-    infos = [i for i in infos if i['light_pct'] < 50]
+    infos = [i for i in infos if i['light_pct'] < 50 or i['status'] == 'retarget']
+
+    # 同じシリーズの変換実績があれば一覧に出し、縮まなかったシリーズは not worth にする
+    table = history_db.series_table('avif')
+    for info in infos:
+        info['hist'] = table.get(history_db.series_of(info['path']))
+        if info['status'] == 'compress' and info['hist'] and info['hist']['ratio'] >= history_db.NOT_WORTH_RATIO:
+            info['status'] = 'not worth'
 
     # サイズ昇順ソート（一番下が一番重い）
     infos.sort(key=lambda x: x['size'])
@@ -433,15 +1193,19 @@ def scan_directory(dir_path):
     return infos
 
 
-def show_list(infos):
-    """一覧を表示"""
+def show_list(infos, states=None):
+    """一覧を表示（states: 変換キューにある項目のパス -> 状態）"""
     NAME_MAX = 40
     print()
     for idx, info in enumerate(infos, 1):
-        marker = '->' if info['status'] == 'compress' else '  '
+        marker = '->' if info['status'] in ('compress', 'retarget') else '  '
         tag = info['status']
+        if states and info['path'] in states:
+            marker, tag = '>>', states[info['path']]
         name = truncate_name(info['basename'], NAME_MAX)
         extra = f" ({info['image_count']}img)" if info['type'] == 'folder' else ''
+        if info.get('hist'):
+            extra += f"  hist {info['hist']['ratio'] * 100:.0f}% {info['hist']['sec_per_page']:.1f}s/p"
         print(f"  [{idx:>3}] {name:<{NAME_MAX}}  {format_size(info['size']):>7}  {info['fmt']:<12} {marker} {tag}{extra}")
     print()
 
@@ -483,25 +1247,5 @@ def parse_selection(sel, count):
     return valid
 
 
-def _build_info_loose(dir_path):
-    """直下のバラ画像のみ分析（サブディレクトリは含めない）"""
-    exts = []
-    total_size = 0
-    for f in os.listdir(dir_path):
-        full = os.path.join(dir_path, f)
-        if not os.path.isfile(full):
-            continue
-        if '.' in f:
-            e = f.rsplit('.', 1)[-1].lower()
-            if e in IMAGE_EXTS:
-                exts.append(e)
-                total_size += os.path.getsize(full)
-
-    if not exts:
-        return None
-
-    return _build_info(dir_path, './', total_size, exts, entry_type='folder')
-
-
 if __name__ == '__main__':
     main()
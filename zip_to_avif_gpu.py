@@ -1,20 +1,49 @@
 #!/usr/bin/env python3
 """アーカイブ内の画像をAVIFに変換（NVIDIA GPU使用版）
-対応形式: zip, rar, 7z
+対応形式: zip, rar, 7z, cbz, cbr, tar, cbt, tar.zst（tar系は先頭から順に読みながら変換する）
 RTX 40系のAV1ハードウェアエンコーダ(NVENC)を使用して高速変換。
+GPUがない環境では libsvtav1 / librav1e / libaom-av1 / pillow-avif のうち使える最速のものに切り替える。
 """
 
+import io
 import zipfile
+import json
 import os
 import sys
+import shutil
 import subprocess
 import tempfile
 import time
+from contextlib import contextmanager
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+import archive_index
+import encoders
+import governor
+import history_db
+import pages
+import quarantine
+import tuner
+import verify
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 IMAGE_EXTS = {'jpg', 'jpeg', 'png', 'webp', 'bmp'}
-ARCHIVE_EXTS = {'zip', 'rar', '7z', 'cbz', 'cbr'}
+ARCHIVE_EXTS = {'zip', 'rar', '7z', 'cbz', 'cbr'} | archive_index.TAR_EXTS
+STATE_DIR = os.path.expanduser('~/.cache/zip_to_avif')
+NOT_WORTH_FILE = os.path.join(STATE_DIR, 'not_worth.json')
+EXIT_NOT_WORTH = 3
+STAGE_BLOCK = 8 * 1024 * 1024
+ANIM_EXTS = {'gif'}
+LIGHT_EXTS = {'avif', 'webp'}  # --retarget で長辺が max_size を超える場合だけ縮小し直す形式
+MAX_NEST_DEPTH = 3
+MAX_PIXELS = 100_000_000  # --pipe でPillowがデコードする最大画素数（展開爆弾対策、zip_to_avif.py と同じ）
+NESTED_OUT_EXTS = {'zip': 'zip', 'cbz': 'cbz', 'rar': 'zip', 'cbr': 'cbz', '7z': 'zip',
+                   'tar': 'zip', 'cbt': 'cbz', 'tar.zst': 'zip', 'tzst': 'zip'}
 
 
 def to_wsl_path(p):
@@ -28,13 +57,58 @@ def to_wsl_path(p):
     return p
 
 
+def parse_options(argv):
+    """--key=value 形式のオプションと位置引数を分離"""
+    args, opts = [], {}
+    for a in argv:
+        if a.startswith('--'):
+            key, _, value = a[2:].partition('=')
+            opts[key] = value
+        else:
+            args.append(a)
+    return args, opts
+
+
+def mark_not_worth(path, fmt, ratio):
+    """変換しても縮まないアーカイブを記録（ディレクトリツールの一覧に反映）"""
+    try:
+        with open(NOT_WORTH_FILE, 'r', encoding='utf-8') as f:
+            table = json.load(f)
+    except (OSError, ValueError):
+        table = {}
+    st = os.stat(path)
+    table[f"{fmt}:{os.path.abspath(path)}"] = {
+        'size': st.st_size, 'mtime': int(st.st_mtime), 'ratio': round(ratio, 1),
+    }
+    os.makedirs(STATE_DIR, exist_ok=True)
+    tmp = NOT_WORTH_FILE + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(table, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, NOT_WORTH_FILE)
+
+
+def copy_sequential(src, dst, block=STAGE_BLOCK):
+    """大きなブロックで順次コピー（drvfs/9P越しの細かいI/Oを避ける）"""
+    with open(src, 'rb') as fi, open(dst, 'wb') as fo:
+        shutil.copyfileobj(fi, fo, block)
+
+
+def write_back(local_path, dst):
+    """ローカルの出力を一時名で書き戻し、renameで置き換える"""
+    tmp = dst + '.part'
+    copy_sequential(local_path, tmp)
+    os.replace(tmp, dst)
+
+
 def extract_archive(src, dest_dir):
     """アーカイブを展開（zip/rar/7z対応）"""
-    ext = src.rsplit('.', 1)[-1].lower() if '.' in src else ''
+    ext = archive_index.archive_ext(src)
 
     if ext in ('zip', 'cbz'):
         with zipfile.ZipFile(src, 'r') as zin:
             zin.extractall(dest_dir)
+    elif ext in archive_index.TAR_EXTS:
+        archive_index.extract_tar(src, dest_dir)
     elif ext in ('rar', 'cbr'):
         subprocess.run(['unar', '-no-directory', '-o', dest_dir, src],
                        capture_output=True, check=True)
@@ -54,7 +128,12 @@ def get_image_size(path):
         '-of', 'csv=p=0',
         path
     ]
-    result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True,
+                                timeout=quarantine.probe_timeout(path))
+    except subprocess.TimeoutExpired:
+        quarantine.add(path, 'ffprobe timeout')
+        return None, None
     if result.returncode == 0 and result.stdout.strip():
         parts = result.stdout.strip().split(',')
         return int(parts[0]), int(parts[1])
@@ -62,65 +141,421 @@ def get_image_size(path):
 
 
 def convert_image(args):
-    """ffmpeg av1_nvencで画像をAVIFに変換（リサイズ対応）"""
+    """ffmpegで画像をAVIFに変換（リサイズ対応、エンコーダは encoders.select_backend で選んだもの）"""
     in_path, out_path, quality, max_size = args
-    cq = max(1, min(51, int(51 - quality * 0.51)))
+    reason = quarantine.is_quarantined(in_path)
+    if reason:
+        return None, f'quarantined: {reason}'
 
     vf_filters = []
-    if max_size > 0:
-        w, h = get_image_size(in_path)
-        if w and h and max(w, h) > max_size:
-            if w >= h:
-                vf_filters.append(f'scale={max_size}:-2')
-            else:
-                vf_filters.append(f'scale=-2:{max_size}')
+    w, h = get_image_size(in_path)
+    if max_size > 0 and w and h and max(w, h) > max_size:
+        if w >= h:
+            vf_filters.append(f'scale={max_size}:-2')
+        else:
+            vf_filters.append(f'scale=-2:{max_size}')
+    gray = pages.classify_image(in_path, w, h) in ('gray', 'near_gray')
+    # 画素数と実測の処理速度からタイムアウトを決める（寸法不明ならファイルサイズから推定）
+    pixels = w * h if w and h else os.path.getsize(in_path) * 4
+    t = time.time()
+    if encoders.uses_pillow():
+        # Pillow も子プロセスで動かし、ffmpeg と同じくタイムアウト・検証・実績の記録を通す
+        cmd = encoders.pillow_cmd(in_path, out_path, quality, max_size, gray)
+    else:
+        if gray and not encoders.is_gray_capable():
+            # nvenc/svtはyuv400非対応のため、輝度だけにしてから yuv420p に戻す（色差面が一定になる）
+            vf_filters.append('format=gray')
+
+        cmd = [
+            'ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
+            '-i', in_path,
+        ]
+        if vf_filters:
+            cmd += ['-vf', ','.join(vf_filters)]
+        cmd += encoders.av1_args(quality, gray)
+        cmd += [
+            '-frames:v', '1',
+            out_path
+        ]
+    err = quarantine.run_guarded(cmd, in_path, quarantine.encode_timeout(encoders.current_backend()['name'], pixels))
+    if err:
+        return None, err
+    quarantine.record_speed(encoders.current_backend()['name'], pixels, time.time() - t)
+    history_db.note_pixels(in_path, pixels)
+    tuner.add_pixels(pixels)
+    err = verify.check(in_path, out_path, w, h)
+    if err:
+        return None, err
+    return out_path, None
+
+
+def convert_best(args):
+    """1回のデコード・縮小から AVIF と WebP を同時にエンコードし、品質を満たす小さい方を返す
+    ffmpeg の split で同じフレームを2つのエンコーダに渡す（デコードとscaleは1回だけ）。
+    検証対象の画像は小さい方から検証し、不合格ならもう一方を使う。
+    """
+    in_path, out_path, quality, max_size = args
+    if encoders.uses_pillow():
+        return convert_image(args)
+    reason = quarantine.is_quarantined(in_path)
+    if reason:
+        return None, f'quarantined: {reason}'
+
+    vf_filters = []
+    w, h = get_image_size(in_path)
+    if max_size > 0 and w and h and max(w, h) > max_size:
+        if w >= h:
+            vf_filters.append(f'scale={max_size}:-2')
+        else:
+            vf_filters.append(f'scale=-2:{max_size}')
+    kind = pages.classify_image(in_path, w, h)
+    gray = kind in ('gray', 'near_gray')
+    if gray and not encoders.is_gray_capable():
+        vf_filters.append('format=gray')
+    if kind == 'palette':
+        # スクリーントーン等の少色PNGはロスレスWebPと比べる
+        webp_args = ['-c:v', 'libwebp', '-lossless', '1', '-compression_level', '6', '-pix_fmt', 'bgra']
+    else:
+        webp_args = ['-c:v', 'libwebp', '-quality', str(quality), '-pix_fmt', 'yuv420p']
+    webp_path = out_path.rsplit('.', 1)[0] + '.webp'
 
+    chain = ','.join(vf_filters + ['split=2[a][w]'])
     cmd = [
         'ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
-        '-i', in_path,
+        '-i', in_path, '-filter_complex', f'[0:v]{chain}',
+        '-map', '[a]', *encoders.av1_args(quality, gray), '-frames:v', '1', '-f', 'avif', out_path,
+        '-map', '[w]', *webp_args, '-frames:v', '1', '-f', 'webp', webp_path,
     ]
-    if vf_filters:
-        cmd += ['-vf', ','.join(vf_filters)]
-    cmd += [
-        '-c:v', 'av1_nvenc',
-        '-cq', str(cq),
-        '-pix_fmt', 'yuv420p',
-        '-frames:v', '1',
-        out_path
+
+    backend = encoders.current_backend()['name'] + '+libwebp'
+    pixels = w * h if w and h else os.path.getsize(in_path) * 4
+    t = time.time()
+    err = quarantine.run_guarded(cmd, in_path, quarantine.encode_timeout(backend, pixels))
+    if err:
+        return None, err
+    quarantine.record_speed(backend, pixels, time.time() - t)
+    history_db.note_pixels(in_path, pixels)
+    tuner.add_pixels(pixels)
+
+    candidates = sorted((p for p in (out_path, webp_path) if os.path.exists(p) and os.path.getsize(p) > 0),
+                        key=os.path.getsize)
+    check = verify.sampled()
+    for path in candidates:
+        err = verify.check(in_path, path, w, h, force=True) if check else None
+        if not err:
+            for other in candidates:
+                if other != path:
+                    os.remove(other)
+            return path, None
+    return None, err or 'no output'
+
+
+def timed_task(func, *args):
+    """func(*args) の結果と所要秒数を返す（実績の記録用。ディレクトリ一括変換のガバナー・--adaptive の枠が空くまで待ってから始める）"""
+    with governor.slot(), tuner.slot():
+        t = time.time()
+        return func(*args), time.time() - t
+
+
+@contextmanager
+def cancel_on_interrupt(executor):
+    """Ctrl-C（SIGINT）で抜けるときは、まだ始まっていない変換を捨てる
+    with ThreadPoolExecutor を抜けるときの shutdown(wait=True) だけでは、残りのページを全部変換してから抜けてしまう。
+    """
+    try:
+        yield executor
+    except KeyboardInterrupt:
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+
+
+def extract_and_convert(reader, member, conv, args):
+    """ZIPメンバを書き出してから変換（伸長も変換ワーカーの中で並列に行う。member が None なら展開済み）"""
+    if member is not None:
+        reader.extract_to(member, args[0])
+    return conv(args)
+
+
+def retarget_and_convert(reader, member, conv, args):
+    """軽い形式（AVIF/WebP）のページは長辺が max_size を超える場合だけ縮小して変換し、
+    それ以外は元のまま残す（--retarget。元のままなら in_path をそのまま返す）
+    """
+    in_path, max_size = args[0], args[3]
+    if member is not None:
+        reader.extract_to(member, in_path)
+    with open(in_path, 'rb') as f:
+        size = archive_index.image_dimensions(f.read(archive_index.HEADER_BYTES))
+    if not size:
+        w, h = get_image_size(in_path)
+        size = (w, h) if w and h else None
+    if not size or max_size <= 0 or max(size) <= max_size:
+        return in_path, None
+    return conv(args)
+
+
+def fit_size(w, h, max_size):
+    """長辺を max_size に縮めた寸法（ffmpeg の scale=N:-2 と同じく短辺は偶数に丸める）"""
+    if max_size <= 0 or max(w, h) <= max_size:
+        return w, h
+    if w >= h:
+        return max_size, max(2, round(h * max_size / w / 2) * 2)
+    return max(2, round(w * max_size / h / 2) * 2), max_size
+
+
+def decode_page(data, max_size):
+    """Pillowで1回だけデコード・縮小し、(画像, 色の種類) を返す
+    JPEGは draft で DCT の段階から縮小デコードする。色の判定も同じ画素から行う。
+    MAX_PIXELS を超える画像は DecompressionBombError にする（呼び出し側が ffmpeg の経路に回す）。
+    """
+    img = Image.open(io.BytesIO(data))
+    if img.width * img.height > MAX_PIXELS:
+        # ヘッダの寸法だけで弾く（デコードしない）
+        raise Image.DecompressionBombError(f'{img.width}x{img.height} exceeds {MAX_PIXELS} pixels')
+    allow_palette = img.format == 'PNG'
+    tw, th = fit_size(img.width, img.height, max_size)
+    if (tw, th) != img.size:
+        img.draft(img.mode, (tw, th))
+        img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+        img = img.resize((tw, th), Image.LANCZOS)
+    else:
+        img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+    return img, pages.classify_decoded(img, allow_palette)
+
+
+def convert_piped(data, page, args):
+    """デコード済みの画素を生のまま ffmpeg の標準入力に流してAVIFにエンコード
+    入力の一時ファイル・ffprobe・ffmpeg 側の再デコードと scale を使わない。
+    AVIF の muxer はシーク可能な出力が必要なため、出力だけは out_path に書く。
+    """
+    in_path, out_path, quality, max_size = args
+    img, kind = page
+    gray = kind in ('gray', 'near_gray')
+    # グレーは1面だけ送る（yuv400非対応のエンコーダでは ffmpeg が色差一定の yuv420p にする）
+    planes = img.convert('L' if gray else 'RGB')
+    w, h = planes.size
+    cmd = [
+        'ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
+        '-f', 'rawvideo', '-pix_fmt', 'gray' if gray else 'rgb24', '-s', f'{w}x{h}', '-i', '-',
+        *encoders.av1_args(quality, gray), '-frames:v', '1', '-f', 'avif', out_path
     ]
 
-    result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
-    if result.returncode != 0:
-        return None, result.stderr
+    backend = encoders.current_backend()['name']
+    t = time.time()
+    err = quarantine.run_guarded(cmd, in_path, quarantine.encode_timeout(backend, w * h),
+                                 input=planes.tobytes(), key=quarantine.data_key(data))
+    if err:
+        return None, err
+    quarantine.record_speed(backend, w * h, time.time() - t)
+    history_db.note_pixels(in_path, w * h)
+    tuner.add_pixels(w * h)
+    err = verify.check_image(img, out_path)
+    if err:
+        return None, err
+    return out_path, None
+
+
+def pipe_and_convert(reader, member, conv, args):
+    """画像をメモリに読み、Pillowでデコードしてパイプ経由で変換
+    member が None なら展開済みのファイルを読む。Pillowで読めない画像と pillow_avif バックエンドは
+    conv（ファイル経由の変換）に任せる。変換しなかった・失敗したときは元データを in_path に書き出す。
+    """
+    in_path, max_size = args[0], args[3]
+    if member is None:
+        with open(in_path, 'rb') as f:
+            data = f.read()
+    else:
+        data = reader.read(member)
+    reason = quarantine.is_quarantined(in_path, quarantine.data_key(data))
+    if reason:
+        result = (None, f'quarantined: {reason}')
+    else:
+        try:
+            page = None if encoders.uses_pillow() else decode_page(data, max_size)
+        except Image.DecompressionBombError:
+            # 大きすぎる画像は、タイムアウトと隔離の効く ffmpeg の経路で変換する
+            page = None
+        except Exception:
+            page = None
+        if page is None:
+            if member is not None:
+                with open(in_path, 'wb') as f:
+                    f.write(data)
+            return conv(args)
+        result = convert_piped(data, page, args)
+    if not result[0] and member is not None:
+        with open(in_path, 'wb') as f:
+            f.write(data)
+    return result
+
+
+def convert_animation(args):
+    """アニメーションGIFをアニメーションAVIFに変換（pages.convert_animation）"""
+    in_path, out_path, quality, max_size = args
+    err = pages.convert_animation(in_path, out_path, quality, max_size, 'avif')
+    if err:
+        return None, err
     return out_path, None
 
 
+def convert_nested(src, dst, quality, workers, max_size, depth, tmpdir, best_of=False, pipe=False):
+    """入れ子のアーカイブを再帰的に変換して dst(ZIP) に書く
+    zip/cbz はメンバを1つずつストリームで読み、変換中の画像だけを一時ファイルにする
+    （同時に workers*2 枚まで）。rar/7z は一時ディレクトリに展開してから同様に処理する。
+    MAX_NEST_DEPTH を超える入れ子はそのままコピーする。
+    """
+    work = tempfile.mkdtemp(dir=tmpdir)
+    reader = None
+    try:
+        ext = archive_index.archive_ext(src)
+        members = []  # (名前, サイズ, ストリームを開く関数, ZipInfo または展開済みのパス)
+        if ext in ('zip', 'cbz'):
+            reader = archive_index.ParallelZipReader(src)
+            for info in reader.members:
+                members.append((info.filename, info.file_size, lambda i=info: reader.open(i), info))
+        else:
+            ex_dir = os.path.join(work, 'x')
+            os.makedirs(ex_dir)
+            extract_archive(src, ex_dir)
+            for root, dirs, files in os.walk(ex_dir):
+                for f in files:
+                    full = os.path.join(root, f)
+                    rel = os.path.relpath(full, ex_dir).replace(os.sep, '/')
+                    members.append((rel, os.path.getsize(full), lambda p=full: open(p, 'rb'), full))
+
+        with zipfile.ZipFile(dst, 'w', zipfile.ZIP_STORED) as zout, \
+                ThreadPoolExecutor(max_workers=workers) as executor, cancel_on_interrupt(executor):
+            pending = {}
+
+            def finish(future):
+                name, new_name, in_path, out_path = pending.pop(future)
+                result_path, err = future.result()
+                use = bool(result_path and os.path.exists(result_path))
+                if use and name.rsplit('.', 1)[-1].lower() in ANIM_EXTS:
+                    # アニメーションは元より大きければ元を採用
+                    use = os.path.getsize(result_path) < os.path.getsize(in_path)
+                if use:
+                    # best-of では WebP が選ばれることがある
+                    zout.write(result_path, new_name.rsplit('.', 1)[0] + os.path.splitext(result_path)[1])
+                else:
+                    zout.write(in_path, name)
+                for p in [in_path, out_path] + ([result_path] if result_path else []):
+                    if os.path.exists(p):
+                        os.remove(p)
+
+            for idx, (name, size, opener, ref) in enumerate(members):
+                m_ext = archive_index.archive_ext(name)
+                if m_ext in IMAGE_EXTS or m_ext in ANIM_EXTS:
+                    in_path = ref if reader is None else os.path.join(work, f"{idx}.{m_ext}")
+                    out_path = os.path.join(work, f"{idx}.avif")
+                    conv = convert_animation if m_ext in ANIM_EXTS else (convert_best if best_of else convert_image)
+                    task = pipe_and_convert if pipe and conv is convert_image else extract_and_convert
+                    f = executor.submit(task, reader, None if reader is None else ref,
+                                        conv, (in_path, out_path, quality, max_size))
+                    pending[f] = (name, name.rsplit('.', 1)[0] + '.avif', in_path, out_path)
+                    while len(pending) >= workers * 2:
+                        finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for fut in finished:
+                            finish(fut)
+                elif m_ext in ARCHIVE_EXTS and depth < MAX_NEST_DEPTH:
+                    inner = os.path.join(work, f"{idx}.{m_ext}")
+                    inner_out = os.path.join(work, f"{idx}.out.zip")
+                    with opener() as fi, open(inner, 'wb') as fo:
+                        shutil.copyfileobj(fi, fo, STAGE_BLOCK)
+                    try:
+                        convert_nested(inner, inner_out, quality, workers, max_size, depth + 1, work, best_of, pipe)
+                        smaller = os.path.getsize(inner_out) < size
+                    except Exception as e:
+                        print(f"  ERROR nested {name}: {e}", flush=True)
+                        smaller = False
+                    if smaller:
+                        zout.write(inner_out, name[:-len(m_ext)] + NESTED_OUT_EXTS[m_ext])
+                    else:
+                        zout.write(inner, name)
+                    for p in (inner, inner_out):
+                        if os.path.exists(p):
+                            os.remove(p)
+                else:
+                    with opener() as fi, zout.open(name, 'w', force_zip64=size > 0x7fffffff) as fo:
+                        shutil.copyfileobj(fi, fo, STAGE_BLOCK)
+
+            for future in as_completed(list(pending)):
+                finish(future)
+    finally:
+        if reader:
+            reader.close()
+        shutil.rmtree(work, ignore_errors=True)
+
+
 def main():
-    if len(sys.argv) < 4:
+    args, opts = parse_options(sys.argv[1:])
+    if len(args) < 3:
         print("Usage: python3 zip_to_avif_gpu.py <入力アーカイブ> <出力ZIP> <品質(1-100)> [並列数] [最大辺px]")
-        print("  対応形式: zip, rar, 7z, cbz, cbr")
+        print("  対応形式: zip, rar, 7z, cbz, cbr, tar, cbt, tar.zst（.tar.zst は zstd コマンドが必要）")
+        print("  出力の拡張子が .tar / .cbt / .tar.zst なら tar で先頭から順に書く（それ以外はZIP）")
         print("  品質の目安: 60=最大圧縮, 75=推奨, 85=高画質")
+        print("  --abort-after=N: N枚変換した時点で見込み圧縮率を判定（デフォルト40、0で無効）")
+        print("  --abort-ratio=R: 見込み圧縮率がR%を超えたら中止（デフォルト90）")
+        print("  --stage: 入力をLinux側に順次コピーしてから展開し、出力ZIPも順次書き戻す（/mnt 上のファイル向け）")
+        print("  --verify=R: 出力を縮小デコードして元画像と比べる割合（デフォルト1=全数、0で無効）")
+        print(f"  --min-psnr=DB: 検証の合格ライン（デフォルト{verify.MIN_PSNR:.0f}dB、輝度SSIMは{verify.MIN_SSIM}以上）")
+        print("  --best-of: 各ページを1回デコードしてAVIFとWebPを同時にエンコードし、品質を満たす小さい方を採用")
+        print("  --pipe: Pillowでデコード・縮小した画素をffmpegの標準入力に流す（入力の一時ファイルとffprobeを省く、要Pillow）")
+        print("  --adaptive[=LO-HI]: 完了した画素数/秒を見て並列数を実行中に増減（デフォルトの範囲は1〜並列数×2）")
+        print("  --retarget: AVIF/WebPのページは長辺が最大辺を超えるものだけ縮小して変換し、残りはそのままコピー")
+        print(f"  --align=N: 出力ZIPの各エントリのデータ先頭をNバイト境界に揃える（デフォルト{archive_index.PAGE_ALIGN}、1で無効）")
+        print("  --encoder=NAME: AV1エンコーダを指定（av1_nvenc, libsvtav1, librav1e, libaom-av1, pillow_avif）")
+        print("                  省略時は使えるものから最速を自動選択（判定結果は ~/.cache/zip_to_avif/encoders.json）")
         print("  最大辺: 長辺がこのpxを超える画像を縮小（デフォルト3000、0で無効）")
         sys.exit(1)
 
-    src = to_wsl_path(sys.argv[1])
-    dst = to_wsl_path(sys.argv[2])
-    quality = int(sys.argv[3])
-    workers = int(sys.argv[4]) if len(sys.argv) > 4 else 4
-    max_size = int(sys.argv[5]) if len(sys.argv) > 5 else 3000
+    src = to_wsl_path(args[0])
+    dst = to_wsl_path(args[1])
+    quality = int(args[2])
+    workers = int(args[3]) if len(args) > 3 else 4
+    max_size = int(args[4]) if len(args) > 4 else 3000
+    abort_after = int(opts.get('abort-after', 40))
+    abort_ratio = float(opts.get('abort-ratio', 90))
+    stage = 'stage' in opts
+    align = int(opts.get('align') or archive_index.PAGE_ALIGN)
+    retarget = 'retarget' in opts
+    best_of = 'best-of' in opts
+    # best-of は ffmpeg 側で split するのでファイル経由のまま
+    pipe = 'pipe' in opts and not best_of
+    if pipe and Image is None:
+        print("  WARNING: Pillow is not installed, --pipe is disabled", flush=True)
+        pipe = False
+    if pipe:
+        # MAX_PIXELS 以下なら Pillow の展開爆弾の警告を出さない（超えるものは decode_page で弾く）
+        Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+    verify.configure(float(opts.get('verify') or 1), float(opts.get('min-psnr') or verify.MIN_PSNR))
+    # ディレクトリ一括変換のガバナーから起動された場合は、その同時変換数に変換中も従う
+    governor.follow()
+    try:
+        pool = tuner.options_to_config(opts, workers)
+    except ValueError as e:
+        print(f"エラー: {e}")
+        sys.exit(1)
+
+    try:
+        backend = encoders.select_backend(workers, opts.get('encoder') or None)
+    except ValueError as e:
+        print(f"エラー: {e}")
+        sys.exit(1)
 
     # 入力ファイルチェック
     if not os.path.isfile(src):
         print(f"エラー: ファイルが見つかりません: {src}")
         sys.exit(1)
 
-    ext = src.rsplit('.', 1)[-1].lower() if '.' in src else ''
+    ext = archive_index.archive_ext(src)
     if ext not in ARCHIVE_EXTS:
         print(f"エラー: 未対応の形式です (.{ext})")
         print(f"  対応形式: {', '.join(sorted(ARCHIVE_EXTS))}")
         sys.exit(1)
 
     start = time.time()
+    series = history_db.series_of(src)
+    history_db.start_run('zip_to_avif_gpu', 'avif', quality, workers, max_size, backend['name'])
 
     with tempfile.TemporaryDirectory() as tmpdir:
         in_dir = os.path.join(tmpdir, 'in')
@@ -130,24 +565,54 @@ def main():
 
         # アーカイブを展開
         print("Extracting archive...", flush=True)
-        extract_archive(src, in_dir)
-
-        # 展開されたファイルを走査
-        all_files = []
-        for root, dirs, files in os.walk(in_dir):
-            for f in files:
-                full = os.path.join(root, f)
-                rel = os.path.relpath(full, in_dir)
+        stage_time = 0.0
+        local_src = src
+        if stage:
+            t = time.time()
+            local_src = os.path.join(tmpdir, 'src.' + ext)
+            copy_sequential(src, local_src)
+            stage_time += time.time() - t
+        reader = None
+        members = {}  # 展開先パス -> ZipInfo / TarMember（まだ展開していない）
+        tar = ext in archive_index.TAR_EXTS
+        if ext in ('zip', 'cbz') or tar:
+            # ZIPは一括展開せず、画像は変換ワーカーの中でメンバごとに並列に伸長する。
+            # tar は中央ディレクトリもシークも無いので、別スレッドが先頭から1回だけ読み、
+            # 届いた画像から順に変換ワーカーへ渡す（展開し終わるのを待たない）
+            if tar:
+                reader = archive_index.TarStreamReader(local_src, ahead=pool * 2)
+            else:
+                reader = archive_index.ParallelZipReader(local_src)
+            all_files = []
+            for idx, info in enumerate(reader.members):
+                rel = archive_index.safe_member_name(info.filename)
+                if not rel:
+                    continue
+                base = os.path.basename(rel)
+                full = os.path.join(in_dir, f"{idx}.{archive_index.archive_ext(base)}" if '.' in base else str(idx))
                 all_files.append((full, rel))
-
-        print(f"  {len(all_files)} files extracted", flush=True)
+                members[full] = info
+            mode = 'streaming' if tar else 'extracting in parallel with conversion'
+            print(f"  {len(all_files)} files ({mode})", flush=True)
+        else:
+            extract_archive(local_src, in_dir)
+
+            # 展開されたファイルを走査
+            all_files = []
+            for root, dirs, files in os.walk(in_dir):
+                for f in files:
+                    full = os.path.join(root, f)
+                    rel = os.path.relpath(full, in_dir)
+                    all_files.append((full, rel))
+
+            print(f"  {len(all_files)} files extracted", flush=True)
 
         # 変換タスクを準備
         tasks = []
         non_image_files = []
         for full_path, rel_name in all_files:
             ext_f = rel_name.rsplit('.', 1)[-1].lower() if '.' in rel_name else ''
-            if ext_f in IMAGE_EXTS:
+            if ext_f in IMAGE_EXTS or ext_f in ANIM_EXTS or (retarget and ext_f in LIGHT_EXTS):
                 out_name = rel_name.rsplit('.', 1)[0] + '.avif'
                 out_path = os.path.join(out_dir, out_name)
                 os.makedirs(os.path.dirname(out_path), exist_ok=True)
@@ -155,62 +620,195 @@ def main():
             else:
                 non_image_files.append((full_path, rel_name))
 
+        if tar:
+            # 画像以外は読み進める途中でそのまま書き出す（先に書き出すと画像を読み飛ばせない）
+            for p, _ in non_image_files:
+                reader.spill(members[p], p)
+            reader.start([members[t[0]] for t in tasks])
+        elif reader:
+            # 画像以外（入れ子のアーカイブ等）は先に並列で書き出しておく
+            with ThreadPoolExecutor(max_workers=workers) as ex, cancel_on_interrupt(ex):
+                list(ex.map(lambda p: reader.extract_to(members[p], p), [p for p, _ in non_image_files]))
+
         # GPU並列変換
-        print(f"Converting {len(tasks)} images with GPU (workers={workers}, max_size={max_size})...", flush=True)
+        print(f"Converting {len(tasks)} images with {backend['name']} (workers={workers}, max_size={max_size}"
+              f"{', piped' if pipe else ''})...", flush=True)
+        hist = history_db.series_table('avif').get(series)
+        if hist:
+            # 同じシリーズの過去の実績から見込みを出す
+            print(f"  History: '{series}' shrinks to {hist['ratio'] * 100:.0f}% at {hist['sec_per_page']:.1f} s/page "
+                  f"({hist['pages']} pages), ETA ~{hist['sec_per_page'] * len(tasks) / workers:.0f}s", flush=True)
         results = {}
         errors = 0
         done = 0
 
-        with ThreadPoolExecutor(max_workers=workers) as executor:
-            futures = {}
-            for in_path, out_path, q, orig_name, new_name in tasks:
-                f = executor.submit(convert_image, (in_path, out_path, q, max_size))
-                futures[f] = (orig_name, new_name, in_path, out_path)
-
-            for future in as_completed(futures):
-                orig_name, new_name, in_path, out_path = futures[future]
-                done += 1
-                result_path, err = future.result()
-
-                if result_path and os.path.exists(result_path):
-                    results[new_name] = result_path
-                else:
-                    results[orig_name] = in_path
-                    errors += 1
-                    if err:
-                        print(f"  ERROR {orig_name}: {err.strip()}", flush=True)
-
-                if done % 20 == 0 or done == len(tasks):
-                    elapsed = time.time() - start
-                    eta = elapsed / done * (len(tasks) - done) if done > 0 else 0
-                    print(f"  [{done}/{len(tasks)}] Elapsed: {elapsed:.0f}s | ETA: {eta:.0f}s", flush=True)
+        # 早期中止の判定用（見込み圧縮率 = 非画像 + 変換済み + 未変換×現在の圧縮率）
+        other_bytes = sum(members[p].file_size if p in members else os.path.getsize(p) for p, _ in non_image_files)
+        image_bytes = sum(members[t[0]].file_size if t[0] in members else os.path.getsize(t[0])
+                          for t in tasks)
+        done_in = 0
+        done_out = 0
+        retarget_kept = 0
+        webp_count = 0
+        projected = None
+
+        try:
+            with ThreadPoolExecutor(max_workers=pool) as executor, cancel_on_interrupt(executor):
+                futures = {}
+                for in_path, out_path, q, orig_name, new_name in tasks:
+                    if orig_name.rsplit('.', 1)[-1].lower() in ANIM_EXTS:
+                        conv = convert_animation
+                    else:
+                        conv = convert_best if best_of else convert_image
+                    if retarget and orig_name.rsplit('.', 1)[-1].lower() in LIGHT_EXTS:
+                        task = retarget_and_convert
+                    else:
+                        task = pipe_and_convert if pipe and conv is convert_image else extract_and_convert
+                    f = executor.submit(timed_task, task, reader, members.get(in_path), conv,
+                                        (in_path, out_path, q, max_size))
+                    futures[f] = (orig_name, new_name, in_path, out_path)
+
+                for future in as_completed(futures):
+                    orig_name, new_name, in_path, out_path = futures[future]
+                    done += 1
+                    (result_path, err), sec = future.result()
+                    out_before = done_out
+
+                    # パイプ変換に成功したZIPメンバは in_path に書き出されていない
+                    in_size = members[in_path].file_size if in_path in members else os.path.getsize(in_path)
+                    done_in += in_size
+                    if result_path == in_path:
+                        # --retarget で縮小の要らなかった軽いページ
+                        results[orig_name] = in_path
+                        done_out += in_size
+                        retarget_kept += 1
+                    elif result_path and os.path.exists(result_path):
+                        out_size = os.path.getsize(result_path)
+                        if orig_name.rsplit('.', 1)[-1].lower() in ANIM_EXTS and out_size >= in_size:
+                            # アニメーションは元より大きければ元を採用
+                            results[orig_name] = in_path
+                            done_out += in_size
+                        else:
+                            if result_path.endswith('.webp'):
+                                # best-of で WebP の方が小さかった
+                                new_name = new_name.rsplit('.', 1)[0] + '.webp'
+                                webp_count += 1
+                            results[new_name] = result_path
+                            done_out += out_size
+                    else:
+                        results[orig_name] = in_path
+                        done_out += in_size
+                        errors += 1
+                        if err:
+                            print(f"  ERROR {orig_name}: {err.strip()}", flush=True)
+                    history_db.add_image(in_path, series, orig_name.rsplit('.', 1)[-1].lower(), in_size,
+                                         done_out - out_before, sec, result_path)
+
+                    if done % 20 == 0 or done == len(tasks):
+                        elapsed = time.time() - start
+                        eta = elapsed / done * (len(tasks) - done) if done > 0 else 0
+                        print(f"  [{done}/{len(tasks)}] Elapsed: {elapsed:.0f}s | ETA: {eta:.0f}s", flush=True)
+
+                    if abort_after > 0 and done == abort_after and done < len(tasks) and done_in > 0:
+                        rest = image_bytes - done_in
+                        est_out = other_bytes + done_out + rest * done_out / done_in
+                        ratio = est_out / (other_bytes + image_bytes) * 100
+                        if ratio > abort_ratio:
+                            projected = ratio
+                            for f in futures:
+                                f.cancel()
+                            break
+        except KeyboardInterrupt:
+            if reader:
+                # 読み込みスレッドを止めてから一時ディレクトリを消す
+                if tar:
+                    reader.abort()
+                reader.close()
+            raise
+
+        if reader:
+            if projected is not None and tar:
+                reader.abort()
+            # tar は末尾までの画像以外の書き出しを待つ
+            reader.close()
+
+        if projected is not None:
+            print(f"\nAborted: projected ratio {projected:.0f}% after {done} images "
+                  f"(threshold {abort_ratio:.0f}%), not worth converting", flush=True)
+            mark_not_worth(src, 'avif', projected)
+            history_db.add_archive(src, os.path.getsize(src), None, done, time.time() - start, 'not_worth')
+            history_db.add_busy(done, time.time() - start)
+            history_db.flush()
+            sys.exit(EXIT_NOT_WORTH)
+
+        # 入れ子のアーカイブを再帰的に変換（小さくなったものだけ差し替え）
+        nested = [(p, n) for p, n in non_image_files
+                  if archive_index.archive_ext(n) in ARCHIVE_EXTS]
+        if nested:
+            print(f"Converting {len(nested)} nested archives...", flush=True)
+        for idx, (full_path, rel_name) in enumerate(nested):
+            nested_out = os.path.join(out_dir, f".nested_{idx}.zip")
+            try:
+                convert_nested(full_path, nested_out, quality, workers, max_size, 1, tmpdir, best_of, pipe)
+            except Exception as e:
+                print(f"  ERROR nested {rel_name}: {e}, keeping original", flush=True)
+                continue
+            if os.path.getsize(nested_out) < os.path.getsize(full_path):
+                non_image_files.remove((full_path, rel_name))
+                n_ext = archive_index.archive_ext(rel_name)
+                results[rel_name[:-len(n_ext)] + NESTED_OUT_EXTS[n_ext]] = nested_out
 
         # 新しいZIPを作成
-        print("Creating output ZIP...", flush=True)
+        print("Creating output archive...", flush=True)
         total_out = 0
 
-        with zipfile.ZipFile(dst, 'w', zipfile.ZIP_STORED) as zout:
-            for name, path in sorted(results.items()):
-                data = open(path, 'rb').read()
-                zout.writestr(name, data)
-                total_out += len(data)
-
-            for full_path, rel_name in non_image_files:
-                data = open(full_path, 'rb').read()
-                zout.writestr(rel_name, data)
-                total_out += len(data)
+        out_ext = archive_index.archive_ext(dst)
+        zip_path = os.path.join(tmpdir, 'out.' + out_ext) if stage else dst
+        # 変換したページ・元のまま残したページ・画像以外を、ページ番号の自然順でまとめて並べる
+        entries = list(results.items()) + [(rel_name, full_path) for full_path, rel_name in non_image_files]
+        entries.sort(key=lambda e: archive_index.natural_key(e[0]))
+        if out_ext in archive_index.TAR_EXTS:
+            # tar は先頭から順に1回書くだけで済む（中央ディレクトリを最後に書き足さない）
+            with archive_index.tar_writer(zip_path) as tout:
+                for name, path in entries:
+                    total_out += archive_index.write_tar(tout, name, path)
+        else:
+            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zout:
+                for name, path in entries:
+                    with open(path, 'rb') as f:
+                        total_out += archive_index.write_aligned(zout, name, f.read(), align)
+
+        if stage:
+            t = time.time()
+            write_back(zip_path, dst)
+            stage_time += time.time() - t
 
         in_size = os.path.getsize(src)
         out_size = os.path.getsize(dst)
 
     elapsed = time.time() - start
+    history_db.add_archive(src, in_size, out_size, len(tasks), elapsed, 'done')
+    history_db.add_busy(len(tasks), elapsed)
+    history_db.flush()
     print(f"\nDone in {elapsed:.0f}s")
     print(f"Input:  {in_size/1024/1024:.1f} MB")
     print(f"Output: {out_size/1024/1024:.1f} MB")
     print(f"Ratio: {out_size/in_size*100:.1f}%")
+    if stage:
+        print(f"Staging: {stage_time:.1f}s sequential copy in/out")
+    if best_of:
+        print(f"Best-of: {webp_count} pages WebP, the rest AVIF")
+    if retarget:
+        print(f"Retarget: {retarget_kept} light pages already within {max_size}px, copied as is")
     if errors:
         print(f"Errors: {errors} files kept original")
+    tuner.report()
 
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    except KeyboardInterrupt:
+        # 一時ディレクトリは with を抜けるときに消えている
+        print("\nInterrupted.", flush=True)
+        sys.exit(130)